@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+
+"""
+appengine_config.py -- Udacity conference server-side Python App Engine
+    configuration imported by the runtime before the application
+
+$Id$
+
+"""
+
+import importprofile
+
+# time the imports of the application (see importprofile.py)
+importprofile.install()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""
+batch.py -- Udacity conference server-side Python App Engine
+    several ConferenceApi calls in one HTTP request
+
+$Id$
+
+"""
+
+"""
+    The batch endpoint takes a list of (method name, JSON request message)
+    items and returns the responses in the same order, each either a JSON
+    response message or the HTTP status and message of its error, so that
+    one failing call does not fail the others.
+
+    All calls run within the batch request: the user is authenticated once
+    (Endpoints only verifies the token when it has not done so yet during
+    the request) and they all share the request's ndb context, so an
+    entity read by one call is served from the context cache to the next.
+
+    Items overlap when their method has an asynchronous variant: a
+    _<method>Async method of the service that takes the same request and
+    returns a Future, e.g. _getConferenceDetailAsync. The read methods
+    that pages combine have one (getConference, getConferenceDetail,
+    getConferenceSessions, getSessionsBySpeaker, getFeaturedSpeaker,
+    getProfile, getConferencesToAttend, getRegistrationStatus and
+    getWaitlistPosition); methods that change data must not, since their
+    order within the batch matters. Consecutive items of such methods are
+    started together, and whenever one of them waits for an RPC the event
+    loop moves the others along. Every other item runs to completion on
+    its own, after everything before it and before anything after it.
+
+    An item whose request message cannot be decoded fails with a 400; an
+    error raised by the method itself is reported with its Endpoints
+    status, or as a 500 for any other exception.
+"""
+
+import logging
+
+import endpoints
+from protorpc import messages
+from protorpc import protojson
+from google.appengine.ext import ndb
+
+from models import BatchResponseItem
+
+MAX_BATCH_SIZE = 25
+
+
+def _resolve(service, name):
+    """ Returns the bound Endpoints method of a service for a batch item,
+        or None if there is no such method (or it is the batch method). """
+    method = getattr(service, name, None)
+    info = getattr(method, 'method_info', None)
+    if info is None or name == 'batch':
+        return None
+    return method
+
+
+def _asyncVariant(service, name, method):
+    """ Returns the asynchronous variant of a method, or None """
+    if method is None:
+        return None
+    return getattr(service, '_%sAsync' % name, None)
+
+
+@ndb.tasklet
+def _callAsync(method, variant, item):
+    """ Runs a single batch item, through its asynchronous variant when it
+        has one, and returns (as a Future) its BatchResponseItem. Errors
+        are reported in the item. """
+    result = BatchResponseItem(method=item.method)
+    if method is None:
+        result.errorCode = 404
+        result.errorMessage = 'No such method: %s' % item.method
+        raise ndb.Return(result)
+
+    try:
+        request = protojson.decode_message(method.remote.request_type,
+                                           item.body or '{}')
+    except (messages.Error, ValueError) as e:
+        result.errorCode = 400
+        result.errorMessage = str(e)
+        raise ndb.Return(result)
+
+    try:
+        if variant is not None:
+            response = yield variant(request)
+        else:
+            response = method(request)
+        result.body = protojson.encode_message(response)
+    except endpoints.ServiceException as e:
+        result.errorCode = e.http_status
+        result.errorMessage = str(e)
+    except Exception as e:
+        logging.exception('Batch item %s failed', item.method)
+        result.errorCode = 500
+        result.errorMessage = 'Internal error'
+    raise ndb.Return(result)
+
+
+def runBatch(service, items):
+    """ Runs the items of a batch request against a ConferenceApi instance
+        and returns their BatchResponseItems in request order. """
+    if len(items) > MAX_BATCH_SIZE:
+        raise endpoints.BadRequestException(
+            'A batch holds at most %d calls' % MAX_BATCH_SIZE)
+
+    results = []
+    group = []
+    for item in items:
+        method = _resolve(service, item.method)
+        variant = _asyncVariant(service, item.method, method)
+        if variant is None:
+            results.extend(future.get_result() for future in group)
+            group = []
+            results.append(_callAsync(method, None, item).get_result())
+        else:
+            group.append(_callAsync(method, variant, item))
+    results.extend(future.get_result() for future in group)
+    return results
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+"""
+build_static.py -- Udacity conference server-side Python App Engine
+    build of the fingerprinted static bundles of the web client
+
+$Id$
+
+"""
+
+"""
+    The web client is served from templates/index.html, which loads its
+    stylesheets and scripts one file each and its Angular partials one
+    request per view. This script builds what the deployed client loads
+    instead, under static/build:
+
+        app.<hash>.css  the stylesheets between the <!-- build:css -->
+                        and <!-- endbuild --> markers of index.html,
+                        concatenated and minified
+        app.<hash>.js   the scripts between the <!-- build:js --> markers,
+                        followed by every partial of static/partials put
+                        in Angular's $templateCache under its /partials/
+                        URL (so the views need no request of their own),
+                        concatenated and minified
+        index.html      templates/index.html loading the two bundles
+
+    The hash in a bundle's name is taken from its contents, so a bundle
+    never changes under its name and is served with a one year
+    expiration, while index.html is only cached briefly. The handlers
+    doing so are (re)generated in app.yaml between the BEGIN_MARKER and
+    END_MARKER lines. The bundles of the previous build are kept, for
+    clients still holding the previous index.html; older ones are
+    deleted.
+
+    Minification uses the standard library only. Comments are dropped
+    and whitespace collapsed outside strings (and regular expression
+    literals); JavaScript keeps its line breaks, so that statements
+    ending without a semicolon still end. Run it from the project
+    directory before deploying:
+
+        python build_static.py
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import re
+
+INDEX_TEMPLATE = os.path.join('templates', 'index.html')
+BUILD_DIR = os.path.join('static', 'build')
+BUILD_URL = '/build/'
+PARTIALS_DIR = os.path.join('static', 'partials')
+PARTIALS_URL = '/partials/'
+ANGULAR_MODULE = 'conferenceApp'
+APP_YAML = 'app.yaml'
+MANIFEST = 'manifest.json'
+
+""" the static_dir handlers of app.yaml, by URL prefix """
+URL_DIRS = {
+    '/css/': os.path.join('static', 'bootstrap', 'css'),
+    '/js/': os.path.join('static', 'js'),
+}
+
+BUILD_BLOCK_RE = re.compile(
+    r'[ \t]*<!-- build:(css|js) (\S+) -->(.*?)<!-- endbuild -->',
+    re.S)
+ASSET_RE = re.compile(r'(?:href|src)="([^"]+)"')
+
+BEGIN_MARKER = '# BEGIN static build (generated by build_static.py)'
+END_MARKER = '# END static build'
+APP_YAML_HANDLERS = '''%s
+- url: /build
+  static_dir: static/build
+  expiration: "365d"
+
+- url: /
+  static_files: static/build/index.html
+  upload: static/build/index\\.html
+  secure: always
+  expiration: "1m"
+%s''' % (BEGIN_MARKER, END_MARKER)
+
+""" characters after which a '/' starts a regular expression literal """
+REGEX_PRECEDERS = set('(,=:[!&|?{};+-*%<>~^')
+REGEX_KEYWORDS = ('return', 'typeof', 'case', 'do', 'else', 'in',
+                  'instanceof', 'new', 'void', 'delete', 'throw')
+
+
+def _read(path):
+    with io.open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def _write(path, text):
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def _segments(text, js=False):
+    """ Splits source text into (is_code, text) segments, where the
+        segments that are not code are string (and, for JavaScript,
+        regular expression) literals, and drops the comments. """
+    segments = []
+    code = []
+    literal = ''
+    i, n = 0, len(text)
+    while i < n:
+        c = text[i]
+        nxt = text[i + 1] if i + 1 < n else ''
+        if c == '/' and nxt == '*':
+            end = text.find('*/', i + 2)
+            i = n if end < 0 else end + 2
+            code.append(' ')
+        elif js and c == '/' and nxt == '/':
+            end = text.find('\n', i)
+            i = n if end < 0 else end
+        elif c in '"\'' or (js and c == '/' and
+                             _startsRegex(literal + ''.join(code[-20:]))):
+            j = i + 1
+            in_class = False
+            while j < n:
+                if text[j] == '\\':
+                    j += 2
+                    continue
+                if c == '/' and text[j] == '[':
+                    in_class = True
+                elif c == '/' and text[j] == ']':
+                    in_class = False
+                elif text[j] == c and not in_class:
+                    break
+                j += 1
+            segments.append((True, ''.join(code)))
+            segments.append((False, text[i:j + 1]))
+            literal = text[i:j + 1][-20:]
+            code = []
+            i = j + 1
+        else:
+            code.append(c)
+            i += 1
+    segments.append((True, ''.join(code)))
+    return segments
+
+
+def _startsRegex(before):
+    """ Returns whether a '/' following the source text 'before' starts a
+        regular expression literal rather than a division """
+    before = before.rstrip()
+    if not before or before[-1] in REGEX_PRECEDERS:
+        return True
+    return re.search(r'\b(%s)$' % '|'.join(REGEX_KEYWORDS), before) is not None
+
+
+def minifyCss(css):
+    """ Drops comments and needless whitespace from a stylesheet """
+    out = []
+    for is_code, text in _segments(css):
+        if is_code:
+            text = re.sub(r'\s+', ' ', text)
+            text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+            text = re.sub(r':\s+', ':', text)
+            text = text.replace(';}', '}')
+        out.append(text)
+    return ''.join(out).strip()
+
+
+def minifyJs(js):
+    """ Drops comments, indentation and blank lines from a script """
+    out = []
+    for is_code, text in _segments(js, js=True):
+        if is_code:
+            text = re.sub(r'[ \t]*\n\s*', '\n', text)
+            text = re.sub(r'[ \t]+', ' ', text)
+        out.append(text)
+    return ''.join(out).strip() + '\n'
+
+
+def templateCacheJs(partials_dir=PARTIALS_DIR):
+    """ Returns the script that puts every partial in $templateCache """
+    puts = []
+    for name in sorted(os.listdir(partials_dir)):
+        if not name.endswith('.html'):
+            continue
+        html = re.sub(r'\n\s+', '\n',
+                      _read(os.path.join(partials_dir, name))).strip()
+        puts.append('    $templateCache.put(%s, %s);' % (
+            json.dumps(PARTIALS_URL + name), json.dumps(html)))
+    return ("angular.module('%s').run(['$templateCache', "
+            "function ($templateCache) {\n%s\n}]);\n"
+            % (ANGULAR_MODULE, '\n'.join(puts)))
+
+
+def _assetPath(url):
+    """ Returns the file served at the URL of a local asset """
+    for prefix, directory in URL_DIRS.items():
+        if url.startswith(prefix):
+            return os.path.join(directory, url[len(prefix):])
+    raise ValueError('Not a local asset: %s' % url)
+
+
+def _bundle(kind, name, block):
+    """ Builds the bundle of a build block of index.html and returns its
+        file name """
+    sources = [_read(_assetPath(url)) for url in ASSET_RE.findall(block)]
+    if kind == 'css':
+        text = '\n'.join(minifyCss(source) for source in sources) + '\n'
+    else:
+        sources.append(templateCacheJs())
+        text = ';\n'.join(minifyJs(source) for source in sources)
+
+    base, ext = os.path.splitext(name)
+    digest = hashlib.md5(text.encode('utf-8')).hexdigest()[:12]
+    file_name = '%s.%s%s' % (base, digest, ext)
+    _write(os.path.join(BUILD_DIR, file_name), text)
+    return file_name
+
+
+def buildIndex():
+    """ Builds the bundles and index.html, returning the bundle names """
+    files = []
+
+    def replace(match):
+        kind, name, block = match.groups()
+        file_name = _bundle(kind, name, block)
+        files.append(file_name)
+        indent = re.match(r'[ \t]*', match.group(0)).group(0)
+        if kind == 'css':
+            return '%s<link rel="stylesheet" href="%s%s">' % (
+                indent, BUILD_URL, file_name)
+        return '%s<script src="%s%s"></script>' % (
+            indent, BUILD_URL, file_name)
+
+    index = BUILD_BLOCK_RE.sub(replace, _read(INDEX_TEMPLATE))
+    _write(os.path.join(BUILD_DIR, 'index.html'), index)
+    return files
+
+
+def cleanBuild(files):
+    """ Records the bundles of this build and deletes those of the builds
+        before the previous one """
+    manifest_path = os.path.join(BUILD_DIR, MANIFEST)
+    previous = []
+    if os.path.exists(manifest_path):
+        previous = json.loads(_read(manifest_path)).get('current', [])
+    keep = set(files) | set(previous) | set(['index.html', MANIFEST])
+    for name in os.listdir(BUILD_DIR):
+        if name not in keep:
+            os.remove(os.path.join(BUILD_DIR, name))
+    _write(manifest_path, json.dumps(
+        {'current': files,
+         'previous': [name for name in previous if name not in files]},
+        indent=2, separators=(',', ': '), sort_keys=True) + u'\n')
+
+
+def updateAppYaml(path=APP_YAML):
+    """ Writes the handlers of the build between the markers of app.yaml """
+    text = _read(path)
+    start = text.find(BEGIN_MARKER)
+    end = text.find(END_MARKER)
+    if start < 0 or end < 0:
+        raise ValueError('%s has no %r ... %r section'
+                         % (path, BEGIN_MARKER, END_MARKER))
+    _write(path, text[:start] + APP_YAML_HANDLERS
+           + text[end + len(END_MARKER):])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build the fingerprinted static bundles.')
+    parser.parse_args()
+
+    if not os.path.isdir(BUILD_DIR):
+        os.makedirs(BUILD_DIR)
+    files = buildIndex()
+    cleanBuild(files)
+    updateAppYaml()
+
+    for name in files:
+        size = os.path.getsize(os.path.join(BUILD_DIR, name))
+        print('%-32s %8d bytes' % (name, size))
+
+
+if __name__ == '__main__':
+    main()
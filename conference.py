@@ -27,6 +27,9 @@ __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 """
 
+import json
+import operator
+
 from datetime import datetime
 
 from collections import Counter
@@ -34,10 +37,13 @@ from collections import Counter
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 from constants import *
@@ -49,6 +55,66 @@ from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
 
 from utils import getUserId
+from utils import minuteOfDay
+
+from idblock import IdBlock
+
+from keys import compactId
+from keys import conferenceKey
+from keys import decodeKey
+
+from batch import runBatch
+
+from localcache import ANNOUNCEMENT_CACHE
+from localcache import CONFERENCE_CACHE
+from localcache import FEATURED_SPEAKER_CACHE
+from localcache import SPEAKER_CACHE
+
+from itinerary import buildItinerary
+from itinerary import cacheItinerary
+from itinerary import cachedItinerary
+from itinerary import invalidateItinerary
+
+from listmode import fetchList
+from listmode import fetchListAsync
+
+from importprofile import uninstall as stopImportProfile
+from profiling import profiledApp
+
+from projection import projectionFor
+from projection import selectFields
+
+from ratelimit import rateLimited
+
+from tombstones import clearTombstones
+from tombstones import clearTombstonesAsync
+from tombstones import getEntity
+from tombstones import getEntityAsync
+
+from notifications import NOTIFICATION_QUEUE
+from notifications import confirmationTask
+
+from registration import registrationStateAsync
+from registration import queueRegistration
+
+from waitlist import addToWaitlist
+from waitlist import promotionTask
+from waitlist import removeFromWaitlist
+from waitlist import waitlistPositionAsync
+
+from upcoming import FEED_PAGE_SIZE
+from upcoming import feedPage
+from upcoming import refreshTask
+from upcoming import upcomingPage
+
+from recommend import MAX_RECOMMENDATIONS
+from recommend import recommendedKeys
+
+from facets import facetValues
+from facets import countFacets
+from facets import getFacetSummary
+from facets import getFilteredFacetSummary
+from facets import FACET_COUNT_LIMIT
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
@@ -56,6 +122,29 @@ MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
 MEMCACHE_SPEAKER_KEY = "FEATURED_SPEAKER"
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
+MAX_PAGE_SIZE = 100
+
+# ids for new Conferences, reserved a block at a time by each instance
+CONFERENCE_IDS = IdBlock(Conference)
+
+""" Python equivalents of the datastore filter operators, used for filters
+    that are applied in memory rather than by the datastore """
+FILTER_FUNCTIONS = {
+    '=':  operator.eq,
+    '>':  operator.gt,
+    '>=': operator.ge,
+    '<':  operator.lt,
+    '<=': operator.le,
+    '!=': operator.ne,
+}
+
+
+@ndb.tasklet
+def _enqueueAsync(queue, tasks):
+    """ Enqueues tasks as an ndb Future. add_async() returns a UserRPC,
+        which a tasklet can wait on but a tuple of Futures cannot hold. """
+    result = yield queue.add_async(tasks)
+    raise ndb.Return(result)
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -96,13 +185,11 @@ class ConferenceApi(remote.Service):
             raise endpoints.BadRequestException(
                 "Session name is required")
 
-        conf = ndb.Key(urlsafe=request.conferenceKey)
-
-        if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.conferenceKey)
+        # generate Conf Key
+        conf_key = self._conferenceKey(request.conferenceKey)
+        wsck = conf_key.urlsafe()
 
-        if conf.parent() != ndb.Key(Profile, getUserId(user)):
+        if conf_key.parent() != ndb.Key(Profile, getUserId(user)):
             raise endpoints.ForbiddenException(
                 'You must be the conference organizer to be able to create'
                 'sessions for this conference.'
@@ -112,6 +199,7 @@ class ConferenceApi(remote.Service):
         data = {field.name: getattr(request, field.name)
                 for field in request.all_fields()}
         del data['conferenceKey']
+        del data['sessionKey']
 
         # convert date from strings to Date objects
         if data['date']:
@@ -122,12 +210,8 @@ class ConferenceApi(remote.Service):
             data['startTime'] = datetime.strptime(
                 data['startTime'], "%H:%M").time()
 
-        # generate Conf Key
-        wsck = request.conferenceKey
-        conf_key = ndb.Key(urlsafe=wsck)
-
-        # get the conference entity
-        conf = conf_key.get()
+        # get the conference entity (or its tombstone)
+        conf = getEntity(conf_key)
 
         # if not found, raise an error and abort
         if not conf:
@@ -144,6 +228,7 @@ class ConferenceApi(remote.Service):
         # create Session & save to Datastore
         sess = Session(**data)
         sess.put()
+        clearTombstones(s_key)
 
         """ add a task to the background queue that will determine if the
             Speaker for this Session should be the Featured Speaker.
@@ -163,13 +248,23 @@ class ConferenceApi(remote.Service):
             Provide the websafe ConferenceKey for the Conference to retrieve
             sessions for as the parameter to the request.
         """
-        wsck = request.conferenceKey
-        conf_key = ndb.Key(urlsafe=wsck)
-        confSessions = Session.query(ancestor=conf_key)
-        return SessionForms(
-            items=[self._copySessionToForm(sess)
+        return self._getConferenceSessionsAsync(request).get_result()
+
+    @ndb.tasklet
+    def _getConferenceSessionsAsync (self, request):
+        """ Asynchronous variant of getConferenceSessions (also run by the
+            batch endpoint, see batch.py) """
+        conf_key = self._conferenceKey(request.conferenceKey)
+        fields = self._selectFields(SessionForm, request.fields)
+        projection = projectionFor(
+            Session, fields, LIST_PROJECTIONS['getConferenceSessions'])
+        confSessions = yield fetchListAsync(Session.query(ancestor=conf_key),
+                                            'getConferenceSessions',
+                                            projection)
+        raise ndb.Return(SessionForms(
+            items=[self._copySessionToForm(sess, fields)
                    for sess in confSessions]
-        )
+        ))
 
     @endpoints.method(SESSION_BY_TYPE_POST_REQUEST, SessionForms,
                       path='session/{conferenceKey}/{typeOfSession}',
@@ -182,11 +277,11 @@ class ConferenceApi(remote.Service):
 
         """ first, build the key to the conference based  on the websafe key
             that was in the request """
-        c_key = ndb.Key(urlsafe=request.conferenceKey)
+        c_key = self._conferenceKey(request.conferenceKey)
 
         """ retrieve the conference. If not found, raise an
             exception and quit """
-        if not c_key.get():
+        if not getEntity(c_key):
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.conferenceKey)
 
@@ -205,10 +300,13 @@ class ConferenceApi(remote.Service):
         container. This method is called multiple times for queries that return
         multiple sessions. The calling method is responsible for aggregating
         the individual Sessions this method returns into a SessonForms (plural)
-        response object """
-    def _copySessionToForm (self, sess):
+        response object. If a set of fields is given, only those are copied
+        (the Session may be the result of a projection query) """
+    def _copySessionToForm (self, sess, fields=None):
         sf = SessionForm()
         for field in sf.all_fields():
+            if fields is not None and field.name not in fields:
+                continue
             if hasattr(sess, field.name):
                 # convert Date to date string; just copy others
                 if field.name.endswith('date'):
@@ -231,23 +329,34 @@ class ConferenceApi(remote.Service):
         """ Returns all Sessions that a particular Speaker is speaking at.
             Provide the websafe key for the Speaker in the request parameter.
         """
-        sessions = Session.query(Session.speakerKey == request.speakerKey)
+        return self._getSessionsBySpeakerAsync(request).get_result()
 
-        return SessionForms(
+    @ndb.tasklet
+    def _getSessionsBySpeakerAsync (self, request):
+        """ Asynchronous variant of getSessionsBySpeaker (also run by the
+            batch endpoint, see batch.py) """
+        sessions = yield fetchListAsync(
+            Session.query(Session.speakerKey == request.speaker),
+            'getSessionsBySpeaker')
+
+        raise ndb.Return(SessionForms(
             items=[self._copySessionToForm(sess) for sess in sessions]
-        )
+        ))
 
     @endpoints.method(SessionQueryForms, SessionForms,
                       path='querySessions', http_method='POST',
                       name='querySessions')
+    @rateLimited
     def querySessions (self, request):
         """ Returns all Sessions that match the filters specified in the
             SessionQueryForms POST body. See source code for details on
-            how to construct and use the filters. """
+            how to construct and use the filters. The optional 'fields'
+            list limits the fields returned for each Session. """
+        fields = self._selectFields(SessionForm, request.fields)
         sessions = self._sessionQueryFactory(request)
 
         return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in sessions]
+            items=[self._copySessionToForm(sess, fields) for sess in sessions]
         )
 
     @endpoints.method(WISHLIST_REQUEST, BooleanMessage,
@@ -271,8 +380,8 @@ class ConferenceApi(remote.Service):
         # get the key for the session that will be added to the wishlist
         wssk = request.sessionKey
 
-        # retrieve the session from Datastore
-        sess = ndb.Key(urlsafe=wssk).get()
+        # retrieve the session from Datastore (or its tombstone)
+        sess = getEntity(decodeKey(wssk))
 
         """ if we get no results on the session query, throw an exception.
             Otherwise, check to see if the session is already in the wish-
@@ -291,6 +400,7 @@ class ConferenceApi(remote.Service):
 
         # Save the profile back to Datastore
         prof.put()
+        invalidateItinerary(prof.key.id())
 
         return BooleanMessage(data=result)
 
@@ -314,7 +424,7 @@ class ConferenceApi(remote.Service):
         """ Now use the websafe key in the request to find and load the
             session the user wants to remove """
         wssk = request.sessionKey
-        sess = ndb.Key(urlsafe=wssk).get()
+        sess = decodeKey(wssk).get()
 
         """ If the session was not found, or if the session was not in the
             user's wishlist already, return an error """
@@ -322,7 +432,7 @@ class ConferenceApi(remote.Service):
             raise endpoints.NotFoundException(
                 'No Session found with key: %s' % wssk)
         if wssk in prof.sessionKeysWishList:
-            prof.sessionKeysWishlist.remove(wssk)
+            prof.sessionKeysWishList.remove(wssk)
             result = True
         else:
             result = False
@@ -330,8 +440,72 @@ class ConferenceApi(remote.Service):
         """ If we get to this point, all is good. Now safe the updated
             profile """
         prof.put()
+        invalidateItinerary(prof.key.id())
         return BooleanMessage(data=result)
 
+    @endpoints.method(WishlistUpdateForm, WishlistForm,
+                      path='wishlist/bulk', http_method='POST',
+                      name='updateWishlist')
+    def updateWishlist (self, request):
+        """ Adds the Sessions of 'add' to and removes those of 'remove' from
+            the current user's wishlist, with a single write of their
+            Profile. Sessions already in (or not in) the wishlist are
+            skipped, a Session in both lists is removed, and every Session
+            added must exist. Returns the new wishlist. """
+        prof = self._getProfileFromUser()
+
+        add = self._sessionKeys(request.add)
+        remove = set(self._sessionKeys(request.remove))
+        missing = [key for key, sess in zip(add, ndb.get_multi(add))
+                   if not sess]
+        if missing:
+            raise endpoints.NotFoundException(
+                'No Session found with key: %s' % ', '.join(
+                    key.urlsafe() for key in missing))
+
+        prof, added, removed = self._updateWishlist(
+            prof.key, [key.urlsafe() for key in add],
+            set(key.urlsafe() for key in remove))
+        invalidateItinerary(prof.key.id())
+        return WishlistForm(sessionKeys=prof.sessionKeysWishList,
+                            added=added, removed=removed)
+
+    def _sessionKeys (self, websafe_keys):
+        """ Returns the Session keys of a list of websafe keys, in order and
+            without duplicates. Raises BadRequestException for a key that
+            is not a Session's. """
+        keys = []
+        seen = set()
+        for wssk in websafe_keys:
+            try:
+                key = decodeKey(wssk)
+            except Exception:
+                key = None
+            if not key or key.kind() != 'Session':
+                raise endpoints.BadRequestException(
+                    'Not a Session key: %s' % wssk)
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+        return keys
+
+    @ndb.transactional()
+    def _updateWishlist (self, p_key, add, remove):
+        """ Applies a wishlist update to the Profile and stores it (once, if
+            anything changed). Returns the Profile with the numbers of
+            Sessions added and removed. """
+        prof = p_key.get()
+        wishlist = prof.sessionKeysWishList
+        present = set(wishlist)
+        kept = [wssk for wssk in wishlist if wssk not in remove]
+        new = [wssk for wssk in add
+               if wssk not in present and wssk not in remove]
+        removed = len(wishlist) - len(kept)
+        if new or removed:
+            prof.sessionKeysWishList = kept + new
+            prof.put()
+        return prof, len(new), removed
+
     @endpoints.method(message_types.VoidMessage, SessionForms,
                       http_method='POST', name='getSessionsInWishlist')
     def getSessionsInWishlist (self, request):
@@ -347,30 +521,124 @@ class ConferenceApi(remote.Service):
 
         # return the collection of sessions
         return SessionForms(
-            items=[self._copySessionToForm(ndb.Key(urlsafe=session).get())
+            items=[self._copySessionToForm(decodeKey(session).get())
                    for session in sessions]
         )
 
+    @endpoints.method(message_types.VoidMessage, ItineraryForm,
+                      path='wishlist/itinerary', http_method='GET',
+                      name='getItinerary')
+    def getItinerary (self, request):
+        """ Returns the current user's wishlist of Sessions in date and
+            start time order, with the groups of Sessions whose times
+            overlap (see itinerary.py). """
+        prof = self._getProfileFromUser()
+        user_id = prof.key.id()
+
+        cached = cachedItinerary(user_id)
+        if cached is not None:
+            return protojson.decode_message(ItineraryForm, cached)
+
+        sessions = [sess for sess in ndb.get_multi(
+            [decodeKey(wssk) for wssk in prof.sessionKeysWishList])
+            if sess]
+        ordered, groups = buildItinerary(sessions)
+        itinerary = ItineraryForm(
+            sessions=[self._copySessionToForm(sess) for sess in ordered],
+            overlaps=[OverlapGroupForm(
+                sessionKeys=[sess.key.urlsafe() for sess in group])
+                for group in groups])
+        cacheItinerary(user_id, protojson.encode_message(itinerary))
+        return itinerary
+
     def _sessionQueryFactory (self, request):
-        # Return formatted session query from the submitted filters
+        """ Return the Sessions matching the submitted filters as a list,
+            ordered by the inequality field (if any) and then by name. As
+            for Conferences (see _getQuery), the datastore only gets the
+            equality filters, served as a merge join over the built-in
+            indexes (or the inequality filter when it is the only one); any
+            other filter and the ordering are applied in memory, so that no
+            composite index is needed. """
         q = Session.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
-
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Session.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Session.name)
+        inequality_filter, filters = self._formatFilters(
+            request.filters, SESSION_FIELDS)
 
+        """ startTime is matched through the startMinute integer (a string
+            or int() value can never equal a stored time), and dates are
+            converted from strings to Date objects """
         for filtr in filters:
-            if filtr["field"] in ["duration", "startTime"]:
+            if filtr["field"] == "duration":
                 filtr["value"] = int(filtr["value"])
+            elif filtr["field"] == "startTime":
+                filtr["field"] = "startMinute"
+                filtr["value"] = minuteOfDay(filtr["value"])
+            elif filtr["field"] == "date":
+                filtr["value"] = datetime.strptime(
+                    filtr["value"][:10], "%Y-%m-%d").date()
+        if inequality_filter == "startTime":
+            inequality_filter = "startMinute"
+
+        equalities = [f for f in filters if f["operator"] == "="]
+        residual = [f for f in filters if f["operator"] != "="]
+        if not equalities:
+            equalities, residual = residual, []
+
+        for filtr in equalities:
             formatted_query = ndb.query.FilterNode(filtr["field"],
                                                    filtr["operator"],
                                                    filtr["value"])
             q = q.filter(formatted_query)
-        return q
+
+        sessions = [sess for sess in q
+                    if all(self._matchesFilter(sess, filtr)
+                           for filtr in residual)]
+        if not inequality_filter:
+            return sorted(sessions, key=lambda sess: sess.sessionName)
+        return sorted(sessions, key=lambda sess: (
+            getattr(sess, inequality_filter), sess.sessionName))
+
+    @endpoints.method(SESSION_WINDOW_REQUEST, SessionForms,
+                      path='sessionsInWindow', http_method='GET',
+                      name='getSessionsInWindow')
+    def getSessionsInWindow (self, request):
+        """ Returns the Sessions (across all Conferences) held on a given
+            date ('YYYY-MM-DD') that start at or after startTime and before
+            endTime ('HH:MM', 24 hour format), ordered by start time.
+            Results are paged: pass the returned nextPageToken as pageToken
+            to get the next pageSize Sessions. """
+        try:
+            day = datetime.strptime(request.date[:10], "%Y-%m-%d").date()
+            start = minuteOfDay(request.startTime)
+            end = minuteOfDay(request.endTime)
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "Use 'YYYY-MM-DD' for the date and 'HH:MM' for the times")
+
+        """ Date and start time are combined in startSortKey, so the window
+            is a single range scan over its (built-in) index. Only keys are
+            read by the query; the Sessions are then fetched by key, which
+            the ndb cache can serve. """
+        base = day.toordinal() * 1440
+        q = Session.query(Session.startSortKey >= base + start,
+                          Session.startSortKey < base + end).order(
+            Session.startSortKey)
+        page_size = min(max(request.pageSize or 1, 1),
+                        MAX_PAGE_SIZE)
+        try:
+            cursor = Cursor(urlsafe=request.pageToken) \
+                if request.pageToken else None
+            keys, next_cursor, more = q.fetch_page(
+                page_size, start_cursor=cursor, keys_only=True)
+        except (datastore_errors.BadValueError,
+                datastore_errors.BadRequestError):
+            raise endpoints.BadRequestException(
+                'Invalid pageToken: %s' % request.pageToken)
+
+        return SessionForms(
+            items=[self._copySessionToForm(sess)
+                   for sess in ndb.get_multi(keys) if sess],
+            nextPageToken=next_cursor.urlsafe() if more else None
+        )
 
     """
         The following method satisfies:
@@ -396,8 +664,9 @@ class ConferenceApi(remote.Service):
             'lecture,' etc.) and the startTime field should contain a
             properly formatted Time string ('HH:MM' in 24 hour format).
         """
-        """ startTime is stored as a string and is in 24-hour HH:MM format
-            so a less-than search will yield the correct results.
+        """ startTime is matched through startMinute (minutes since
+            midnight), which the (typeOfSession, startMinute) index serves
+            as a single range scan.
             For this to work, a query with a subsequent filter is needed.
             First, all sessions (regardless of which conference they are part
             of) will be queried to find the subset of sessions that match the
@@ -411,8 +680,7 @@ class ConferenceApi(remote.Service):
             the request and sort it by typeOfSession """
         matchingSessions = Session.query(
             Session.typeOfSession == request.typeOfSession).filter(
-            Session.startTime < datetime.strptime(
-                request.startTime, "%H:%M").time()
+            Session.startMinute < minuteOfDay(request.startTime)
         )
 
         """ Now copy the matching sessions into the SessionForms and return
@@ -440,6 +708,7 @@ class ConferenceApi(remote.Service):
                       path='queryProblem',
                       http_method='POST',
                       name='queryProblem')
+    @rateLimited
     def queryProblem (self, request):
         """ Returns all Sessions (across all Conferences) that do NOT match
             the specified typeOfSession and that DO occur strictly before
@@ -452,28 +721,18 @@ class ConferenceApi(remote.Service):
             startTime is a string in proper Time format (HH:MM) specified
             using 24 hour time. """
 
-        """ First, start by getting all of the sessions that do NOT match
-            the type specified in the query. Then, iterate over the results
-            and build a new list that contains only those sessions that start
-            before the specified time.
-
-            First build a query for all sessions that do not match the session
-            type in the request """
-        sessionsByType = Session.query(
-            Session.typeOfSession != request.typeOfSession)
-
-        """ Using the sessions that were retrieved by the query above, set up
-            a new list to contain only those sessions that start before the
-            specified startTime and then iterate over the query results,
-            appending only those sessions that start before the time specified
-            in the request """
-        matchingSessions = []
-        for sess in sessionsByType:
-            """ make sure that there is a valid startTime and that the
-                starTime is less than the specified time """
-            if sess.startTime and (sess.startTime < datetime.strptime(
-                    request.startTime, "%H:%M").time()):
-                matchingSessions.append(sess)
+        """ Datastore allows an inequality on only one property, so one
+            of the two conditions has to be applied in memory. The time
+            condition is a range scan over the built-in startMinute index,
+            which reads only the sessions before the time instead of every
+            session of another type; the type is then excluded in memory.
+            Sessions without a startTime have no startMinute and are never
+            returned by the range scan. """
+        sessionsBefore = Session.query(
+            Session.startMinute < minuteOfDay(request.startTime))
+
+        matchingSessions = [sess for sess in sessionsBefore
+                            if sess.typeOfSession != request.typeOfSession]
 
         """ Now copy the matching sessions into the SessionForms and return
             them """
@@ -525,12 +784,15 @@ class ConferenceApi(remote.Service):
 
         # Save the speaker to Datastore
         sp.put()
+        SPEAKER_CACHE.invalidate()
         return self._copySpeakerToForm(sp)
 
-    def _copySpeakerToForm (self, speaker):
-        # Copy relevant fields from Speaker to SpeakerForm
+    def _copySpeakerToForm (self, speaker, fields=None):
+        # Copy relevant (or only the given) fields from Speaker to SpeakerForm
         sf = SpeakerForm()
         for field in sf.all_fields():
+            if fields is not None and field.name not in fields:
+                continue
             if hasattr(speaker, field.name):
                 setattr(sf, field.name, getattr(speaker, field.name))
             elif field.name == "websafeKey":
@@ -557,12 +819,22 @@ class ConferenceApi(remote.Service):
             Speaker is chosen from the Speakers in the tie.\n
 
              See _setFeaturedSpeaker() in the source code for more details."""
-        featuredSpeakerMessage = memcache.get(
-            MEMCACHE_SPEAKER_KEY + request.conf_key)
-        return FeaturedSpeakerData(
+        return self._getFeaturedSpeakerAsync(request).get_result()
+
+    @ndb.tasklet
+    def _getFeaturedSpeakerAsync (self, request):
+        """ Asynchronous variant of getFeaturedSpeaker (also run by the
+            batch endpoint, see batch.py) """
+        featuredSpeakerMessage = yield FEATURED_SPEAKER_CACHE.getAsync(
+            request.conf_key,
+            lambda: ndb.get_context().memcache_get(
+                MEMCACHE_SPEAKER_KEY + request.conf_key))
+        if not featuredSpeakerMessage:
+            raise ndb.Return(FeaturedSpeakerData())
+        raise ndb.Return(FeaturedSpeakerData(
             speakerKey=featuredSpeakerMessage['key'],
             items=[self._copySpeakerSessionToForm(sess)
-                   for sess in featuredSpeakerMessage['sessionName']])
+                   for sess in featuredSpeakerMessage['sessionName']]))
 
 
     def _copySpeakerSessionToForm (self, sess):
@@ -572,20 +844,103 @@ class ConferenceApi(remote.Service):
         sf.check_initialized()
         return sf
 
-    @endpoints.method(message_types.VoidMessage, SpeakerForms,
+    @endpoints.method(SPEAKERS_GET_REQUEST, SpeakerForms,
                       path='speakers',
                       http_method='GET', name='getAllSpeakers')
     def getAllSpeakers (self, request):
-        """ Returns a list of all the Speakers that are in the system. """
-        speakers = Speaker.query()
-        return SpeakerForms(items=[self._copySpeakerToForm(speaker)
+        """ Returns a list of all the Speakers that are in the system.
+            The optional 'fields' parameter limits the fields returned.
+            See getSpeakerDirectory for an ordered, paged list. """
+        fields = self._selectFields(SpeakerForm, request.fields)
+        projection = projectionFor(
+            Speaker, fields, LIST_PROJECTIONS['getAllSpeakers'])
+        speakers = SPEAKER_CACHE.get(
+            ','.join(projection or ['*']),
+            lambda: fetchList(Speaker.query(), 'getAllSpeakers', projection))
+        return SpeakerForms(items=[self._copySpeakerToForm(speaker, fields)
                                    for speaker in speakers])
 
+    @endpoints.method(SPEAKER_DIRECTORY_REQUEST, SpeakerForms,
+                      path='speakers/directory',
+                      http_method='GET', name='getSpeakerDirectory')
+    def getSpeakerDirectory (self, request):
+        """ Returns the Speakers in alphabetical order, pageSize at a time.
+            With a prefix, only the Speakers whose name starts with it
+            (ignoring case and accents), e.g. to autocomplete the speaker
+            of a new Session. Pass the returned nextPageToken as pageToken
+            to get the next page. First pages are served from the speaker
+            cache, which is cleared whenever a Speaker is added. """
+        prefix = Speaker.normalizeName(request.prefix)
+        page_size = min(max(request.pageSize or 1, 1),
+                        MAX_PAGE_SIZE)
+        if request.pageToken:
+            speakers, token = self._speakerDirectoryPage(
+                prefix, page_size, request.pageToken)
+        else:
+            speakers, token = SPEAKER_CACHE.get(
+                u'directory:%d:%s' % (page_size, prefix),
+                lambda: self._speakerDirectoryPage(prefix, page_size))
+        return SpeakerForms(
+            items=[self._copySpeakerToForm(speaker) for speaker in speakers],
+            nextPageToken=token)
+
+    def _speakerDirectoryPage (self, prefix, page_size, page_token=None):
+        """ Returns a page of Speakers ordered by their normalized name and
+            starting with the (normalized) prefix, with the token of the
+            next page or None if this is the last one. The range and the
+            order are on the same property, so the built-in index serves
+            the query. """
+        q = Speaker.query()
+        if prefix:
+            q = q.filter(Speaker.sortName >= prefix,
+                         Speaker.sortName < prefix + u'\ufffd')
+        q = q.order(Speaker.sortName)
+        try:
+            cursor = Cursor(urlsafe=page_token) if page_token else None
+            keys, next_cursor, more = q.fetch_page(
+                page_size, start_cursor=cursor, keys_only=True)
+        except (datastore_errors.BadValueError,
+                datastore_errors.BadRequestError):
+            raise endpoints.BadRequestException(
+                'Invalid pageToken: %s' % page_token)
+        speakers = [speaker for speaker in ndb.get_multi(keys) if speaker]
+        return speakers, next_cursor.urlsafe() if more else None
+
+    def _selectFields (self, form, names):
+        """ Returns the set of fields of 'form' requested by a 'fields'
+            selector, or None for all fields (see projection.py). """
+        try:
+            return selectFields(form, names)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+
 # - - - Conference objects - - - - - - - - - - - - - - - - -
-    def _copyConferenceToForm (self, conf, displayName):
-        # Copy relevant fields from Conference to ConferenceForm.
+    def _conferenceKey (self, identifier):
+        """ Returns the Key of the Conference named by a websafe key or a
+            compact id (see keys.py). Raises NotFoundException if it names
+            no Conference key. """
+        try:
+            conf_key = conferenceKey(identifier)
+        except Exception:
+            conf_key = None
+        if not conf_key or conf_key.kind() != 'Conference':
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % identifier)
+        return conf_key
+
+    def _websafeConferenceKey (self, identifier):
+        """ Returns the websafe key of the Conference named by a websafe key
+            or a compact id, which is how Conferences are known within the
+            application (see _conferenceKey). """
+        return self._conferenceKey(identifier).urlsafe()
+
+    def _copyConferenceToForm (self, conf, displayName, fields=None):
+        # Copy relevant (or only the given) fields from Conference to
+        # ConferenceForm. The Conference may come from a projection query.
         cf = ConferenceForm()
         for field in cf.all_fields():
+            if fields is not None and field.name not in fields:
+                continue
             if hasattr(conf, field.name):
                 """ convert Date to date string; just copy others """
                 if field.name.endswith('Date'):
@@ -594,7 +949,10 @@ class ConferenceApi(remote.Service):
                     setattr(cf, field.name, getattr(conf, field.name))
             elif field.name == "websafeKey":
                 setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
+            elif field.name == "conferenceId":
+                setattr(cf, field.name, compactId(conf.key))
+        if displayName and (fields is None
+                            or 'organizerDisplayName' in fields):
             setattr(cf, 'organizerDisplayName', displayName)
         cf.check_initialized()
         return cf
@@ -646,33 +1004,55 @@ class ConferenceApi(remote.Service):
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
 
+        # store the Conference and run its side effects concurrently
+        return self._putConferenceAsync(request, user_id, data).get_result()
+
+    @ndb.tasklet
+    def _putConferenceAsync (self, request, user_id, data):
+        """ Store a new Conference built from 'data' and enqueue the tasks
+            that follow its creation. The id comes from the instance's
+            pre-allocated block, so the key is known up front without a
+            datastore round trip, and the tasks of both queues are enqueued
+            concurrently once the put succeeded. Returns the (modified)
+            request.
+        """
         # get Profile Key based on user ID
         p_key = ndb.Key(Profile, user_id)
 
-        """ generate a unique conference ID with the profile
-            as the ancestor """
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
-
-        # generate the conference key with the ancestor profile
+        """ take a unique conference ID from the pre-allocated block and
+            generate the conference key with the ancestor profile """
+        c_id = yield CONFERENCE_IDS.nextIdAsync()
         c_key = ndb.Key(Conference, c_id, parent=p_key)
 
         # store the key and the organizer ID in the dictionary
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
-
-        # Save the Conference to Datastore
-        Conference(**data).put()
-
-        """ Now send email to organizer confirming
-            creation of Conference & return (modified) ConferenceForm """
-        taskqueue.add(params={'email': user.email(),
-                              'conferenceInfo': repr(request)},
-                      url='/tasks/send_confirmation_email'
-                      )
-        return request
+        conf = Conference(**data)
+
+        """ Side effects of a new Conference: count it in the browse page
+            facets and queue the email to the organizer confirming creation
+            of the Conference (sent in batches, see notifications.py). """
+        facet_task = taskqueue.Task(
+            params={'c_key': c_key.urlsafe(),
+                    'old': json.dumps({}),
+                    'new': json.dumps(facetValues(conf))},
+            url='/tasks/update_conference_facets')
+
+        """ Save the Conference to Datastore, with the alias that lets it
+            be named by its id alone, then clear their tombstones and
+            enqueue the tasks; both only make sense once they are stored. """
+        alias = ConferenceAlias(id=c_id, conference=c_key)
+        yield ndb.put_multi_async([conf, alias])
+        yield (clearTombstonesAsync(c_key, alias.key),
+               _enqueueAsync(taskqueue.Queue(), [facet_task, refreshTask()]),
+               _enqueueAsync(taskqueue.Queue(NOTIFICATION_QUEUE),
+                             [confirmationTask(c_key)]))
+
+        # return (modified) ConferenceForm
+        raise ndb.Return(request)
 
     @ndb.transactional()
-    def _updateConferenceObject (self, request):
+    def _updateConferenceObject (self, request, wsck):
         # This method updates an existing conference
         user = endpoints.get_current_user()
         if not user:
@@ -680,19 +1060,21 @@ class ConferenceApi(remote.Service):
         user_id = getUserId(user)
 
         # update existing conference
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = decodeKey(wsck).get()
 
         # check that conference exists
         if not conf:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' %
-                request.websafeConferenceKey)
+                'No conference found with key: %s' % wsck)
 
         # check that user is owner
         if user_id != conf.organizerUserId:
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        # remember the facets before the update so they can be moved
+        old_facets = facetValues(conf)
+
         """ Not getting all the fields, so don't create a new object; just
             copy relevant fields from ConferenceForm to Conference object """
         for field in request.all_fields():
@@ -709,6 +1091,20 @@ class ConferenceApi(remote.Service):
 
         # save Conference to Datastore
         conf.put()
+
+        """ if any faceted field changed, update the facets once the
+            transaction commits """
+        new_facets = facetValues(conf)
+        if new_facets != old_facets:
+            taskqueue.add(params={'c_key': conf.key.urlsafe(),
+                                  'old': json.dumps(old_facets),
+                                  'new': json.dumps(new_facets)},
+                          url='/tasks/update_conference_facets',
+                          transactional=True)
+
+        # the upcoming feed may show the Conference
+        taskqueue.Queue().add(refreshTask(), transactional=True)
+
         prof = ndb.Key(Profile, user_id).get()
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
@@ -726,7 +1122,10 @@ class ConferenceApi(remote.Service):
         """ Updates an existing Conference (as identified by the
             websafeConferenceKey parameter) with the data provided in the
             request body. Returns the udpated Conference object. """
-        return self._updateConferenceObject(request)
+        conf_form = self._updateConferenceObject(
+            request, self._websafeConferenceKey(request.websafeConferenceKey))
+        CONFERENCE_CACHE.invalidate()
+        return conf_form
 
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
                       path='conference/{websafeConferenceKey}',
@@ -735,15 +1134,102 @@ class ConferenceApi(remote.Service):
         """ Returns the Conference object identified by the
             websafeConferenceKey parameter or an exception if the specified
             Conference key does not exist. """
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
+        return self._getConferenceAsync(request).get_result()
+
+    @ndb.tasklet
+    def _getConferenceAsync (self, request):
+        """ Asynchronous variant of getConference (also run by the batch
+            endpoint, see batch.py) """
+        wsck = self._websafeConferenceKey(request.websafeConferenceKey)
+
+        @ndb.tasklet
+        def load():
+            conf = yield getEntityAsync(decodeKey(wsck))
+            if not conf:
+                raise ndb.Return(None)
+            prof = yield conf.key.parent().get_async()
+            raise ndb.Return((conf, getattr(prof, 'displayName', None)))
+
+        """ The Conference and its organizer's name are kept in the
+            instance-local cache (see localcache.py). Missing Conferences
+            are not cached; their tombstones (see tombstones.py) answer. """
+        cached = yield CONFERENCE_CACHE.getAsync(wsck, load)
+        if not cached:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' %
-                request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+                'No conference found with key: %s' % wsck)
+        conf, displayName = cached
 
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        raise ndb.Return(self._copyConferenceToForm(conf, displayName))
+
+    @endpoints.method(CONF_GET_REQUEST, ConferenceDetailForm,
+                      path='conference/{websafeConferenceKey}/detail',
+                      http_method='GET', name='getConferenceDetail')
+    def getConferenceDetail (self, request):
+        """ Returns everything the Conference detail page shows in a single
+            call: the Conference with its organizer's name, its Sessions
+            and Featured Speaker and, if a user is logged in, whether they
+            attend it, their queued registration and waitlist state and
+            which of its Sessions are on their wishlist. """
+        return self._getConferenceDetailAsync(request).get_result()
+
+    def _getConferenceDetailAsync (self, request):
+        """ Asynchronous variant of getConferenceDetail, returning a Future
+            of its response (also run by the batch endpoint, see batch.py) """
+        user = endpoints.get_current_user()
+        user_id = getUserId(user) if user else None
+        return self._conferenceDetailAsync(
+            self._websafeConferenceKey(request.websafeConferenceKey),
+            user_id)
+
+    @ndb.tasklet
+    def _conferenceDetailAsync (self, wsck, user_id):
+        """ Fetches all parts of the detail page in parallel and returns
+            (as a Future) the ConferenceDetailForm. """
+        conf_key = decodeKey(wsck)
+        conf, organizer, sessions, featured, user_state = yield (
+            conf_key.get_async(),
+            conf_key.parent().get_async(),
+            fetchListAsync(Session.query(ancestor=conf_key),
+                           'getConferenceSessions'),
+            ndb.get_context().memcache_get(MEMCACHE_SPEAKER_KEY + wsck),
+            self._userConferenceStateAsync(wsck, user_id))
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+
+        detail = ConferenceDetailForm(
+            conference=self._copyConferenceToForm(
+                conf, getattr(organizer, 'displayName', None)),
+            sessions=[self._copySessionToForm(sess) for sess in sessions])
+        if featured:
+            detail.featuredSpeaker = FeaturedSpeakerData(
+                speakerKey=featured['key'],
+                items=[self._copySpeakerSessionToForm(name)
+                       for name in featured['sessionName']])
+
+        prof, state, position = user_state
+        if prof:
+            detail.isAttending = wsck in prof.conferenceKeysToAttend
+            wishlist = set(prof.sessionKeysWishList)
+            detail.sessionKeysInWishlist = [
+                sess.key.urlsafe() for sess in sessions
+                if sess.key.urlsafe() in wishlist]
+            detail.registrationState = state or RegistrationState.NOT_QUEUED
+            detail.waitlistPosition = position
+        raise ndb.Return(detail)
+
+    @ndb.tasklet
+    def _userConferenceStateAsync (self, wsck, user_id):
+        """ Returns (as a Future) the Profile of a user with their queued
+            registration state and waitlist position for a Conference, or
+            (None, None, 0) when no user is logged in. """
+        if not user_id:
+            raise ndb.Return((None, None, 0))
+        state = yield (ndb.Key(Profile, user_id).get_async(),
+                       registrationStateAsync(user_id, wsck),
+                       waitlistPositionAsync(user_id, wsck))
+        raise ndb.Return(state)
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='getConferencesCreated',
@@ -767,26 +1253,75 @@ class ConferenceApi(remote.Service):
         )
 
     def _getQuery (self, request):
-        # Return formatted query from the submitted filters
+        """ Return the datastore query for the submitted filters, along
+            with the filters that must still be applied in memory and the
+            inequality field (if any) as (query, residual, inequality).
+
+            Equality filters are always sent to the datastore, which serves
+            them as a merge join over the built-in single-property indexes.
+            An inequality filter is only sent along when it is the sole
+            filter; combined with equality filters it would need a composite
+            index, so it is applied in memory instead. The query is not
+            ordered for the same reason - see _executeConferenceQuery. """
         q = Conference.query()
         inequality_filter, filters = self._formatFilters(request.filters)
 
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
-
         for filtr in filters:
             if filtr["field"] in ["month", "maxAttendees"]:
                 filtr["value"] = int(filtr["value"])
+
+        equalities = [f for f in filters if f["operator"] == "="]
+        residual = [f for f in filters if f["operator"] != "="]
+        if not equalities:
+            equalities, residual = residual, []
+
+        for filtr in equalities:
             formatted_query = ndb.query.FilterNode(
                 filtr["field"], filtr["operator"], filtr["value"])
             q = q.filter(formatted_query)
-        return q
+        return q, residual, inequality_filter
+
+    def _executeConferenceQuery (self, request, endpoint='queryConferences',
+                                 projection=None):
+        """ Run the query for the submitted filters and return the matching
+            Conferences as a list, ordered by the inequality field (if any)
+            and then by name, exactly as the datastore would have. The
+            ordering and any residual inequality filter are applied in
+            memory so that no composite index is needed. The query runs in
+            the list mode of the given endpoint (see listmode.py), or as a
+            projection on the given properties, which must then include
+            the properties filtered and sorted on. """
+        q, residual, inequality_filter = self._getQuery(request)
+
+        conferences = [conf for conf in fetchList(q, endpoint, projection)
+                       if all(self._matchesFilter(conf, filtr)
+                              for filtr in residual)]
+
+        def sort_key(conf):
+            if not inequality_filter:
+                return conf.name
+            value = getattr(conf, inequality_filter)
+            """ repeated properties sort by their smallest value, as in
+                the datastore """
+            if isinstance(value, list):
+                value = min(value) if value else None
+            return (value, conf.name)
+
+        return sorted(conferences, key=sort_key)
 
-    def _formatFilters (self, filters):
+    @staticmethod
+    def _matchesFilter (conf, filtr):
+        """ Apply a single formatted filter to a Conference (or Session) in
+            memory. As with the datastore, a repeated property matches when
+            any one of its values does. """
+        values = getattr(conf, filtr["field"])
+        if not isinstance(values, list):
+            values = [values]
+        compare = FILTER_FUNCTIONS[filtr["operator"]]
+        return any(value is not None and compare(value, filtr["value"])
+                   for value in values)
+
+    def _formatFilters (self, filters, fields=FIELDS):
         # Parse, check validity and format user supplied filters
         formatted_filters = []
         inequality_field = None
@@ -799,7 +1334,7 @@ class ConferenceApi(remote.Service):
                      for field in f.all_fields()}
 
             try:
-                filtr["field"] = FIELDS[filtr["field"]]
+                filtr["field"] = fields[filtr["field"]]
                 filtr["operator"] = OPERATORS[filtr["operator"]]
             except KeyError:
                 raise endpoints.BadRequestException(
@@ -824,30 +1359,139 @@ class ConferenceApi(remote.Service):
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
                       path='queryConferences', http_method='POST',
                       name='queryConferences')
+    @rateLimited
     def queryConferences (self, request):
         """ Returns a list of Conferences that satisfy the query specifications
             provided by the request body. See the source code for specifics
-            on how to specify the query terms. """
-        conferences = self._getQuery(request)
+            on how to specify the query terms. The optional 'fields' list
+            limits the fields returned for each Conference; the browse
+            list asks only for the ones it shows. """
+        fields = self._selectFields(ConferenceForm, request.fields)
+
+        """ Projections are only backed by indexes for the unfiltered
+            query (see LIST_PROJECTIONS in constants.py). The seats are
+            not in the projection index, so asking for them runs the
+            regular query. """
+        projection = None
+        if not request.filters:
+            projection = projectionFor(
+                Conference, fields, LIST_PROJECTIONS['queryConferences'])
+        conferences = self._executeConferenceQuery(
+            request, projection=projection)
 
         """ need to fetch organiser displayName from profiles.
-            Get all keys and use get_multi for speed """
-        organisers = [(ndb.Key(Profile, conf.organizerUserId))
-                      for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
+            Get all keys and use get_multi for speed. The organiser is the
+            parent of the Conference, which is also known for projected
+            Conferences. """
         names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        if fields is None or 'organizerDisplayName' in fields:
+            organisers = [conf.key.parent() for conf in conferences]
+            profiles = ndb.get_multi(organisers)
+
+            # put display names in a dict for easier fetching
+            for profile in profiles:
+                names[profile.key.id()] = profile.displayName
 
         # copy conference objects to form that can return multiple confs
         return ConferenceForms(
             items=[self._copyConferenceToForm(
-                conf, names[conf.organizerUserId])
+                conf, names.get(conf.key.parent().id()), fields)
                    for conf in conferences]
         )
 
+    @endpoints.method(UPCOMING_REQUEST, ConferenceForms,
+                      path='conferences/upcoming', http_method='GET',
+                      name='getUpcomingConferences')
+    def getUpcomingConferences (self, request):
+        """ Returns the Conferences that start today or later, ordered by
+            start date, a page at a time. fromDate and toDate ('YYYY-MM-DD')
+            limit the range of start dates. Pass the returned nextPageToken
+            as pageToken to get the next page. The first pages of the feed
+            without a range are served from Memcache (see upcoming.py). """
+        try:
+            from_date = datetime.strptime(request.fromDate[:10],
+                "%Y-%m-%d").date() if request.fromDate else None
+            to_date = datetime.strptime(request.toDate[:10],
+                "%Y-%m-%d").date() if request.toDate else None
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "Use 'YYYY-MM-DD' for fromDate and toDate")
+        page_size = min(max(request.pageSize or FEED_PAGE_SIZE, 1),
+                        MAX_PAGE_SIZE)
+
+        try:
+            if from_date or to_date or page_size != FEED_PAGE_SIZE:
+                conferences, token = upcomingPage(
+                    page_size, request.pageToken, from_date, to_date)
+            else:
+                conferences, token = feedPage(request.pageToken)
+        except (datastore_errors.BadValueError,
+                datastore_errors.BadRequestError):
+            raise endpoints.BadRequestException(
+                'Invalid pageToken: %s' % request.pageToken)
+
+        return ConferenceForms(
+            items=[self._copyConferenceToForm(conf, displayName)
+                   for conf, displayName in conferences],
+            nextPageToken=token)
+
+    @endpoints.method(RECOMMENDED_REQUEST, ConferenceForms,
+                      path='conferences/recommended', http_method='GET',
+                      name='getRecommendedConferences')
+    def getRecommendedConferences (self, request):
+        """ Returns up to 'limit' upcoming Conferences recommended to the
+            user, best first, from the topics, cities and months of the
+            Conferences they attend or have Sessions of in their wishlist
+            (see recommend.py). Nothing is recommended without either. """
+        prof = self._getProfileFromUser()
+        limit = min(max(request.limit or 10, 1), MAX_RECOMMENDATIONS)
+        keys = [decodeKey(wsck) for wsck in recommendedKeys(prof)[:limit]]
+        conferences = [conf for conf in ndb.get_multi(keys) if conf]
+        profiles = ndb.get_multi(
+            set(conf.key.parent() for conf in conferences))
+        names = dict((p.key, p.displayName) for p in profiles if p)
+        return ConferenceForms(
+            items=[self._copyConferenceToForm(
+                conf, names.get(conf.key.parent())) for conf in conferences])
+
+    @endpoints.method(ConferenceQueryForms, FacetCountForms,
+                      path='getConferenceFacets', http_method='POST',
+                      name='getConferenceFacets')
+    def getConferenceFacets (self, request):
+        """ Returns the number of Conferences for each value of the city,
+            topics and month fields. The request body takes the same filters
+            as queryConferences; when filters are given, only Conferences
+            matching them are counted. A count of filtered Conferences
+            stops at FACET_COUNT_LIMIT, and says so with capped. """
+        limit = None
+        if not request.filters:
+            summary = getFacetSummary()
+        else:
+            inequality_filter, filters = self._formatFilters(request.filters)
+
+            """ Equality filters on faceted fields are answered by count
+                queries per facet value (see facets.py). Anything else
+                needs a run of the regular query, whose Conferences are
+                then counted. """
+            if not inequality_filter and all(
+                    filtr["field"] in FACET_FIELDS for filtr in filters):
+                summary = getFilteredFacetSummary(
+                    [(filtr["field"], filtr["value"]) for filtr in filters])
+                limit = FACET_COUNT_LIMIT
+            else:
+                summary = countFacets(self._executeConferenceQuery(
+                    request, 'getConferenceFacets'))
+
+        items = []
+        for field in FACET_FIELDS:
+            for value in sorted(summary[field]):
+                count = summary[field][value]
+                capped = limit is not None and count > limit
+                items.append(FacetCountForm(field=field, value=value,
+                                            count=limit if capped else count,
+                                            capped=capped))
+        return FacetCountForms(items=items)
+
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
     def _copyProfileToForm (self, prof):
@@ -877,8 +1521,14 @@ class ConferenceApi(remote.Service):
 
         # get the user's Profile based on their user ID
         user_id = getUserId(user)
+        return self._profileOfUserAsync(user, user_id).get_result()
+
+    @ndb.tasklet
+    def _profileOfUserAsync (self, user, user_id):
+        """ Returns (as a Future) the Profile of a logged-in user, creating
+            it if non-existent """
         p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
+        profile = yield p_key.get_async()
 
         # create new Profile if one was not retrieved by the above query
         if not profile:
@@ -888,10 +1538,10 @@ class ConferenceApi(remote.Service):
                 mainEmail=user.email(),
                 teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put()
+            yield profile.put_async()
 
         # return the profile fully populated
-        return profile
+        raise ndb.Return(profile)
 
     def _doProfile (self, save_request=None):
         """ Get user Profile and return to user, possibly updating it first.
@@ -916,7 +1566,17 @@ class ConferenceApi(remote.Service):
                       path='profile', http_method='GET', name='getProfile')
     def getProfile (self, request):
         """ Returns the Profile of the current user. """
-        return self._doProfile()
+        return self._getProfileAsync(request).get_result()
+
+    @ndb.tasklet
+    def _getProfileAsync (self, request):
+        """ Asynchronous variant of getProfile (also run by the batch
+            endpoint, see batch.py) """
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        prof = yield self._profileOfUserAsync(user, getUserId(user))
+        raise ndb.Return(self._copyProfileToForm(prof))
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
                       path='profile', http_method='POST', name='saveProfile')
@@ -949,6 +1609,9 @@ class ConferenceApi(remote.Service):
             announcement = ""
             memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
 
+        # drop the copies held by the instances
+        ANNOUNCEMENT_CACHE.invalidate()
+
         return announcement
 
     @staticmethod
@@ -966,7 +1629,7 @@ class ConferenceApi(remote.Service):
         """
 
         # Create a key based on the c_key parameter passed in.
-        c_key = ndb.Key(urlsafe=request.get('c_key'))
+        c_key = decodeKey(request.get('c_key'))
 
         # Limit the projection to minimize data transfer - only need 2 fields.
         qo = ndb.QueryOptions(projection=['speakerKey', 'sessionName'])
@@ -1066,6 +1729,9 @@ class ConferenceApi(remote.Service):
         else:
             # No featured speakers in the system, so clear the MemCache
             memcache.delete(MEMCACHE_SPEAKER_KEY + c_key.urlsafe())
+
+        # drop the copies held by the instances
+        FEATURED_SPEAKER_CACHE.invalidate()
         return
 
     @endpoints.method(
@@ -1073,15 +1739,17 @@ class ConferenceApi(remote.Service):
         path='conference/announcement/get', http_method='GET',
         name='getAnnouncement')
     def getAnnouncement (self, request):
-            """ Return any current Announcement from Memcache. If there is
-                no Announcement present, return an empty string. """
-            return StringMessage(data=memcache.get(
-                MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+            """ Return any current Announcement from the instance-local
+                cache or Memcache. If there is no Announcement present,
+                return an empty string. """
+            return StringMessage(data=ANNOUNCEMENT_CACHE.get(
+                MEMCACHE_ANNOUNCEMENTS_KEY,
+                lambda: memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)) or "")
 
     # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
     @ndb.transactional(xg=True)
-    def _conferenceRegistration (self, request, reg=True):
+    def _conferenceRegistration (self, wsck, reg=True):
         """ Register or unregister user for selected Conference. Will throw
             an exception if the specified Conference does not exist. Will
             also throw an exception if the user is trying to register for a
@@ -1096,8 +1764,7 @@ class ConferenceApi(remote.Service):
 
         """ check if conf exists with provided websafeConfKey and throw
             an exception if the conference is not in Datastore """
-        wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
+        conf = decodeKey(wsck).get()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
@@ -1112,7 +1779,8 @@ class ConferenceApi(remote.Service):
             # check if seats avail and raise exception if none left
             if conf.seatsAvailable <= 0:
                 raise ConflictException(
-                    "There are no seats available.")
+                    "There are no seats available. Use joinWaitlist to "
+                    "be registered when a seat becomes available.")
 
             # register user, take away one seat
             prof.conferenceKeysToAttend.append(wsck)
@@ -1127,6 +1795,10 @@ class ConferenceApi(remote.Service):
                 prof.conferenceKeysToAttend.remove(wsck)
                 conf.seatsAvailable += 1
                 retval = True
+
+                # offer the seat to the waitlist once this commits
+                taskqueue.Queue().add(promotionTask(wsck),
+                                      transactional=True)
             else:
                 retval = False
 
@@ -1135,24 +1807,136 @@ class ConferenceApi(remote.Service):
         conf.put()
         return BooleanMessage(data=retval)
 
+    @endpoints.method(CONF_GET_REQUEST, RegistrationStatusForm,
+                      path='conference/{websafeConferenceKey}/queue',
+                      http_method='POST',
+                      name='queueRegistrationForConference')
+    @rateLimited
+    def queueRegistrationForConference (self, request):
+        """ Queued alternative to registerForConference for Conferences
+            that many users register for at once. The request is queued
+            and granted in a batch with others; poll getRegistrationStatus
+            until its state is no longer PENDING. """
+        prof = self._getProfileFromUser()
+        wsck = self._websafeConferenceKey(request.websafeConferenceKey)
+        if not decodeKey(wsck).get():
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+
+        # no need to queue a user that is already registered
+        if wsck in prof.conferenceKeysToAttend:
+            state = RegistrationState.ALREADY_REGISTERED
+        else:
+            queueRegistration(prof.key.id(), wsck)
+            state = RegistrationState.PENDING
+        return RegistrationStatusForm(websafeConferenceKey=wsck, state=state)
+
+    @endpoints.method(CONF_GET_REQUEST, RegistrationStatusForm,
+                      path='conference/{websafeConferenceKey}/queue',
+                      http_method='GET', name='getRegistrationStatus')
+    def getRegistrationStatus (self, request):
+        """ Returns the state of the current user's queued registration
+            for the Conference. Only reads a single small entity, so it is
+            cheap to poll. """
+        return self._getRegistrationStatusAsync(request).get_result()
+
+    @ndb.tasklet
+    def _getRegistrationStatusAsync (self, request):
+        """ Asynchronous variant of getRegistrationStatus (also run by the
+            batch endpoint, see batch.py) """
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        wsck = self._websafeConferenceKey(request.websafeConferenceKey)
+        state = yield registrationStateAsync(getUserId(user), wsck)
+        raise ndb.Return(RegistrationStatusForm(
+            websafeConferenceKey=wsck,
+            state=state or RegistrationState.NOT_QUEUED))
+
+    @endpoints.method(CONF_GET_REQUEST, WaitlistForm,
+                      path='conference/{websafeConferenceKey}/waitlist',
+                      http_method='POST', name='joinWaitlist')
+    def joinWaitlist (self, request):
+        """ Puts the current user on the waitlist of a sold out Conference.
+            Users on the waitlist are registered, oldest first, as seats
+            become available, and are notified by email. Returns the
+            user's position on the waitlist. """
+        prof = self._getProfileFromUser()
+        wsck = self._websafeConferenceKey(request.websafeConferenceKey)
+        conf = decodeKey(wsck).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        if wsck in prof.conferenceKeysToAttend:
+            raise ConflictException(
+                "You have already registered for this conference")
+        if conf.seatsAvailable > 0:
+            raise ConflictException(
+                "There are seats available; register for the conference")
+
+        return WaitlistForm(websafeConferenceKey=wsck,
+                            position=addToWaitlist(prof.key.id(), wsck))
+
+    @endpoints.method(CONF_GET_REQUEST, WaitlistForm,
+                      path='conference/{websafeConferenceKey}/waitlist',
+                      http_method='GET', name='getWaitlistPosition')
+    def getWaitlistPosition (self, request):
+        """ Returns the current user's position on the waitlist of a
+            Conference (0 if not on the waitlist). Served from a cached
+            index, so polling it does not load the registration path. """
+        return self._getWaitlistPositionAsync(request).get_result()
+
+    @ndb.tasklet
+    def _getWaitlistPositionAsync (self, request):
+        """ Asynchronous variant of getWaitlistPosition (also run by the
+            batch endpoint, see batch.py) """
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        wsck = self._websafeConferenceKey(request.websafeConferenceKey)
+        position = yield waitlistPositionAsync(getUserId(user), wsck)
+        raise ndb.Return(WaitlistForm(websafeConferenceKey=wsck,
+                                      position=position))
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+                      path='conference/{websafeConferenceKey}/waitlist',
+                      http_method='DELETE', name='leaveWaitlist')
+    def leaveWaitlist (self, request):
+        """ Takes the current user off the waitlist of a Conference.
+            Returns false if the user was not on the waitlist. """
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        return BooleanMessage(data=removeFromWaitlist(
+            getUserId(user),
+            self._websafeConferenceKey(request.websafeConferenceKey)))
+
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='conferences/attending',
                       http_method='GET', name='getConferencesToAttend')
     def getConferencesToAttend (self, request):
         """ Return list of Conferences the current user is registered for. """
+        return self._getConferencesToAttendAsync(request).get_result()
+
+    @ndb.tasklet
+    def _getConferencesToAttendAsync (self, request):
+        """ Asynchronous variant of getConferencesToAttend (also run by the
+            batch endpoint, see batch.py) """
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
 
         """ First, get user's profile and then use that to build a query for
             all descendant conferences (which represent the conferences the
             user has registered for) """
-        prof = self._getProfileFromUser()
-        conf_keys = [ndb.Key(urlsafe=wsck)
-                     for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
+        prof = yield self._profileOfUserAsync(user, getUserId(user))
+        conf_keys = [decodeKey(wsck) for wsck in prof.conferenceKeysToAttend]
+        conferences = yield ndb.get_multi_async(conf_keys)
 
         # get organizers of the above conferences
         organisers = [ndb.Key(Profile, conf.organizerUserId)
                       for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        profiles = yield ndb.get_multi_async(organisers)
 
         # put display names in a dict for easier fetching
         names = {}
@@ -1160,29 +1944,47 @@ class ConferenceApi(remote.Service):
             names[profile.key.id()] = profile.displayName
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(
+        raise ndb.Return(ConferenceForms(items=[self._copyConferenceToForm(
             conf, names[conf.organizerUserId])
-                                      for conf in conferences])
+                                                for conf in conferences]))
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
                       http_method='POST', name='registerForConference')
+    @rateLimited
     def registerForConference (self, request):
         """ Register the current user for the Conference specified in the
             websafeConferenceKey parameter assuming there are still seats
             available for that Conference and the user isn't already registered
             for that Conference (both will throw exceptions). """
-        return self._conferenceRegistration(request)
+        wsck = self._websafeConferenceKey(request.websafeConferenceKey)
+        registered = self._conferenceRegistration(wsck)
+        CONFERENCE_CACHE.delete(wsck)
+        return registered
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
                       http_method='DELETE', name='unregisterFromConference')
+    @rateLimited
     def unregisterFromConference (self, request):
         """ Unregisters the current user from the Conference specified in the
             websafeConferenceKey parameter assuming they are presently
             registered for that Conference (throws exception if the user is
             not presently registered for that Conference). """
-        return self._conferenceRegistration(request, reg=False)
+        wsck = self._websafeConferenceKey(request.websafeConferenceKey)
+        unregistered = self._conferenceRegistration(wsck, reg=False)
+        CONFERENCE_CACHE.delete(wsck)
+        return unregistered
+
+    @endpoints.method(BatchRequestForm, BatchResponseForm,
+                      path='batch', http_method='POST', name='batch')
+    def batch (self, request):
+        """ Runs several ConferenceApi calls in one request. Each item
+            names a method and carries its request message as JSON; the
+            results come back in the same order, each with either the
+            JSON response message or the status and message of its error.
+            See batch.py for how the calls are run. """
+        return BatchResponseForm(items=runBatch(self, request.items))
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='filterPlayground',
@@ -1204,5 +2006,10 @@ class ConferenceApi(remote.Service):
             items=[self._copyConferenceToForm(conf, "") for conf in q]
         )
 
-# register API
-api = endpoints.api_server([ConferenceApi])
+# register API, profiled on demand (see profiling.py)
+api = profiledApp(endpoints.api_server([ConferenceApi]))
+
+""" The API is imported; stop timing imports (see importprofile.py). This
+    is the entry point of the /_ah/spi/ requests, which most instances load
+    first and which never import main.py. """
+stopImportProfile()
@@ -44,6 +44,35 @@ FIELDS =    {
     'MAX_ATTENDEES': 'maxAttendees',
 }
 
+""" Fields present for a session """
+SESSION_FIELDS = {
+    'NAME': 'sessionName',
+    'TYPE': 'typeOfSession',
+    'SPEAKER': 'speakerKey',
+    'DURATION': 'duration',
+    'DATE': 'date',
+    'START_TIME': 'startTime',
+}
+
+""" Projections that list endpoints may run when the requested fields
+    allow it, as tuples of properties. Every tuple is backed by an index in
+    index.yaml. See projection.py """
+LIST_PROJECTIONS = {
+    'queryConferences': [
+        ('name', 'city', 'startDate'),
+    ],
+    'getConferenceSessions': [
+        ('sessionName', 'typeOfSession', 'date', 'startTime'),
+    ],
+    'getAllSpeakers': [
+        ('displayName',),
+    ],
+}
+
+""" Conference fields that the browse page shows faceted counts for.
+    See facets.py """
+FACET_FIELDS = ('city', 'topics', 'month')
+
 """ The following list of elements each define a specific request or response
     container that is specific to a particular Model in the overall data
     scheme. A "websafe" key is a key that has been URL-encoded to preserve
@@ -63,7 +92,8 @@ CONF_POST_REQUEST = endpoints.ResourceContainer(
 SESSIONS_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     conferenceKey=messages.StringField(1),
-    sessionKey=messages.StringField(2)
+    sessionKey=messages.StringField(2),
+    fields=messages.StringField(3, repeated=True),
 )
 
 SESSIONS_POST_REQUEST = endpoints.ResourceContainer(
@@ -76,6 +106,18 @@ WISHLIST_REQUEST = endpoints.ResourceContainer(
     sessionKey=messages.StringField(1, required=True),
 )
 
+SPEAKERS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    fields=messages.StringField(1, repeated=True),
+)
+
+SPEAKER_DIRECTORY_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    prefix=messages.StringField(1),
+    pageSize=messages.IntegerField(2, default=20),
+    pageToken=messages.StringField(3),
+)
+
 SPEAKER_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     speaker=messages.StringField(1, required=True),
@@ -103,6 +145,28 @@ SESSION_BY_SPEAKER_POST_REQUEST = endpoints.ResourceContainer(
     speaker=messages.StringField(1),
 )
 
+SESSION_WINDOW_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    date=messages.StringField(1, required=True),
+    startTime=messages.StringField(2, required=True),
+    endTime=messages.StringField(3, required=True),
+    pageSize=messages.IntegerField(4, default=20),
+    pageToken=messages.StringField(5),
+)
+
+UPCOMING_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    fromDate=messages.StringField(1),
+    toDate=messages.StringField(2),
+    pageSize=messages.IntegerField(3),
+    pageToken=messages.StringField(4),
+)
+
+RECOMMENDED_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    limit=messages.IntegerField(1, default=10),
+)
+
 GET_FEATURED_SPEAKER_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     conf_key=messages.StringField(1, required=True)
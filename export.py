@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+"""
+export.py -- Udacity conference server-side Python App Engine
+    streaming bulk export of Conferences, Sessions and registrations
+
+$Id$
+
+"""
+
+"""
+    An export run writes every Conference, Session and registration (one
+    row per Profile and Conference attended) to files, as newline
+    delimited JSON or CSV. Each kind is exported by a chain of tasks: a
+    task reads one page of EXPORT_PAGE_SIZE entities in key order from
+    the kind's cursor, writes their rows to a new part file, then
+    checkpoints the cursor and the file and enqueues the next task in the
+    same transaction. A task therefore holds one page in memory at most,
+    and a failed task simply writes the same part file again.
+
+    Once every kind is done, a manifest.json listing the part files of
+    each kind (and their row counts) is written next to them:
+
+        <run id>/conferences/part-00001.ndjson
+        ...
+        <run id>/manifest.json
+
+    CSV part files all start with the header row so that each can be
+    loaded on its own.
+
+    Files go to a storage backend, chosen by EXPORT_STORAGE among
+    STORAGE_BACKENDS. A backend only needs write(path, data); the local
+    file system backend writes under EXPORT_ROOT and stands in for a
+    cloud storage bucket.
+"""
+
+import collections
+import csv
+import errno
+import json
+import os
+import StringIO
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import ExportKind
+from models import ExportRun
+from models import Profile
+from models import Session
+
+EXPORT_PAGE_SIZE = 500
+EXPORT_FORMATS = {'ndjson': 'ndjson', 'csv': 'csv'}
+EXPORT_ROOT = os.environ.get('EXPORT_ROOT', '/tmp/conference_exports')
+EXPORT_STORAGE = 'local'
+
+RUNNING = 'running'
+DONE = 'done'
+
+
+class LocalFileStorage(object):
+    """ Writes export files under a directory of the local file system """
+
+    def __init__(self, root=EXPORT_ROOT):
+        self.root = root
+
+    def write(self, path, data):
+        """ Writes (or overwrites) the file at 'path' with 'data' """
+        full_path = os.path.join(self.root, path)
+        try:
+            os.makedirs(os.path.dirname(full_path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        with open(full_path, 'wb') as f:
+            f.write(data)
+
+
+STORAGE_BACKENDS = {
+    'local': LocalFileStorage,
+}
+
+
+def exportStorage():
+    """ Returns the storage backend that export files are written to """
+    return STORAGE_BACKENDS[EXPORT_STORAGE]()
+
+
+def _value(value):
+    """ Converts a property value to a JSON-friendly one """
+    if isinstance(value, list):
+        return [_value(v) for v in value]
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def _conferenceRows(conf):
+    """ Returns the export row of a Conference """
+    return [{
+        'key': conf.key.urlsafe(),
+        'name': conf.name,
+        'description': conf.description,
+        'organizerUserId': conf.organizerUserId,
+        'topics': conf.topics,
+        'city': conf.city,
+        'startDate': conf.startDate,
+        'endDate': conf.endDate,
+        'month': conf.month,
+        'maxAttendees': conf.maxAttendees,
+        'seatsAvailable': conf.seatsAvailable,
+    }]
+
+
+def _sessionRows(sess):
+    """ Returns the export row of a Session """
+    return [{
+        'key': sess.key.urlsafe(),
+        'conferenceKey': sess.key.parent().urlsafe(),
+        'sessionName': sess.sessionName,
+        'highlights': sess.highlights,
+        'speakerKey': sess.speakerKey,
+        'duration': sess.duration,
+        'typeOfSession': sess.typeOfSession,
+        'date': sess.date,
+        'startTime': sess.startTime,
+    }]
+
+
+def _registrationRows(prof):
+    """ Returns one export row per Conference a Profile attends """
+    return [{'userId': prof.key.id(), 'conferenceKey': wsck}
+            for wsck in prof.conferenceKeysToAttend]
+
+
+Exporter = collections.namedtuple('Exporter', 'model columns rows')
+
+""" The exported kinds, by name: the model read, the columns of its rows
+    (in CSV order) and the function turning an entity into rows """
+EXPORTERS = collections.OrderedDict([
+    ('conferences', Exporter(
+        Conference,
+        ['key', 'name', 'description', 'organizerUserId', 'topics', 'city',
+         'startDate', 'endDate', 'month', 'maxAttendees', 'seatsAvailable'],
+        _conferenceRows)),
+    ('sessions', Exporter(
+        Session,
+        ['key', 'conferenceKey', 'sessionName', 'highlights', 'speakerKey',
+         'duration', 'typeOfSession', 'date', 'startTime'],
+        _sessionRows)),
+    ('registrations', Exporter(
+        Profile, ['userId', 'conferenceKey'], _registrationRows)),
+])
+
+
+def _encode(rows, columns, fmt):
+    """ Returns the contents of a part file holding 'rows' """
+    if fmt == 'ndjson':
+        return ''.join(json.dumps(dict((c, _value(row[c])) for c in columns))
+                       + '\n' for row in rows)
+
+    out = StringIO.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    for row in rows:
+        values = []
+        for column in columns:
+            value = _value(row[column])
+            if isinstance(value, list):
+                value = '|'.join(value)
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            values.append('' if value is None else value)
+        writer.writerow(values)
+    return out.getvalue()
+
+
+def _pageTask(state):
+    """ Returns the task that exports the next page of a kind """
+    return taskqueue.Task(params={'kind': state.key.urlsafe(),
+                                  'cursor': state.cursor or ''},
+                          url='/tasks/export')
+
+
+def startExport(fmt='ndjson'):
+    """ Starts an export run in the given format and returns its key.
+        Raises ValueError for an unknown format. """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError('Unknown export format: %s' % fmt)
+    run = ExportRun(format=fmt, status=RUNNING)
+    run.put()
+    states = [ExportKind(parent=run.key, id=name) for name in EXPORTERS]
+    ndb.put_multi(states)
+    taskqueue.Queue().add([_pageTask(state) for state in states])
+    return run.key
+
+
+def resumeExport(run_key):
+    """ Restarts the unfinished kinds of a run from their checkpoints """
+    states = ExportKind.query(ancestor=run_key).fetch()
+    tasks = [_pageTask(state) for state in states if not state.done]
+    if tasks:
+        taskqueue.Queue().add(tasks)
+
+
+def exportPage(state_key, cursor):
+    """ Exports the next page of a kind to a new part file, provided that
+        its checkpoint is still at 'cursor' (the urlsafe cursor the task
+        was given, empty for the first page). """
+    state = state_key.get()
+    if not state or state.done or (state.cursor or '') != cursor:
+        return
+    run = state_key.parent().get()
+    name = state_key.id()
+    exporter = EXPORTERS[name]
+
+    model = exporter.model
+    entities, next_cursor, more = model.query().order(model.key).fetch_page(
+        EXPORT_PAGE_SIZE,
+        start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+    rows = [row for entity in entities for row in exporter.rows(entity)]
+
+    path = None
+    if rows:
+        path = '%s/%s/part-%05d.%s' % (run.key.id(), name, state.part + 1,
+                                       EXPORT_FORMATS[run.format])
+        exportStorage().write(path, _encode(rows, exporter.columns,
+                                            run.format))
+
+    next_cursor = next_cursor.urlsafe() if more and next_cursor else None
+    if _checkpoint(state_key, cursor, next_cursor, path, len(rows)) and \
+            not next_cursor:
+        _finishExport(run.key)
+
+
+@ndb.transactional()
+def _checkpoint(state_key, cursor, next_cursor, path, rows):
+    """ Records an exported page and enqueues the task for the next one
+        (if any) when the transaction commits. Returns False if another
+        task checkpointed the kind in the meantime. """
+    state = state_key.get()
+    if (state.cursor or '') != cursor:
+        return False
+    if path:
+        state.part += 1
+        state.files.append(path)
+        state.rows += rows
+    if next_cursor:
+        state.cursor = next_cursor
+        taskqueue.add(_pageTask(state), transactional=True)
+    else:
+        state.done = True
+    state.put()
+    return True
+
+
+def _finishExport(run_key):
+    """ Writes the manifest of a run once all of its kinds are done """
+    states = ExportKind.query(ancestor=run_key).fetch()
+    if not all(state.done for state in states):
+        return
+    run = run_key.get()
+    manifest = {
+        'run': run_key.id(),
+        'format': run.format,
+        'created': run.created.isoformat(),
+        'kinds': dict((state.key.id(), {'rows': state.rows,
+                                        'files': state.files})
+                      for state in states),
+    }
+    exportStorage().write('%s/manifest.json' % run_key.id(),
+                          json.dumps(manifest, indent=2))
+    run.status = DONE
+    run.put()
+
+
+def recentExports(limit=10):
+    """ Returns the status and files of the most recent export runs """
+    runs = ExportRun.query().order(-ExportRun.created).fetch(limit)
+    exports = []
+    for run in runs:
+        states = ExportKind.query(ancestor=run.key).fetch()
+        exports.append({
+            'id': run.key.urlsafe(),
+            'format': run.format,
+            'status': run.status,
+            'created': str(run.created),
+            'kinds': dict((state.key.id(), {'rows': state.rows,
+                                            'files': len(state.files),
+                                            'done': state.done})
+                          for state in states),
+        })
+    return exports
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+"""
+facets.py -- Udacity conference server-side Python App Engine
+    faceted counts of Conferences for the browse page
+
+$Id$
+
+"""
+
+"""
+    A "facet" is one value of one of the browsable Conference fields
+    (see FACET_FIELDS in constants.py), e.g. city == 'London'. The number
+    of Conferences of every facet is a sharded counter: FACET_SHARDS
+    ConferenceFacetShard entities, each in its own entity group, of which
+    an update changes one at random. Creating or updating Conferences of
+    a popular value thus never queues on one entity group, and no entity
+    grows with the number of Conferences.
+
+    Facets are maintained by the /tasks/update_conference_facets task,
+    which is enqueued by _createConferenceObject and
+    _updateConferenceObject. A retried task may count a Conference twice;
+    the daily rebuild (rebuildConferenceFacets) repairs any such drift.
+    The unfiltered counts are kept in Memcache.
+
+    Counts within equality filters on facet fields are counted by the
+    datastore: one keys-only count query per facet value, combining the
+    filters with the value, all run at once. Equality filters are served
+    by merge joins over the built-in indexes, so no composite index is
+    needed. A count query stops after FACET_COUNT_LIMIT Conferences; a
+    facet with more is counted as FACET_COUNT_LIMIT + 1, which the API
+    reports as a capped count. These counts are cached for
+    FILTERED_FACETS_SECONDS per combination of filters. Other filters go
+    through the regular query, and its Conferences are counted in memory
+    (countFacets()).
+"""
+
+import hashlib
+import random
+
+from collections import Counter
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from constants import FACET_FIELDS
+from models import Conference
+from models import ConferenceFacetShard
+
+FACET_SHARDS = 10
+FACET_COUNT_LIMIT = 1000
+FILTERED_FACETS_SECONDS = 60
+MEMCACHE_FACETS_KEY = "CONFERENCE_FACETS"
+MEMCACHE_FILTERED_FACETS_KEY = "CONFERENCE_FACETS_%s"
+
+""" the kind of the facets before they were sharded counters, deleted by
+    rebuildConferenceFacets """
+LEGACY_FACET_KIND = 'ConferenceFacet'
+
+
+def facetShardKey(field, value, shard):
+    """ Returns the key of one shard of the counter of a facet """
+    return ndb.Key(ConferenceFacetShard, u'%s:%s:%d' % (field, value, shard))
+
+
+def facetValues(conf):
+    """ Returns a dictionary of facet field -> sorted list of the (string)
+        values a Conference has for that field. A month of 0 means that
+        the Conference has no start date, so it is not a facet value. """
+    values = {}
+    for field in FACET_FIELDS:
+        raw = getattr(conf, field, None)
+        if not isinstance(raw, list):
+            raw = [raw]
+        values[field] = sorted(set(
+            unicode(v) for v in raw if v not in (None, '', 0)))
+    return values
+
+
+def updateConferenceFacets(c_key, old, new):
+    """ Moves a Conference from the facets it had (old) to the facets it
+        has now (new). Both are dictionaries as returned by facetValues();
+        use an empty dictionary for a newly created Conference.
+
+        Returns False (and changes nothing) if a new Conference cannot be
+        found, i.e. its put failed. """
+    if not old and not c_key.get():
+        return False
+
+    for field in FACET_FIELDS:
+        before = set(old.get(field, []))
+        after = set(new.get(field, []))
+        for value in before - after:
+            _addToFacet(field, value, -1)
+        for value in after - before:
+            _addToFacet(field, value, 1)
+
+    # the cached counts are now stale
+    memcache.delete(MEMCACHE_FACETS_KEY)
+    return True
+
+
+@ndb.transactional()
+def _addToFacet(field, value, delta):
+    """ Adds delta to a random shard of the counter of a facet """
+    s_key = facetShardKey(field, value, random.randrange(FACET_SHARDS))
+    shard = s_key.get() or ConferenceFacetShard(key=s_key, field=field,
+                                                value=value, count=0)
+    shard.count += delta
+    shard.put()
+
+
+def rebuildConferenceFacets():
+    """ Recomputes every facet from scratch by scanning all Conferences,
+        each counter into its first shard. Used by the facet cron job to
+        repair any drift caused by failed or retried update tasks.
+
+        The new counts are written over the shards of every counted
+        facet, its other existing shards set to 0, so a counter never
+        reads as missing while the rebuild runs. Only the shards of facets
+        no Conference has any more are deleted, after the writes. """
+    counts = countFacets(Conference.query())
+    shards = dict(
+        (facetShardKey(field, value, 0),
+         ConferenceFacetShard(key=facetShardKey(field, value, 0),
+                              field=field, value=value, count=count))
+        for field in counts for value, count in counts[field].items())
+    counted = set((shard.field, shard.value) for shard in shards.values())
+
+    stale = []
+    for shard in ConferenceFacetShard.query():
+        if shard.key in shards:
+            continue
+        if (shard.field, shard.value) in counted:
+            if shard.count:
+                shard.count = 0
+                shards[shard.key] = shard
+        else:
+            stale.append(shard.key)
+    ndb.put_multi(shards.values())
+
+    # drop the facets no Conference has, and those of the key list era
+    stale.extend(ndb.Query(kind=LEGACY_FACET_KIND).iter(keys_only=True))
+    ndb.delete_multi(stale)
+    memcache.delete(MEMCACHE_FACETS_KEY)
+
+
+def countFacets(conferences):
+    """ Returns the counts of the facets of the given Conferences, as a
+        dictionary of field -> {value: count} """
+    counts = dict((field, Counter()) for field in FACET_FIELDS)
+    for conf in conferences:
+        for field, values in facetValues(conf).items():
+            counts[field].update(values)
+    return dict((field, dict(counts[field])) for field in FACET_FIELDS)
+
+
+def getFacetSummary():
+    """ Returns the unfiltered counts as a dictionary of
+        field -> {value: count}, from Memcache when available. """
+    summary = memcache.get(MEMCACHE_FACETS_KEY)
+    if summary is None:
+        totals = Counter()
+        for shard in ConferenceFacetShard.query():
+            totals[shard.field, shard.value] += shard.count
+        summary = dict((field, {}) for field in FACET_FIELDS)
+        for (field, value), count in totals.items():
+            if count > 0:
+                summary[field][value] = count
+        memcache.set(MEMCACHE_FACETS_KEY, summary)
+    return summary
+
+
+def _facetFilter(field, value):
+    """ Returns the equality filter of a facet """
+    prop = Conference._properties[field]
+    return prop == (int(value) if field == 'month' else value)
+
+
+@ndb.tasklet
+def _countFacetsAsync(filters):
+    """ Counts (as a Future) the Conferences matching the filters within
+        every facet of the unfiltered summary """
+    summary = getFacetSummary()
+    base = [_facetFilter(field, value) for field, value in filters]
+    facets = [(field, value) for field in FACET_FIELDS
+              for value in summary[field]]
+    counts = yield [
+        Conference.query(*(base + [_facetFilter(field, value)])).count_async(
+            limit=FACET_COUNT_LIMIT + 1)
+        for field, value in facets]
+
+    filtered = dict((field, {}) for field in FACET_FIELDS)
+    for (field, value), count in zip(facets, counts):
+        if count:
+            filtered[field][value] = count
+    raise ndb.Return(filtered)
+
+
+def getFilteredFacetSummary(filters):
+    """ Returns the counts (same shape as getFacetSummary()) restricted to
+        the Conferences matching all of the given (field, value) equality
+        filters on facet fields, from Memcache when they were counted for
+        the same filters within FILTERED_FACETS_SECONDS. A count of
+        FACET_COUNT_LIMIT + 1 stands for any number above it. """
+    memcache_key = MEMCACHE_FILTERED_FACETS_KEY % hashlib.md5(
+        repr(sorted((field, unicode(value)) for field, value in filters))
+    ).hexdigest()
+    summary = memcache.get(memcache_key)
+    if summary is None:
+        summary = _countFacetsAsync(filters).get_result()
+        memcache.set(memcache_key, summary, time=FILTERED_FACETS_SECONDS)
+    return summary
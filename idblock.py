@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""
+idblock.py -- Udacity conference server-side Python App Engine
+    per-instance blocks of pre-allocated datastore ids
+
+$Id$
+
+"""
+
+"""
+    Reserving an id with allocate_ids() is a blocking datastore RPC. An
+    IdBlock reserves ids a block at a time and hands them out from memory,
+    so that only one request in every 'size' pays for the RPC. An IdBlock
+    is meant to be created once at module level, so each instance keeps
+    its own block; ids left over when an instance shuts down are simply
+    never used.
+
+    The ids come from the kind's root range, while the ids of existing
+    entities were reserved under their parent key. Those per-parent ids
+    are small sequential numbers, so before handing out any id the block
+    reserves every root id up to 'floor'; ids above the floor can never
+    clash with an id an existing entity already has under its parent.
+"""
+
+import threading
+
+from google.appengine.ext import ndb
+
+ID_FLOOR = 1 << 20
+
+
+class IdBlock(object):
+    """ Thread-safe source of ids for one model kind """
+
+    def __init__(self, model, size=100, floor=ID_FLOOR):
+        self._model = model
+        self._size = size
+        self._floor = floor
+        self._lock = threading.Lock()
+        self._next = 1
+        self._last = 0
+        self._floorReserved = False
+
+    @ndb.tasklet
+    def nextIdAsync(self):
+        """ Returns (as a Future) the next unused id, reserving a new block
+            of ids from the datastore when the current one is used up. """
+        with self._lock:
+            if self._next <= self._last:
+                next_id = self._next
+                self._next += 1
+                raise ndb.Return(next_id)
+
+        if not self._floorReserved:
+            yield self._model.allocate_ids_async(max=self._floor)
+            self._floorReserved = True
+
+        first, last = yield self._model.allocate_ids_async(size=self._size)
+
+        """ Another request may have refilled the block while this one was
+            waiting; keep whichever block is not used up and let the ids of
+            the other one go to waste. """
+        with self._lock:
+            if self._next > self._last:
+                self._next, self._last = first + 1, last
+        raise ndb.Return(first)
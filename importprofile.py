@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""
+importprofile.py -- Udacity conference server-side Python App Engine
+    timing of the module imports of a starting instance
+
+$Id$
+
+"""
+
+"""
+    appengine_config.py, which the runtime imports before anything else,
+    installs a wrapper around __import__ that times every module loaded
+    from then on. Each module gets its cumulative time (including the
+    modules it imports in turn) and its self time (without them). The
+    wrapper is removed as soon as either entry point is imported (at the
+    end of conference.py, which the API requests load, and of main.py),
+    so requests do not pay for it. main.py imports conference.py last for
+    that reason.
+
+    The report is shown at /admin/startup with the steps of the warmup
+    request (see WarmupHandler in main.py), for the instance serving it.
+"""
+
+import __builtin__
+import sys
+import threading
+import time
+
+STARTED = time.time()
+
+_originalImport = None
+_lock = threading.RLock()
+_stack = []
+_modules = {}
+_warmup = []
+
+
+def _timedImport(name, globals=None, locals=None, fromlist=None, level=-1):
+    """ __import__, timing the modules it loads """
+    if name in sys.modules:
+        return _originalImport(name, globals, locals, fromlist, level)
+
+    with _lock:
+        _stack.append(0.0)
+        start = time.time()
+        try:
+            return _originalImport(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - start
+            children = _stack.pop()
+            if _stack:
+                _stack[-1] += elapsed
+            cumulative, own = _modules.get(name, (0.0, 0.0))
+            _modules[name] = (cumulative + elapsed,
+                              own + elapsed - children)
+
+
+def install():
+    """ Starts timing imports """
+    global _originalImport
+    if _originalImport is None:
+        _originalImport = __builtin__.__import__
+        __builtin__.__import__ = _timedImport
+
+
+def uninstall():
+    """ Stops timing imports """
+    global _originalImport
+    if _originalImport is not None:
+        __builtin__.__import__ = _originalImport
+        _originalImport = None
+
+
+def recordWarmupStep(name, seconds):
+    """ Records how long a step of the warmup request took """
+    _warmup.append((name, seconds))
+
+
+def startupReport(limit=40):
+    """ Returns the slowest imports (by cumulative time, in milliseconds)
+        and the warmup steps of this instance. """
+    modules = sorted(_modules.items(), key=lambda item: -item[1][0])
+    return {
+        'startedSecondsAgo': round(time.time() - STARTED, 1),
+        'importedModules': len(_modules),
+        'imports': [{'module': name,
+                     'cumulativeMs': round(cumulative * 1000, 1),
+                     'selfMs': round(own * 1000, 1)}
+                    for name, (cumulative, own) in modules[:limit]],
+        'warmup': [{'step': name, 'ms': round(seconds * 1000, 1)}
+                   for name, seconds in _warmup],
+    }
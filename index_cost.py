@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""
+index_cost.py -- Udacity conference server-side Python App Engine
+    report of the index write cost of a Conference
+
+$Id$
+
+"""
+
+"""
+    Reports how many datastore write operations it costs to store a
+    Conference, before and after a change to its indexes. Each indexed
+    property value costs two index rows (ascending and descending) and
+    each composite index costs one row per combination of the values of
+    its properties, which is why a repeated property such as 'topics'
+    multiplies the rows of every composite index it appears in.
+
+    The costs follow the Datastore write operation rules:
+
+        new entity put:  2 + 2 per indexed value + 1 per composite row
+        entity update:   1 + 4 per changed indexed value
+                           + 2 per changed composite row
+
+    The "before" column assumes every property is indexed (the ndb default)
+    together with the composite indexes of the --before index file; the
+    "after" column uses the indexed flags of the Conference model and the
+    composite indexes of the --after index file. Run it from the project
+    directory with the App Engine SDK on the PYTHONPATH, e.g.
+
+        git show HEAD~1:index.yaml > /tmp/old_index.yaml
+        python index_cost.py --before /tmp/old_index.yaml --topics 5
+"""
+
+import argparse
+
+import yaml
+
+from models import Conference
+
+
+def sampleValueCounts(topics):
+    """ Returns the number of values a typical Conference has for each of
+        its properties, with 'topics' topics. """
+    counts = {}
+    for name, prop in Conference._properties.items():
+        counts[name] = topics if prop._repeated else 1
+    return counts
+
+
+def compositeIndexes(path, kind='Conference'):
+    """ Returns the property names of each composite index for a kind
+        declared in an index.yaml file. """
+    if not path:
+        return []
+    with open(path) as f:
+        config = yaml.safe_load(f) or {}
+    return [[prop['name'] for prop in index.get('properties', [])]
+            for index in config.get('indexes') or []
+            if index.get('kind') == kind]
+
+
+def compositeRows(index, counts):
+    """ Returns the number of rows one entity has in a composite index. """
+    rows = 1
+    for name in index:
+        rows *= counts.get(name, 0)
+    return rows
+
+
+def writeCost(indexed, composites, counts, changed=()):
+    """ Returns (new entity put cost, update cost) in write operations.
+        The update cost is for changing the single-valued properties in
+        'changed', e.g. seatsAvailable on every registration. """
+    values = sum(counts[name] for name in indexed)
+    rows = sum(compositeRows(index, counts) for index in composites)
+    put = 2 + 2 * values + rows
+
+    changed_values = sum(counts[name] for name in changed if name in indexed)
+    changed_rows = sum(compositeRows(index, counts) for index in composites
+                       if set(changed) & set(index))
+    update = 1 + 4 * changed_values + 2 * changed_rows
+    return put, update
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Report the index write cost of a Conference.')
+    parser.add_argument('--before', help='index.yaml before the change')
+    parser.add_argument('--after', default='index.yaml',
+                        help='index.yaml after the change')
+    parser.add_argument('--topics', type=int, default=3,
+                        help='number of topics of the sample Conference')
+    args = parser.parse_args()
+
+    counts = sampleValueCounts(args.topics)
+    before = writeCost(list(Conference._properties),
+                       compositeIndexes(args.before), counts,
+                       changed=('seatsAvailable',))
+    after = writeCost([name for name, prop in Conference._properties.items()
+                       if prop._indexed],
+                      compositeIndexes(args.after), counts,
+                      changed=('seatsAvailable',))
+
+    print('Conference with %d topics      before   after' % args.topics)
+    print('create (put new entity)     %8d %7d' % (before[0], after[0]))
+    print('registration (seat change)  %8d %7d' % (before[1], after[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""
+itinerary.py -- Udacity conference server-side Python App Engine
+    wishlist itinerary with schedule conflicts
+
+$Id$
+
+"""
+
+"""
+    An itinerary lists the Sessions of a wishlist in date and start time
+    order, and groups the Sessions whose times overlap. A Session lasts
+    from startSortKey (its date and start time in minutes) for 'duration'
+    minutes; Sessions without a date or a start time come last, and are
+    in no group.
+
+    Groups are found with one sweep over the Sessions sorted by start: a
+    Session starting before the latest end seen in the current group
+    joins it, any other starts a new group. Overlap is transitive within
+    a group, e.g. A overlaps B and B overlaps C puts all three together
+    even if A ends before C starts. Sorting makes this O(n log n).
+
+    The itinerary of a user is kept in Memcache (as the encoded message
+    the endpoint returns) until their wishlist changes.
+"""
+
+from google.appengine.api import memcache
+
+ITINERARY_CACHE_SECONDS = 600
+MEMCACHE_ITINERARY_KEY = "ITINERARY_%s"
+
+
+def sessionInterval(sess):
+    """ Returns the (start, end) minutes of a Session, or None if it has
+        no date or start time. A Session without a duration ends when it
+        starts. """
+    if sess.startSortKey is None:
+        return None
+    return sess.startSortKey, sess.startSortKey + (sess.duration or 0)
+
+
+def buildItinerary(sessions):
+    """ Returns the Sessions in date and start time order, with the lists
+        of overlapping Sessions (each in that order too). """
+    timed = []
+    untimed = []
+    for sess in sessions:
+        interval = sessionInterval(sess)
+        if interval:
+            timed.append((interval, sess))
+        else:
+            untimed.append(sess)
+    timed.sort(key=lambda item: item[0])
+
+    groups = []
+    group, group_end = [], None
+    for (start, end), sess in timed:
+        if group and start < group_end:
+            group.append(sess)
+            group_end = max(group_end, end)
+        else:
+            if len(group) > 1:
+                groups.append(group)
+            group, group_end = [sess], end
+    if len(group) > 1:
+        groups.append(group)
+
+    untimed.sort(key=lambda sess: sess.sessionName)
+    return [sess for interval, sess in timed] + untimed, groups
+
+
+def cachedItinerary(user_id):
+    """ Returns the cached itinerary of a user, or None """
+    return memcache.get(MEMCACHE_ITINERARY_KEY % user_id)
+
+
+def cacheItinerary(user_id, itinerary):
+    """ Caches the itinerary of a user """
+    memcache.set(MEMCACHE_ITINERARY_KEY % user_id, itinerary,
+                 time=ITINERARY_CACHE_SECONDS)
+
+
+def invalidateItinerary(user_id):
+    """ Drops the cached itinerary of a user, whose wishlist changed """
+    memcache.delete(MEMCACHE_ITINERARY_KEY % user_id)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+jobs.py -- Udacity conference server-side Python App Engine
+    maintenance jobs run by the mapper
+
+$Id$
+
+"""
+
+"""
+    Each function is a mapper job (see mapper.py): it is called with every
+    entity of its kind and returns what needs to be stored. Start them at
+    /admin/mapper. They must be idempotent, since a batch is processed
+    again when its task is retried. Each call runs in a transaction over
+    the entity; queries and reads of other entities go through
+    ndb.non_transactional helpers.
+"""
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from keys import hasCompactId
+from mapper import mapperJob
+from models import Conference
+from models import ConferenceAlias
+from models import Profile
+from models import Session
+from models import Speaker
+
+
+@mapperJob(Conference)
+def backfillConferenceMonth(conf):
+    """ Sets the month of Conferences stored without it (or with a stale
+        one), as set by _createConferenceObject from the start date. """
+    if conf.startDate and conf.month != conf.startDate.month:
+        conf.month = conf.startDate.month
+        return conf
+
+
+@ndb.non_transactional
+def _attendeeCount(conf_key):
+    """ Returns the number of Profiles attending a Conference. Profiles not
+        written since their lists are stored compactly (see keys.py) still
+        hold the websafe key, which a filter on the property no longer
+        matches, so they are counted by a filter on the raw value. """
+    wsck = conf_key.urlsafe()
+    compact = Profile.query(
+        Profile.conferenceKeysToAttend == wsck).fetch(keys_only=True)
+    legacy = Profile.query(
+        ndb.GenericProperty('conferenceKeysToAttend') == wsck).fetch(
+        keys_only=True)
+    return len(set(compact) | set(legacy))
+
+
+@mapperJob(Conference, rate=10)
+def repairSeatsAvailable(conf):
+    """ Recomputes the free seats of a Conference from the Profiles that
+        attend it. The count is eventually consistent and not taken in the
+        Conference's transaction, so run this while registrations are
+        quiet. """
+    attending = _attendeeCount(conf.key)
+    seats = max((conf.maxAttendees or 0) - attending, 0)
+    if conf.seatsAvailable != seats:
+        conf.seatsAvailable = seats
+        return conf
+
+
+@mapperJob(Conference, rate=10)
+def recomputeFeaturedSpeakers(conf):
+    """ Enqueues the task that sets the Featured Speaker of a Conference,
+        as done when one of its Sessions is created. """
+    taskqueue.add(params={'c_key': conf.key.urlsafe()},
+                  url='/tasks/set_featured_speaker', transactional=True)
+
+
+@mapperJob(Conference)
+def backfillConferenceAliases(conf):
+    """ Stores the ConferenceAlias of Conferences whose id is unique across
+        Conferences, so that they can be named by their id (see keys.py).
+        Conferences created before ids came from an IdBlock have none. """
+    if hasCompactId(conf.key):
+        return ConferenceAlias(id=conf.key.id(), conference=conf.key)
+
+
+@ndb.non_transactional
+def _existingKeys(websafe_keys):
+    """ Returns the websafe keys (in order, without duplicates) whose
+        entities still exist. """
+    unique = []
+    for wsk in websafe_keys:
+        if wsk not in unique:
+            unique.append(wsk)
+    keys = []
+    for wsk in unique:
+        try:
+            keys.append(ndb.Key(urlsafe=wsk))
+        except Exception:
+            keys.append(None)
+    found = ndb.get_multi([key for key in keys if key])
+    exists = dict(zip([key for key in keys if key], found))
+    return [wsk for wsk, key in zip(unique, keys) if key and exists[key]]
+
+
+@mapperJob(Profile)
+def migrateProfileLists(prof):
+    """ Drops duplicate keys and keys of deleted Conferences and Sessions
+        from the lists of a Profile. """
+    attending = _existingKeys(prof.conferenceKeysToAttend)
+    wishlist = _existingKeys(prof.sessionKeysWishList)
+    if attending != prof.conferenceKeysToAttend or \
+            wishlist != prof.sessionKeysWishList:
+        prof.conferenceKeysToAttend = attending
+        prof.sessionKeysWishList = wishlist
+        return prof
+
+
+@mapperJob(Session)
+def backfillSessionStartTimes(sess):
+    """ Stores the computed startMinute and startSortKey of Sessions
+        created before they existed. They are computed on every read, but
+        only stored ones are indexed, and getSessionsInWindow and the time
+        filters of the Session queries run on the indexes. """
+    if sess.startTime:
+        return sess
+
+
+@mapperJob(Speaker)
+def backfillSpeakerSortName(speaker):
+    """ Stores the computed sortName of Speakers created before it existed,
+        so that they appear in the speaker directory. """
+    return speaker
+
+
+@mapperJob(Profile)
+def compactProfileLists(prof):
+    """ Rewrites every Profile, so that its key lists are stored in the
+        compact form of keys.py and match queries again. Run it once after
+        deploying the compact form, before relying on queries over the
+        lists. """
+    return prof
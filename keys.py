@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""
+keys.py -- Udacity conference server-side Python App Engine
+    cached key decoding and compact Conference identifiers
+
+$Id$
+
+"""
+
+"""
+    Websafe keys are base64 encoded protocol buffers, and parsing one is
+    not free. decodeKey() keeps the keys it decoded in a bounded LRU
+    cache of the instance; keys are immutable, so they can be shared by
+    concurrent requests.
+
+    Conferences created since ids come from an IdBlock (see idblock.py)
+    have an id that is unique across all Conferences, and so can be named
+    by that number alone, e.g. /conference/5629499534213120. A
+    ConferenceAlias, stored with the Conference, maps the id to the full
+    key. Every endpoint that takes a Conference key takes either form;
+    the websafe key stays the canonical one inside the application (in
+    task parameters, Memcache keys, waitlist entries and so on).
+
+    The key lists of a Profile are stored compactly by KeyPathProperty:
+    the ids along the key's path joined with '|', without the application
+    id and protocol buffer framing of a websafe key. The property still
+    holds websafe keys in memory, and in query filters, so the code using
+    the lists does not change. Values stored before are read as they are,
+    and are compacted when the Profile is next written (or by the
+    compactProfileLists mapper job; until then, queries do not match
+    them).
+"""
+
+import collections
+import threading
+
+from google.appengine.ext import ndb
+
+from idblock import ID_FLOOR
+from tombstones import getEntity
+
+KEY_CACHE_SIZE = 10000
+PATH_SEPARATOR = '|'
+
+
+class KeyCache(object):
+    """ A thread-safe, size-bounded LRU cache of values that never change,
+        such as decoded keys """
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def get(self, name, loader):
+        """ Returns the value cached for name, or the value returned by
+            loader(), which is then cached unless it is None. """
+        with self._lock:
+            value = self._entries.pop(name, None)
+            if value is not None:
+                self._entries[name] = value
+                self._stats['hits'] += 1
+                return value
+
+        value = loader()
+        with self._lock:
+            self._stats['misses'] += 1
+            if value is not None:
+                self._entries[name] = value
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+                    self._stats['evictions'] += 1
+        return value
+
+    def stats(self):
+        """ Returns the counters and current size of the cache """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        for name in ('hits', 'misses', 'evictions'):
+            stats.setdefault(name, 0)
+        return stats
+
+
+""" websafe key -> Key, and Conference id -> Conference Key """
+DECODED_KEYS = KeyCache(KEY_CACHE_SIZE)
+CONFERENCE_IDS = KeyCache(KEY_CACHE_SIZE)
+
+
+def decodeKey(websafe):
+    """ Returns the Key of a websafe key. Raises the errors of
+        ndb.Key(urlsafe=...) for a malformed one. """
+    return DECODED_KEYS.get(websafe, lambda: ndb.Key(urlsafe=websafe))
+
+
+def compactId(conf_key):
+    """ Returns the identifier of a Conference in API paths: its id when
+        that is unique across Conferences, else its websafe key. """
+    if hasCompactId(conf_key):
+        return str(conf_key.id())
+    return conf_key.urlsafe()
+
+
+def hasCompactId(conf_key):
+    """ Returns whether a Conference's id is unique across Conferences,
+        so that it can be named by its id alone. """
+    c_id = conf_key.id()
+    return isinstance(c_id, (int, long)) and c_id > ID_FLOOR
+
+
+def conferenceKey(identifier):
+    """ Returns the Key of a Conference given by its websafe key or its
+        compact id, or None for an id that names no Conference. Raises the
+        errors of decodeKey() for a malformed websafe key. """
+    if not identifier.isdigit():
+        return decodeKey(identifier)
+
+    def load():
+        alias = getEntity(ndb.Key('ConferenceAlias', int(identifier)))
+        return alias.conference if alias else None
+    return CONFERENCE_IDS.get(int(identifier), load)
+
+
+def keyCacheStats():
+    """ Returns the stats() of the key caches of this instance """
+    return {'decodedKeys': DECODED_KEYS.stats(),
+            'conferenceIds': CONFERENCE_IDS.stats()}
+
+
+class KeyPathProperty(ndb.StringProperty):
+    """ A websafe key stored as the ids along its path. The kinds along the
+        path are given to the property; the first id may be a string (a
+        Profile's), the others must be integers. Keys of any other shape
+        are stored as websafe keys. """
+
+    def __init__(self, kinds, **kwargs):
+        super(KeyPathProperty, self).__init__(**kwargs)
+        self._kinds = tuple(kinds)
+
+    def _to_base_type(self, value):
+        if PATH_SEPARATOR in value:
+            return value
+        try:
+            flat = decodeKey(value).flat()
+        except Exception:
+            return value
+        kinds, ids = flat[0::2], flat[1::2]
+        if kinds != self._kinds or \
+                not all(isinstance(i, (int, long)) for i in ids[1:]):
+            return value
+        return PATH_SEPARATOR.join(
+            i.encode('utf-8') if isinstance(i, unicode) else str(i)
+            for i in ids)
+
+    def _from_base_type(self, value):
+        if PATH_SEPARATOR not in value:
+            return value
+        ids = value.rsplit(PATH_SEPARATOR, len(self._kinds) - 1)
+        pairs = [self._kinds[0], ids[0]]
+        for kind, i in zip(self._kinds[1:], ids[1:]):
+            pairs.extend((kind, int(i)))
+        return ndb.Key(*pairs).urlsafe()
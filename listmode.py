@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""
+listmode.py -- Udacity conference server-side Python App Engine
+    selectable execution of the queries behind list endpoints
+
+$Id$
+
+"""
+
+"""
+    ndb caches entities fetched by key (in the request context and in
+    Memcache), but never the results of a query. A list endpoint can run
+    its query in one of two modes:
+
+        ENTITIES - the query returns full entities, all of them read from
+                   the datastore
+        KEYS     - the query returns keys only (small operations), and the
+                   entities are then fetched by key, so that hot entities
+                   are served by the ndb caches instead of the datastore
+
+    Projection queries (see projection.py) return partial entities that
+    cannot be fetched by key, so they always run directly.
+
+    The mode is chosen per endpoint (DEFAULT_LIST_MODES, overridable at run
+    time through /admin/list_modes for side-by-side benchmarks) and every
+    call is counted in Memcache per endpoint: calls, entities read by
+    queries, and, in KEYS mode, cache hits and misses.
+"""
+
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+ENTITIES = 'entities'
+KEYS = 'keys'
+LIST_MODES = (ENTITIES, KEYS)
+
+DEFAULT_LIST_MODES = {
+    'getConferenceSessions': KEYS,
+    'getSessionsBySpeaker': KEYS,
+    'getAllSpeakers': KEYS,
+    'queryConferences': KEYS,
+    'getConferenceFacets': KEYS,
+}
+
+MEMCACHE_LIST_MODE_KEY = "LIST_MODE_%s"
+MEMCACHE_LIST_STATS_PREFIX = "LIST_STATS_%s_"
+LIST_STATS = ('calls', 'queried', 'hits', 'misses')
+
+# run-time overrides are re-read from Memcache at most this often
+MODE_REFRESH_SECONDS = 30
+_modes = {}
+
+
+def listMode(endpoint):
+    """ Returns the mode the list query of an endpoint runs in """
+    mode, expires = _modes.get(endpoint, (None, 0))
+    if expires < time.time():
+        mode = memcache.get(MEMCACHE_LIST_MODE_KEY % endpoint) or \
+            DEFAULT_LIST_MODES.get(endpoint, KEYS)
+        _modes[endpoint] = (mode, time.time() + MODE_REFRESH_SECONDS)
+    return mode
+
+
+def setListMode(endpoint, mode):
+    """ Overrides the mode of an endpoint on every instance (within
+        MODE_REFRESH_SECONDS). A mode of None restores the default. """
+    if mode is None:
+        memcache.delete(MEMCACHE_LIST_MODE_KEY % endpoint)
+    elif mode in LIST_MODES:
+        memcache.set(MEMCACHE_LIST_MODE_KEY % endpoint, mode)
+    else:
+        raise ValueError('Unknown list mode: %s' % mode)
+    _modes.pop(endpoint, None)
+
+
+def _record(endpoint, **counts):
+    """ Adds to the Memcache counters of an endpoint without waiting for
+        Memcache, so a list fetch never blocks on its stats """
+    counts['calls'] = 1
+    memcache.Client().offset_multi_async(
+        counts, initial_value=0,
+        key_prefix=MEMCACHE_LIST_STATS_PREFIX % endpoint)
+
+
+def listStats():
+    """ Returns a dictionary of endpoint -> counters, mode and cache hit
+        ratio (None when nothing was fetched by key yet). """
+    stats = {}
+    for endpoint in sorted(DEFAULT_LIST_MODES):
+        counts = memcache.get_multi(
+            LIST_STATS, key_prefix=MEMCACHE_LIST_STATS_PREFIX % endpoint)
+        entry = dict((name, counts.get(name, 0)) for name in LIST_STATS)
+        fetched = entry['hits'] + entry['misses']
+        entry['hitRatio'] = float(entry['hits']) / fetched if fetched else None
+        entry['mode'] = listMode(endpoint)
+        stats[endpoint] = entry
+    return stats
+
+
+@ndb.tasklet
+def fetchListAsync(query, endpoint, projection=None):
+    """ Runs a list query in the mode of the endpoint, or as a projection
+        on the given properties, and returns (as a Future) the list of
+        entities it matches, in query order. """
+    if projection:
+        entities = yield query.fetch_async(projection=projection)
+        _record(endpoint, queried=len(entities))
+        raise ndb.Return(entities)
+
+    if listMode(endpoint) == ENTITIES:
+        entities = yield query.fetch_async()
+        _record(endpoint, queried=len(entities))
+        raise ndb.Return(entities)
+
+    keys = yield query.fetch_async(keys_only=True)
+
+    """ Ask the caches first so hits and misses can be counted, then read
+        only the misses from the datastore (which also caches them). """
+    cached = yield ndb.get_multi_async(keys, use_datastore=False)
+    misses = [key for key, entity in zip(keys, cached) if entity is None]
+    loaded = yield ndb.get_multi_async(misses)
+    loaded = dict(zip(misses, loaded))
+    _record(endpoint, hits=len(keys) - len(misses), misses=len(misses))
+
+    entities = [entity if entity is not None else loaded[key]
+                for key, entity in zip(keys, cached)]
+    raise ndb.Return([entity for entity in entities if entity is not None])
+
+
+def fetchList(query, endpoint, projection=None):
+    """ Synchronous version of fetchListAsync """
+    return fetchListAsync(query, endpoint, projection).get_result()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+"""
+localcache.py -- Udacity conference server-side Python App Engine
+    instance-local LRU caches invalidated through Memcache generations
+
+$Id$
+
+"""
+
+"""
+    A LocalCache keeps up to 'size' values in the memory of an instance for
+    at most 'ttl' seconds, least recently used values going first. Since
+    app.yaml sets 'threadsafe: yes', an instance serves several requests at
+    once, so every access to the cache is done under a lock.
+
+    Every cache has a namespace with a generation number kept in Memcache.
+    invalidate() increments it, and each instance re-reads it at most every
+    GENERATION_CHECK_SECONDS, so a single Memcache increment drops the
+    copies held by all instances within that delay. Values are meant for
+    data that is read on most requests but rarely changes.
+
+    On a local miss the value is looked up in Memcache when the cache is
+    'shared' (under a key holding the generation, so invalidating the
+    namespace invalidates this tier too), and only then computed by the
+    loader and stored in both tiers. Caches of values whose source is
+    Memcache already are not shared. A value over the Memcache size limit
+    (1MB), such as a long list, is only kept on the instance.
+
+    delete() drops a single key, on this instance and in Memcache, without
+    touching the generation; other instances keep their copy for at most
+    'ttl' seconds. It suits values changed often, one key at a time, where
+    invalidating the whole namespace would empty the cache of every
+    instance each time.
+
+    getAsync() does the same for tasklets: it looks in Memcache and runs
+    its loader (which returns a Future) without blocking the event loop.
+
+    Every cache counts its local hits, shared hits, misses and evictions
+    per instance; see cacheStats().
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+GENERATION_CHECK_SECONDS = 5
+MEMCACHE_GENERATION_KEY = "CACHE_GENERATION_%s"
+MEMCACHE_VALUE_KEY = "CACHE_%s_%d_%s"
+
+_caches = []
+
+
+class LocalCache(object):
+    """ A thread-safe, size-bounded LRU cache with a time-to-live, local to
+        the instance and invalidated per namespace through Memcache. """
+
+    def __init__(self, namespace, size=100, ttl=300, shared=False,
+                 cache_none=True):
+        self.namespace = namespace
+        self.size = size
+        self.ttl = ttl
+        self.shared = shared
+        self.cache_none = cache_none
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+        self._checked = 0
+        self._stats = collections.Counter()
+        _caches.append(self)
+
+    def _currentGeneration(self):
+        """ Returns the generation of the namespace, re-reading it from
+            Memcache at most every GENERATION_CHECK_SECONDS. An evicted
+            generation starts again from the current time, so that it never
+            goes back to a value that instances may still hold. """
+        now = time.time()
+        if self._generation is not None and \
+                now - self._checked < GENERATION_CHECK_SECONDS:
+            return self._generation
+
+        gen_key = MEMCACHE_GENERATION_KEY % self.namespace
+        generation = memcache.get(gen_key)
+        if generation is None:
+            memcache.add(gen_key, int(now))
+            generation = memcache.get(gen_key) or int(now)
+        with self._lock:
+            if generation != self._generation:
+                self._entries.clear()
+            self._generation, self._checked = generation, now
+        return generation
+
+    def get(self, key, loader=None):
+        """ Returns the value cached for key, or the value returned by
+            loader() (None without a loader), which is then cached. None is
+            cached as well, so a missing value is not looked up again,
+            unless the cache was created with cache_none=False. """
+        generation = self._currentGeneration()
+        entry = self._localEntry(key)
+        if entry:
+            return entry[0]
+
+        shared_key = MEMCACHE_VALUE_KEY % (self.namespace, generation, key)
+        found = memcache.get(shared_key) if self.shared else None
+        if found is not None:
+            value, stat = found[0], 'sharedHits'
+        else:
+            value, stat = loader() if loader else None, 'misses'
+            if value is None and not self.cache_none:
+                with self._lock:
+                    self._stats[stat] += 1
+                return None
+            if self.shared:
+                try:
+                    memcache.set(shared_key, (value,), time=self.ttl)
+                except ValueError:
+                    self._tooLarge(key)
+        self._store(key, value, stat)
+        return value
+
+    @ndb.tasklet
+    def getAsync(self, key, loader=None):
+        """ Returns (as a Future) what get() returns, the loader returning
+            a Future of the value instead of the value. """
+        generation = self._currentGeneration()
+        entry = self._localEntry(key)
+        if entry:
+            raise ndb.Return(entry[0])
+
+        ctx = ndb.get_context()
+        shared_key = MEMCACHE_VALUE_KEY % (self.namespace, generation, key)
+        found = (yield ctx.memcache_get(shared_key)) if self.shared else None
+        if found is not None:
+            value, stat = found[0], 'sharedHits'
+        else:
+            value, stat = (yield loader()) if loader else None, 'misses'
+            if value is None and not self.cache_none:
+                with self._lock:
+                    self._stats[stat] += 1
+                raise ndb.Return(None)
+            if self.shared:
+                try:
+                    yield ctx.memcache_set(shared_key, (value,),
+                                           time=self.ttl)
+                except ValueError:
+                    self._tooLarge(key)
+        self._store(key, value, stat)
+        raise ndb.Return(value)
+
+    def _localEntry(self, key):
+        """ Returns the live (value, expiry) entry of a key on this
+            instance, counted as a local hit, or None """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > time.time():
+                del self._entries[key]
+                self._entries[key] = entry
+                self._stats['localHits'] += 1
+                return entry
+        return None
+
+    def set(self, key, value):
+        """ Caches a value on this instance (and in Memcache if the cache is
+            shared). Other instances keep their copies; call invalidate()
+            first for them to pick up the new value. """
+        if self.shared:
+            try:
+                memcache.set(MEMCACHE_VALUE_KEY % (
+                    self.namespace, self._currentGeneration(), key),
+                    (value,), time=self.ttl)
+            except ValueError:
+                self._tooLarge(key)
+        self._store(key, value)
+
+    def _tooLarge(self, key):
+        logging.warning('Value of %s in cache %s too large for Memcache; '
+                        'kept on this instance only', key, self.namespace)
+
+    def _store(self, key, value, stat=None):
+        """ Adds a value to the local tier, evicting the least recently
+            used values beyond the size of the cache, and counts how it
+            was found. """
+        with self._lock:
+            if stat:
+                self._stats[stat] += 1
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + self.ttl)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def delete(self, key):
+        """ Drops the value of a key on this instance (and in Memcache).
+            Other instances keep their copies for up to 'ttl' seconds. """
+        if self.shared:
+            memcache.delete(MEMCACHE_VALUE_KEY % (
+                self.namespace, self._currentGeneration(), key))
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate(self):
+        """ Drops the values of the namespace on every instance (and in
+            Memcache) by incrementing its generation. """
+        generation = memcache.incr(MEMCACHE_GENERATION_KEY % self.namespace,
+                                   initial_value=int(time.time()))
+        with self._lock:
+            self._entries.clear()
+            self._generation, self._checked = generation, time.time()
+
+    def stats(self):
+        """ Returns the counters and current size of the cache on this
+            instance, with the ratio of requests served by either tier. """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        for name in ('localHits', 'sharedHits', 'misses', 'evictions'):
+            stats.setdefault(name, 0)
+        total = stats['localHits'] + stats['sharedHits'] + stats['misses']
+        stats['hitRatio'] = (float(total - stats['misses']) / total
+                             if total else None)
+        return stats
+
+
+def cacheStats():
+    """ Returns a dictionary of namespace -> stats() of every cache of this
+        instance. """
+    return dict((cache.namespace, cache.stats()) for cache in _caches)
+
+
+""" The caches of the application """
+ANNOUNCEMENT_CACHE = LocalCache('announcement', size=1, ttl=60)
+FEATURED_SPEAKER_CACHE = LocalCache('featured_speaker', size=200, ttl=60)
+SPEAKER_CACHE = LocalCache('speakers', size=500, ttl=300, shared=True)
+CONFERENCE_CACHE = LocalCache('conference', size=500, ttl=60, shared=True,
+                              cache_none=False)
@@ -12,13 +12,101 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
+import logging
+import os
+import time
+
 import webapp2
+from endpoints import api_config
+from protorpc import message_types
+from protorpc import protojson
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
-from google.appengine.api import app_identity
-from google.appengine.api import mail
-from conference import ConferenceApi
+from constants import UPCOMING_REQUEST
 from models import Session, Speaker
 from collections import Counter
+from export import exportPage
+from export import recentExports
+from export import resumeExport
+from export import startExport
+from facets import getFacetSummary
+from facets import rebuildConferenceFacets
+from importprofile import recordWarmupStep
+from importprofile import startupReport
+from importprofile import uninstall as stopImportProfile
+from facets import updateConferenceFacets
+from keys import keyCacheStats
+from listmode import listStats
+from localcache import cacheStats
+from listmode import setListMode
+from mapper import JOBS
+from mapper import pauseJob
+from mapper import processShard
+from mapper import recentJobs
+from mapper import resumeJob
+from mapper import startJob
+import jobs  # registers the mapper jobs
+from notifications import NOTIFICATION_QUEUE
+from notifications import sendConfirmationEmail
+from notifications import sendNotifications
+from notifications import waitlistTasks
+from profiling import captures
+from profiling import getCapture
+from profiling import newToken
+from profiling import profileSettings
+from profiling import revokeToken
+from profiling import setSampleRate
+from recommend import buildIndex
+from recommend import currentIndex
+from ratelimit import rateLimitStats
+from ratelimit import setRateLimit
+from registration import processRegistrations
+from tombstones import tombstoneStats
+from upcoming import refreshFeed
+from waitlist import promoteWaitlist
+# imported last: it stops timing imports (see importprofile.py)
+from conference import ConferenceApi
+
+MAX_FACET_TASK_RETRIES = 5
+
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """ Prepare a new instance before it serves users (warmup request):
+            the modules are imported with this one, then the API
+            configuration and the message encoders are built and the hot
+            cached values are loaded, each step timed for /admin/startup.
+            ndb has no query plans to build; the queries behind the cached
+            values run once instead. """
+        api = ConferenceApi()
+        steps = [
+            ('apiConfig', lambda: api_config.ApiConfigGenerator(
+                ).pretty_print_config_to_json(ConferenceApi)),
+            ('announcement', lambda: api.getAnnouncement(
+                message_types.VoidMessage())),
+            ('upcomingConferences', lambda: protojson.encode_message(
+                api.getUpcomingConferences(
+                    UPCOMING_REQUEST.combined_message_class()))),
+            ('conferenceFacets', getFacetSummary),
+            ('recommendationIndex', currentIndex),
+        ]
+        for name, step in steps:
+            start = time.time()
+            try:
+                step()
+            except Exception:
+                logging.exception('Warmup step %s failed', name)
+            recordWarmupStep(name, time.time() - start)
+        self.response.set_status(204)
+
+class StartupHandler(webapp2.RequestHandler):
+    def get(self):
+        """ Show where the start of the instance serving the request went:
+            its slowest imports and its warmup steps, as JSON. """
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'instance': os.environ.get('INSTANCE_ID'),
+            'startup': startupReport()}, indent=2))
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
@@ -27,18 +115,20 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
         self.response.set_status(204)
 
 
+class SendNotificationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """ Lease pending notification emails from the notifications pull
+            queue and send them in batches. """
+        sendNotifications()
+        self.response.set_status(204)
+
+
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
-        """Send email confirming Conference creation."""
-        mail.send_mail(
-            'noreply@%s.appspotmail.com' % (
-                app_identity.get_application_id()),     # from
-            self.request.get('email'),                  # to
-            'You created a new Conference!',            # subj
-            'Hi, you have created a following '         # body
-            'conference:\r\n\r\n%s' % self.request.get(
-                'conferenceInfo')
-        )
+        """ Send the email of a confirmation task queued before
+            confirmations went through the notifications pull queue. """
+        sendConfirmationEmail(self.request.get('email'),
+                              self.request.get('conferenceInfo'))
 
 class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
     def post(self):
@@ -49,8 +139,268 @@ class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
         ConferenceApi._setFeaturedSpeaker(self, self.request)
         self.response.set_status(204)
 
+class UpdateConferenceFacetsHandler(webapp2.RequestHandler):
+    def post(self):
+        """ Moves a created or updated Conference between the facets
+            used for the counts on the browse page. """
+        updated = updateConferenceFacets(
+            ndb.Key(urlsafe=self.request.get('c_key')),
+            json.loads(self.request.get('old')),
+            json.loads(self.request.get('new')))
+
+        """ A new Conference that is not stored yet makes the task retry;
+            if it is still missing after a few tries its put failed. """
+        retries = int(self.request.headers.get(
+            'X-AppEngine-TaskRetryCount', 0))
+        if not updated and retries < MAX_FACET_TASK_RETRIES:
+            self.response.set_status(503)
+        else:
+            self.response.set_status(204)
+
+
+class RebuildConferenceFacetsHandler(webapp2.RequestHandler):
+    def get(self):
+        """ Recompute all Conference facets from scratch. """
+        rebuildConferenceFacets()
+        self.response.set_status(204)
+
+class ProcessRegistrationsHandler(webapp2.RequestHandler):
+    def post(self):
+        """ Grant seats to the queued registrations for a Conference. """
+        processRegistrations(self.request.get('wsck'))
+        self.response.set_status(204)
+
+    def get(self):
+        """ Cron fallback: grant seats to queued registrations for any
+            Conference, oldest first. """
+        processRegistrations()
+        self.response.set_status(204)
+
+class PromoteWaitlistHandler(webapp2.RequestHandler):
+    def post(self):
+        """ Fill the free seats of a Conference from its waitlist. """
+        promoteWaitlist(self.request.get('wsck'))
+        self.response.set_status(204)
+
+
+class NotifyWaitlistHandler(webapp2.RequestHandler):
+    def post(self):
+        """ Queue the emails for users promoted from a waitlist. """
+        taskqueue.Queue(NOTIFICATION_QUEUE).add(waitlistTasks(
+            self.request.get('wsck'), json.loads(self.request.get('users'))))
+        self.response.set_status(204)
+
+class ListModesHandler(webapp2.RequestHandler):
+    def get(self):
+        """ Show the list mode and cache hit counters of each list
+            endpoint as JSON. """
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(listStats(), indent=2))
+
+    def post(self):
+        """ Switch the list mode of an endpoint ('entities' or 'keys'; an
+            empty mode restores the default). """
+        try:
+            setListMode(self.request.get('endpoint'),
+                        self.request.get('mode') or None)
+        except ValueError as e:
+            self.abort(400, str(e))
+        self.response.set_status(204)
+
+class RateLimitsHandler(webapp2.RequestHandler):
+    def get(self):
+        """ Show the rate limit and refused calls of each rate limited
+            endpoint as JSON. """
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(rateLimitStats(), indent=2))
+
+    def post(self):
+        """ Override the limit of an endpoint ('tokens' per 'seconds'; no
+            tokens restores the default). """
+        try:
+            tokens = self.request.get('tokens')
+            setRateLimit(self.request.get('endpoint'),
+                         int(tokens) if tokens else None,
+                         int(self.request.get('seconds') or 60))
+        except ValueError as e:
+            self.abort(400, str(e))
+        self.response.set_status(204)
+
+class ProfilesHandler(webapp2.RequestHandler):
+    def get(self):
+        """ List the profiled API requests and the profiling settings as
+            JSON, or download the capture of one request (id=<id>) as
+            pstats data (format=pstats, the default) or as JSON with its
+            summary and datastore RPC timeline (format=json). """
+        capture_id = self.request.get('id')
+        if not capture_id:
+            rate, token = profileSettings()
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.write(json.dumps({
+                'sampleRate': rate, 'token': token,
+                'captures': captures()}, indent=2))
+            return
+
+        try:
+            capture = getCapture(int(capture_id))
+        except ValueError:
+            self.abort(400, 'Not a capture id: %s' % capture_id)
+        if not capture:
+            self.abort(404, 'No capture %s' % capture_id)
+        if self.request.get('format') == 'json':
+            del capture['pstats']
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.write(json.dumps(capture, indent=2))
+        else:
+            self.response.headers['Content-Type'] = 'application/octet-stream'
+            self.response.headers['Content-Disposition'] = \
+                'attachment; filename="profile-%d.pstats"' % capture['id']
+            self.response.write(capture['pstats'])
+
+    def post(self):
+        """ Set the share of API requests profiled (sampleRate=<0..1>),
+            and create (token=new) or revoke (token=none) the token that
+            profiles the requests sending it in the X-Profile-Token
+            header. Shows the resulting settings as JSON. """
+        try:
+            rate = self.request.get('sampleRate')
+            if rate:
+                setSampleRate(float(rate))
+        except ValueError as e:
+            self.abort(400, str(e))
+        token = self.request.get('token')
+        if token == 'new':
+            newToken()
+        elif token == 'none':
+            revokeToken()
+        elif token:
+            self.abort(400, 'The token must be new or none')
+        rate, token = profileSettings()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'sampleRate': rate, 'token': token},
+                                       indent=2))
+
+class CacheStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """ Show the hit and miss counters of the instance-local caches of
+            the instance serving the request as JSON. """
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'instance': os.environ.get('INSTANCE_ID'),
+            'caches': cacheStats(),
+            'keyCaches': keyCacheStats(),
+            'tombstones': tombstoneStats()}, indent=2))
+
+class MapperHandler(webapp2.RequestHandler):
+    def post(self):
+        """ Processes the next batch of a mapper shard (see mapper.py) """
+        processShard(ndb.Key(urlsafe=self.request.get('shard')),
+                     self.request.get('cursor'))
+        self.response.set_status(204)
+
+class MapperAdminHandler(webapp2.RequestHandler):
+    def get(self):
+        """ Show the registered mapper jobs and the progress of the most
+            recent runs as JSON. """
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'jobs': sorted(JOBS),
+                                        'runs': recentJobs()}, indent=2))
+
+    def post(self):
+        """ Start a job (action=start, job=<name>), or pause or resume a
+            run (action=pause|resume, id=<run id from GET>). """
+        action = self.request.get('action')
+        if action == 'start':
+            if self.request.get('job') not in JOBS:
+                self.abort(400, 'Unknown job')
+            startJob(self.request.get('job'))
+        elif action in ('pause', 'resume'):
+            run_key = ndb.Key(urlsafe=self.request.get('id'))
+            (pauseJob if action == 'pause' else resumeJob)(run_key)
+        else:
+            self.abort(400, 'Unknown action')
+        self.response.set_status(204)
+
+class ExportPageHandler(webapp2.RequestHandler):
+    def post(self):
+        """ Exports the next page of a kind to a file (see export.py) """
+        exportPage(ndb.Key(urlsafe=self.request.get('kind')),
+                   self.request.get('cursor'))
+        self.response.set_status(204)
+
+class ExportHandler(webapp2.RequestHandler):
+    def get(self):
+        """ Starts the nightly export (cron job) """
+        startExport()
+        self.response.set_status(204)
+
+class ExportAdminHandler(webapp2.RequestHandler):
+    def get(self):
+        """ Show the status of the most recent exports as JSON """
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(recentExports(), indent=2))
+
+    def post(self):
+        """ Start an export (action=start, format=ndjson|csv) or resume a
+            run (action=resume, id=<run id from GET>). """
+        action = self.request.get('action')
+        if action == 'start':
+            try:
+                startExport(self.request.get('format') or 'ndjson')
+            except ValueError as e:
+                self.abort(400, str(e))
+        elif action == 'resume':
+            resumeExport(ndb.Key(urlsafe=self.request.get('id')))
+        else:
+            self.abort(400, 'Unknown action')
+        self.response.set_status(204)
+
+class RefreshUpcomingHandler(webapp2.RequestHandler):
+    def get(self):
+        """ Rebuild the materialized pages of the upcoming Conferences
+            feed (cron job) """
+        refreshFeed()
+        self.response.set_status(204)
+
+    def post(self):
+        """ Rebuild the materialized pages of the upcoming Conferences
+            feed after a Conference was written """
+        refreshFeed()
+        self.response.set_status(204)
+
+class RebuildRecommendationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """ Rebuild the Conference recommendation index (cron job) """
+        buildIndex()
+        self.response.set_status(204)
+
 app = webapp2.WSGIApplication([
+    ('/_ah/warmup', WarmupHandler),
+    ('/admin/startup', StartupHandler),
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/send_notifications', SendNotificationsHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
+    ('/tasks/process_registrations', ProcessRegistrationsHandler),
+    ('/crons/process_registrations', ProcessRegistrationsHandler),
+    ('/tasks/promote_waitlist', PromoteWaitlistHandler),
+    ('/tasks/notify_waitlist', NotifyWaitlistHandler),
+    ('/admin/list_modes', ListModesHandler),
+    ('/admin/cache_stats', CacheStatsHandler),
+    ('/admin/rate_limits', RateLimitsHandler),
+    ('/admin/profiles', ProfilesHandler),
+    ('/admin/mapper', MapperAdminHandler),
+    ('/tasks/mapper', MapperHandler),
+    ('/tasks/export', ExportPageHandler),
+    ('/crons/export', ExportHandler),
+    ('/admin/export', ExportAdminHandler),
+    ('/tasks/refresh_upcoming', RefreshUpcomingHandler),
+    ('/crons/refresh_upcoming', RefreshUpcomingHandler),
+    ('/crons/rebuild_recommendations', RebuildRecommendationsHandler),
     ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler),
-], debug=True)
\ No newline at end of file
+    ('/tasks/update_conference_facets', UpdateConferenceFacetsHandler),
+    ('/crons/rebuild_facets', RebuildConferenceFacetsHandler),
+], debug=True)
+
+# the application is imported; stop timing imports (see importprofile.py,
+# and the end of conference.py for the instances loading the API first)
+stopImportProfile()
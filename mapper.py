@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+"""
+mapper.py -- Udacity conference server-side Python App Engine
+    sharded mapper jobs over whole kinds on the task queue
+
+$Id$
+
+"""
+
+"""
+    A mapper job calls a Python function for every entity of a kind, e.g.
+    to backfill a property or repair a counter. Jobs are registered with
+    the mapperJob decorator (see jobs.py) and started, paused, resumed and
+    followed at /admin/mapper.
+
+    Starting a job splits the key range of the kind into shards, using a
+    sample of the __scatter__ property that the datastore keeps on a
+    random subset of entities, and stores a MapperJob with one MapperShard
+    child per range. Each shard is processed by a chain of tasks on the
+    'mapper' queue: a task reads the keys of one batch of the range in key
+    order from the shard's cursor, then checkpoints the new cursor and
+    enqueues the next task in the same transaction.
+
+    For each key, the entity is read again, the function called and what
+    it returned written in one (cross-group) transaction, so that a job
+    never overwrites a change made by a concurrent transaction, e.g. to
+    the seats of a Conference. A function that needs a query or reads of
+    other entity groups runs them in an ndb.non_transactional helper.
+
+    A task only runs if the shard's cursor is still the one it was given,
+    so a duplicate or retried task after a checkpoint does nothing. A
+    batch is processed again if its task fails before the checkpoint, so
+    job functions must be idempotent. A job whose chains stopped (paused,
+    or out of task retries) is resumed from the checkpoints.
+
+    The rate is limited twice: the 'mapper' queue (queue.yaml) bounds the
+    tasks of all jobs, and each shard waits long enough between batches to
+    stay under the job's rate in entities per second.
+"""
+
+import collections
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import MapperJob
+from models import MapperShard
+
+MAPPER_QUEUE = 'mapper'
+DEFAULT_SHARDS = 8
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_RATE = 50
+SCATTER_OVERSAMPLE = 32
+
+RUNNING = 'running'
+PAUSED = 'paused'
+DONE = 'done'
+
+MapperSpec = collections.namedtuple(
+    'MapperSpec', 'name model function shards batch_size rate')
+
+JOBS = {}
+
+
+def mapperJob(model, name=None, shards=DEFAULT_SHARDS,
+              batch_size=DEFAULT_BATCH_SIZE, rate=DEFAULT_RATE):
+    """ Registers the decorated function as a mapper job over the entities
+        of 'model', under its own name unless one is given. The function
+        is called with each entity and returns the entity (or a list of
+        entities) to store, or None to store nothing. 'rate' is the most
+        entities per second that each shard processes. Each entity is
+        read, mapped and written in a transaction of its own. """
+    def register(function):
+        job_name = name or function.__name__
+        JOBS[job_name] = MapperSpec(job_name, model, function, shards,
+                                    batch_size, rate)
+        return function
+    return register
+
+
+def _splitKeys(model, shards):
+    """ Returns the keys that split the key range of a kind into at most
+        'shards' ranges of about the same size, found from a sorted sample
+        of scattered keys. No keys (a single shard) for an empty kind. """
+    if shards <= 1:
+        return []
+    sample = model.query().order(
+        ndb.GenericProperty('__scatter__')).fetch(
+        shards * SCATTER_OVERSAMPLE, keys_only=True)
+    sample.sort(key=lambda key: key.to_old_key())
+
+    splits = []
+    step = float(len(sample)) / shards
+    for i in range(1, shards):
+        key = sample[int(i * step)] if sample else None
+        if key and (not splits or key != splits[-1]):
+            splits.append(key)
+    return splits
+
+
+def _shardTask(shard, countdown=0):
+    """ Returns the task that processes the next batch of a shard """
+    return taskqueue.Task(params={'shard': shard.key.urlsafe(),
+                                  'cursor': shard.cursor or ''},
+                          url='/tasks/mapper', countdown=countdown)
+
+
+def startJob(name):
+    """ Starts a new run of the registered job 'name' and returns the key
+        of its MapperJob. Raises KeyError for an unknown job. """
+    spec = JOBS[name]
+    bounds = [None] + _splitKeys(spec.model, spec.shards) + [None]
+
+    job = MapperJob(name=name, status=RUNNING, shardCount=len(bounds) - 1)
+    job.put()
+    shards = [MapperShard(parent=job.key, id=i + 1, index=i,
+                          startKey=bounds[i], endKey=bounds[i + 1])
+              for i in range(len(bounds) - 1)]
+    ndb.put_multi(shards)
+    taskqueue.Queue(MAPPER_QUEUE).add([_shardTask(shard) for shard in shards])
+    return job.key
+
+
+def pauseJob(job_key):
+    """ Stops the shards of a job after their current batch """
+    _setStatus(job_key, PAUSED)
+
+
+def resumeJob(job_key):
+    """ Restarts the unfinished shards of a job from their checkpoints """
+    _setStatus(job_key, RUNNING)
+    shards = MapperShard.query(ancestor=job_key).fetch()
+    tasks = [_shardTask(shard) for shard in shards if not shard.done]
+    if tasks:
+        taskqueue.Queue(MAPPER_QUEUE).add(tasks)
+
+
+@ndb.transactional()
+def _setStatus(job_key, status):
+    """ Sets the status of a job, unless it is done already """
+    job = job_key.get()
+    if job.status != DONE:
+        job.status = status
+        job.put()
+
+
+def processShard(shard_key, cursor):
+    """ Processes the next batch of a shard, provided that its checkpoint
+        is still at 'cursor' (the urlsafe cursor the task was given, empty
+        for the start of the range) and its job is running. """
+    shard, job = ndb.get_multi([shard_key, shard_key.parent()])
+    if not shard or not job or shard.done or job.status != RUNNING or \
+            (shard.cursor or '') != cursor:
+        return
+    spec = JOBS.get(job.name)
+    if not spec:
+        """ e.g. a job removed or renamed by a deployment while it ran;
+            pausing it keeps the checkpoints for a resume """
+        logging.error('Unknown mapper job %r; pausing run %s',
+                      job.name, job.key.urlsafe())
+        pauseJob(job.key)
+        return
+
+    model = spec.model
+    q = model.query()
+    if shard.startKey:
+        q = q.filter(model.key >= shard.startKey)
+    if shard.endKey:
+        q = q.filter(model.key < shard.endKey)
+    q = q.order(model.key)
+    keys, next_cursor, more = q.fetch_page(
+        spec.batch_size, keys_only=True,
+        start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+    written = sum(ndb.transaction(lambda: _mapKey(spec.function, key),
+                                  xg=True)
+                  for key in keys)
+
+    next_cursor = next_cursor.urlsafe() if more and next_cursor else None
+    if not _checkpoint(shard_key, cursor, next_cursor, len(keys),
+                       written, float(len(keys)) / spec.rate):
+        logging.warning('Mapper shard %s moved on while processing batch',
+                        shard_key)
+    elif not next_cursor:
+        _finishJob(shard_key.parent())
+
+
+def _mapKey(function, key):
+    """ Calls a job function with the entity of a key as it is now and
+        stores what it returned, within the caller's transaction. Returns
+        the number of entities written (none for an entity deleted since
+        the query). """
+    entity = key.get()
+    if entity is None:
+        return 0
+    result = function(entity)
+    if isinstance(result, (list, tuple)):
+        changed = list(result)
+    else:
+        changed = [result] if result is not None else []
+    ndb.put_multi(changed)
+    return len(changed)
+
+
+@ndb.transactional()
+def _checkpoint(shard_key, cursor, next_cursor, processed, written,
+                countdown):
+    """ Records a processed batch and enqueues the task for the next one
+        (if any) when the transaction commits. Returns False if another
+        task checkpointed the shard in the meantime. """
+    shard = shard_key.get()
+    if (shard.cursor or '') != cursor:
+        return False
+    shard.processed += processed
+    shard.written += written
+    if next_cursor:
+        shard.cursor = next_cursor
+        taskqueue.Queue(MAPPER_QUEUE).add(_shardTask(shard, countdown),
+                                          transactional=True)
+    else:
+        shard.done = True
+    shard.put()
+    return True
+
+
+def _finishJob(job_key):
+    """ Marks a job as done once all of its shards are """
+    shards = MapperShard.query(ancestor=job_key).fetch()
+    if all(shard.done for shard in shards):
+        _setStatus(job_key, DONE)
+        logging.info('Mapper job %s done: %d entities, %d written',
+                     job_key.id(), sum(shard.processed for shard in shards),
+                     sum(shard.written for shard in shards))
+
+
+def jobProgress(job):
+    """ Returns the progress of a MapperJob as a dictionary """
+    shards = MapperShard.query(ancestor=job.key).fetch()
+    return {
+        'id': job.key.urlsafe(),
+        'name': job.name,
+        'status': job.status,
+        'created': str(job.created),
+        'processed': sum(shard.processed for shard in shards),
+        'written': sum(shard.written for shard in shards),
+        'shards': [{'index': shard.index,
+                    'processed': shard.processed,
+                    'written': shard.written,
+                    'done': shard.done}
+                   for shard in sorted(shards, key=lambda s: s.index)],
+    }
+
+
+def recentJobs(limit=20):
+    """ Returns the progress of the most recent job runs """
+    return [jobProgress(job) for job in
+            MapperJob.query().order(-MapperJob.created).fetch(limit)]
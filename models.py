@@ -48,10 +48,13 @@ created/forked from conferences.py by wesc on 2014 may 24
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 import httplib
+import unicodedata
 import endpoints
 from protorpc import messages
 from google.appengine.ext import ndb
 
+from keys import KeyPathProperty
+
 class Session(ndb.Model):
     """Session Object - represents a specific session of a Conference"""
     sessionName     = ndb.StringProperty(required=True)
@@ -66,6 +69,16 @@ class Session(ndb.Model):
     # between 00 and 59.
     startTime       = ndb.TimeProperty()
     speakerKey      = ndb.StringProperty()
+    # startMinute is startTime as minutes since midnight and startSortKey
+    # combines date and startTime into one number (minutes since 0001-01-01),
+    # so that time-of-day and date/time windows are plain integer ranges
+    # over a single index. Both are None if the parts they need are.
+    startMinute     = ndb.ComputedProperty(
+        lambda self: self.startTime.hour * 60 + self.startTime.minute
+        if self.startTime else None)
+    startSortKey    = ndb.ComputedProperty(
+        lambda self: self.date.toordinal() * 1440 + self.startMinute
+        if self.date and self.startTime else None)
 
 
 class SessionForm(messages.Message):
@@ -82,10 +95,35 @@ class SessionForm(messages.Message):
     startTime       = messages.StringField(7)
     conferenceKey   = messages.StringField(8)
     speakerKey      = messages.StringField(9)
+    sessionKey      = messages.StringField(10)
 
 class SessionForms(messages.Message):
     """SessionForms -- multiple Session outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+class WishlistUpdateForm(messages.Message):
+    """WishlistUpdateForm -- websafe Session keys to add to and remove from
+    the wishlist at once"""
+    add = messages.StringField(1, repeated=True)
+    remove = messages.StringField(2, repeated=True)
+
+class WishlistForm(messages.Message):
+    """WishlistForm -- the wishlist after an update, with the number of
+    Sessions actually added and removed"""
+    sessionKeys = messages.StringField(1, repeated=True)
+    added = messages.IntegerField(2)
+    removed = messages.IntegerField(3)
+
+class OverlapGroupForm(messages.Message):
+    """OverlapGroupForm -- Sessions of an itinerary whose times overlap"""
+    sessionKeys = messages.StringField(1, repeated=True)
+
+class ItineraryForm(messages.Message):
+    """ItineraryForm -- the wishlisted Sessions in date and start time order,
+    with the groups of overlapping ones"""
+    sessions = messages.MessageField(SessionForm, 1, repeated=True)
+    overlaps = messages.MessageField(OverlapGroupForm, 2, repeated=True)
 
 class SessionQueryForm(messages.Message):
     field = messages.StringField(1)
@@ -94,6 +132,7 @@ class SessionQueryForm(messages.Message):
 
 class SessionQueryForms(messages.Message):
     filters = messages.MessageField(SessionQueryForm, 1, repeated=True)
+    fields = messages.StringField(2, repeated=True)
 
 class SpeakerForm(messages.Message):
     """SpeakerForm -- Speaker outbound form message"""
@@ -106,10 +145,23 @@ class Speaker(ndb.Model):
     """Speaker -- Speaker object"""
     displayName = ndb.StringProperty(required=True)
     biography = ndb.StringProperty()
+    # sortName is the normalized displayName that the speaker directory is
+    # ordered and prefix-matched on (see normalizeName)
+    sortName = ndb.ComputedProperty(
+        lambda self: Speaker.normalizeName(self.displayName))
+
+    @staticmethod
+    def normalizeName(name):
+        """ Returns a name in lower case, without accents and with single
+            spaces, so that e.g. u'  \xc9mile Zola' sorts as u'emile zola'. """
+        name = unicodedata.normalize('NFKD', unicode(name or u''))
+        name = u''.join(c for c in name if not unicodedata.combining(c))
+        return u' '.join(name.lower().split())
 
 class SpeakerForms(messages.Message):
     """SpeakerForm -- multiple Speaker outbound form message"""
     items = messages.MessageField(SpeakerForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 
 class FeaturedSpeakerSession(messages.Message):
@@ -125,13 +177,22 @@ class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
     http_status = httplib.CONFLICT
 
+class RateLimitExceededException(endpoints.ServiceException):
+    """RateLimitExceededException -- exception mapped to HTTP 403 response.
+    Endpoints turns a 429 into a 404, so, like Google's APIs, a call over
+    its rate limit is refused as forbidden, saying so in the message"""
+    http_status = httplib.FORBIDDEN
+
 class Profile(ndb.Model):
     """Profile -- User profile object"""
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
-    conferenceKeysToAttend = ndb.StringProperty(repeated=True)
-    sessionKeysWishList = ndb.StringProperty(repeated=True)
+    # websafe keys, stored compactly (see keys.py)
+    conferenceKeysToAttend = KeyPathProperty(('Profile', 'Conference'),
+                                             repeated=True)
+    sessionKeysWishList = KeyPathProperty(('Profile', 'Conference', 'Session'),
+                                          repeated=True)
 
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
@@ -155,17 +216,27 @@ class BooleanMessage(messages.Message):
 
 class Conference(ndb.Model):
     """Conference -- Conference object"""
+    # Only properties that are filtered on are indexed. Queries are served
+    # by merge joins over the built-in single-property indexes (see
+    # _executeConferenceQuery in conference.py), so no composite
+    # Conference indexes are needed apart from the one backing the browse
+    # list projection. Run index_cost.py after changing this.
     name                = ndb.StringProperty(required=True)
-    description         = ndb.StringProperty()
-    organizerUserId     = ndb.StringProperty()
+    description         = ndb.StringProperty(indexed=False)
+    organizerUserId     = ndb.StringProperty(indexed=False)
     topics              = ndb.StringProperty(repeated=True)
     city                = ndb.StringProperty()
     startDate           = ndb.DateProperty()
     month               = ndb.IntegerProperty()
-    endDate             = ndb.DateProperty()
+    endDate             = ndb.DateProperty(indexed=False)
     maxAttendees        = ndb.IntegerProperty()
     seatsAvailable      = ndb.IntegerProperty()
 
+class ConferenceAlias(ndb.Model):
+    """ConferenceAlias -- maps the id of a Conference (unique across
+    Conferences, see keys.py) to its key"""
+    conference      = ndb.KeyProperty(indexed=False)
+
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
     name            = messages.StringField(1)
@@ -180,10 +251,23 @@ class ConferenceForm(messages.Message):
     endDate         = messages.StringField(10) #DateTimeField()
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    conferenceId    = messages.StringField(13)
+
+class ConferenceDetailForm(messages.Message):
+    """ConferenceDetailForm -- everything the Conference detail page shows.
+    The user's fields are left empty when nobody is logged in"""
+    conference = messages.MessageField(ConferenceForm, 1)
+    sessions = messages.MessageField(SessionForm, 2, repeated=True)
+    featuredSpeaker = messages.MessageField(FeaturedSpeakerData, 3)
+    isAttending = messages.BooleanField(4)
+    registrationState = messages.EnumField('RegistrationState', 5)
+    waitlistPosition = messages.IntegerField(6)
+    sessionKeysInWishlist = messages.StringField(7, repeated=True)
 
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
@@ -203,6 +287,55 @@ class TeeShirtSize(messages.Enum):
     XXXL_M = 14
     XXXL_W = 15
 
+class RegistrationState(messages.Enum):
+    """RegistrationState -- outcome of a queued registration request"""
+    NOT_QUEUED = 1
+    PENDING = 2
+    REGISTERED = 3
+    ALREADY_REGISTERED = 4
+    SOLD_OUT = 5
+    FAILED = 6
+
+class RegistrationStatus(ndb.Model):
+    """RegistrationStatus -- state of a user's queued registration request;
+    child of the user's Profile, with the websafe Conference key as id"""
+    state           = ndb.StringProperty(indexed=False)
+    updated         = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class RegistrationStatusForm(messages.Message):
+    """RegistrationStatusForm -- queued registration outbound form message"""
+    websafeConferenceKey = messages.StringField(1)
+    state = messages.EnumField('RegistrationState', 2)
+
+class WaitlistEntry(ndb.Model):
+    """WaitlistEntry -- a user waiting for a seat at a sold out Conference;
+    child of the user's Profile, with the websafe Conference key as id"""
+    conferenceKey   = ndb.StringProperty()
+    joined          = ndb.DateTimeProperty(auto_now_add=True)
+
+class WaitlistForm(messages.Message):
+    """WaitlistForm -- waitlist position outbound form message"""
+    websafeConferenceKey = messages.StringField(1)
+    position = messages.IntegerField(2)
+
+class ConferenceFacetShard(ndb.Model):
+    """ConferenceFacetShard -- one shard of the number of Conferences sharing
+    one field value (see facets.py)"""
+    field           = ndb.StringProperty(indexed=False)
+    value           = ndb.StringProperty(indexed=False)
+    count           = ndb.IntegerProperty(indexed=False)
+
+class FacetCountForm(messages.Message):
+    """FacetCountForm -- number of Conferences sharing one field value"""
+    field = messages.StringField(1)
+    value = messages.StringField(2)
+    count = messages.IntegerField(3)
+    capped = messages.BooleanField(4)
+
+class FacetCountForms(messages.Message):
+    """FacetCountForms -- multiple FacetCountForm outbound form message"""
+    items = messages.MessageField(FacetCountForm, 1, repeated=True)
+
 class ConferenceQueryForm(messages.Message):
     """ConferenceQueryForm -- Conference query inbound form message"""
     field = messages.StringField(1)
@@ -212,4 +345,76 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
-
+    fields = messages.StringField(2, repeated=True)
+
+
+class BatchRequestItem(messages.Message):
+    """BatchRequestItem -- one call within a batch: the name of a
+    ConferenceApi method and its request message as JSON"""
+    method = messages.StringField(1, required=True)
+    body = messages.StringField(2)
+
+class BatchRequestForm(messages.Message):
+    """BatchRequestForm -- batch inbound form message"""
+    items = messages.MessageField(BatchRequestItem, 1, repeated=True)
+
+class BatchResponseItem(messages.Message):
+    """BatchResponseItem -- the result of one call within a batch: its
+    response message as JSON, or the HTTP status and message of its error"""
+    method = messages.StringField(1)
+    body = messages.StringField(2)
+    errorCode = messages.IntegerField(3)
+    errorMessage = messages.StringField(4)
+
+class BatchResponseForm(messages.Message):
+    """BatchResponseForm -- batch outbound form message, in request order"""
+    items = messages.MessageField(BatchResponseItem, 1, repeated=True)
+
+class MapperJob(ndb.Model):
+    """MapperJob -- one run of a mapper job over a kind (see mapper.py)"""
+    name            = ndb.StringProperty()
+    status          = ndb.StringProperty()
+    shardCount      = ndb.IntegerProperty(indexed=False)
+    created         = ndb.DateTimeProperty(auto_now_add=True)
+    updated         = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class MapperShard(ndb.Model):
+    """MapperShard -- the key range of one shard of a MapperJob (its parent)
+    and the checkpoint of its progress through it"""
+    index           = ndb.IntegerProperty()
+    startKey        = ndb.KeyProperty(indexed=False)
+    endKey          = ndb.KeyProperty(indexed=False)
+    cursor          = ndb.StringProperty(indexed=False)
+    processed       = ndb.IntegerProperty(default=0, indexed=False)
+    written         = ndb.IntegerProperty(default=0, indexed=False)
+    done            = ndb.BooleanProperty(default=False)
+    updated         = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class ExportRun(ndb.Model):
+    """ExportRun -- one bulk export of the data to files (see export.py)"""
+    format          = ndb.StringProperty(indexed=False)
+    status          = ndb.StringProperty(indexed=False)
+    created         = ndb.DateTimeProperty(auto_now_add=True)
+
+class ExportKind(ndb.Model):
+    """ExportKind -- the export of one kind within an ExportRun (its parent),
+    with the checkpoint of its progress and the files written so far"""
+    cursor          = ndb.StringProperty(indexed=False)
+    part            = ndb.IntegerProperty(default=0, indexed=False)
+    rows            = ndb.IntegerProperty(default=0, indexed=False)
+    files           = ndb.StringProperty(repeated=True, indexed=False)
+    done            = ndb.BooleanProperty(default=False, indexed=False)
+
+class RecommendationIndex(ndb.Model):
+    """RecommendationIndex -- the current version of the Conference
+    recommendation index and the number of chunks it is stored in (see
+    recommend.py)"""
+    version         = ndb.IntegerProperty(indexed=False)
+    chunks          = ndb.IntegerProperty(indexed=False)
+    conferences     = ndb.IntegerProperty(indexed=False)
+    built           = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class RecommendationChunk(ndb.Model):
+    """RecommendationChunk -- a piece of a pickled recommendation index,
+    a child of the RecommendationIndex"""
+    data            = ndb.BlobProperty()
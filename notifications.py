@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+"""
+notifications.py -- Udacity conference server-side Python App Engine
+    batched delivery of notification emails through a pull queue
+
+$Id$
+
+"""
+
+"""
+    Rather than one push task (and one mail.send_mail call) per email,
+    notifications are added to the 'notifications' pull queue as small
+    tasks, tagged with the kind of notification, whose payload is just a
+    websafe Conference key (plus a user id for waitlist promotions). The
+    cron job at /crons/send_notifications leases them in batches per tag,
+    groups the messages by recipient so that each person gets a single
+    email per batch, and sends the emails with a bounded number of
+    concurrent threads.
+
+    Tasks are only deleted once their email has gone out. A failed email
+    leaves its tasks leased for a growing back-off period, after which
+    they are leased again (which counts as a retry); after
+    MAX_NOTIFICATION_RETRIES retries they are dropped and logged.
+
+    Push tasks of /tasks/send_confirmation_email, which sent one email
+    each, may still be queued from before the pull queue; they carry the
+    text of the email rather than a Conference key, and are sent as they
+    come by sendConfirmationEmail().
+"""
+
+import collections
+import logging
+import threading
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from keys import decodeKey
+
+NOTIFICATION_QUEUE = 'notifications'
+CONFIRMATION_TAG = 'conference_created'
+WAITLIST_TAG = 'waitlist_promoted'
+
+LEASE_SECONDS = 60
+LEASE_BATCH_SIZE = 100
+MAX_BATCHES_PER_RUN = 10
+MAX_CONCURRENT_SENDS = 5
+MAX_NOTIFICATION_RETRIES = 5
+MAX_BACKOFF_SECONDS = 3600
+
+
+def confirmationTask(c_key):
+    """ Returns the pull task asking for a confirmation email for the
+        Conference with key c_key. """
+    return taskqueue.Task(payload=c_key.urlsafe(), method='PULL',
+                          tag=CONFIRMATION_TAG)
+
+
+def waitlistTasks(wsck, user_ids):
+    """ Returns the pull tasks telling users that they were registered for
+        a Conference from its waitlist. """
+    return [taskqueue.Task(payload='%s %s' % (wsck, user_id), method='PULL',
+                           tag=WAITLIST_TAG)
+            for user_id in user_ids]
+
+
+def sendConfirmationEmail(recipient, conferenceInfo):
+    """ Sends the confirmation email of a push task queued before the
+        notifications pull queue """
+    mail.send_mail(
+        'noreply@%s.appspotmail.com' % (app_identity.get_application_id()),
+        recipient, 'You created a new Conference!',
+        'Hi, you have created a following conference:\r\n\r\n%s' % (
+            conferenceInfo))
+
+
+def _formatConference(conf):
+    """ Returns the text describing a Conference in an email """
+    lines = ['  %s' % conf.name]
+    if conf.city:
+        lines.append('    City: %s' % conf.city)
+    if conf.topics:
+        lines.append('    Topics: %s' % ', '.join(conf.topics))
+    if conf.startDate:
+        lines.append('    Dates: %s - %s' % (conf.startDate,
+                                              conf.endDate or ''))
+    if conf.maxAttendees:
+        lines.append('    Max attendees: %d' % conf.maxAttendees)
+    return '\r\n'.join(lines)
+
+
+def _confirmationMessages(tasks):
+    """ Groups leased confirmation tasks by recipient. Returns a list of
+        (recipient, subject, body, tasks) tuples. Tasks whose Conference
+        no longer exists (nothing to confirm) are left out. """
+    c_keys = [ndb.Key(urlsafe=task.payload) for task in tasks]
+    conferences = ndb.get_multi(c_keys)
+    profiles = ndb.get_multi(set(c_key.parent() for c_key in c_keys))
+    emails = dict((prof.key, prof.mainEmail) for prof in profiles if prof)
+
+    items = []
+    for task, c_key, conf in zip(tasks, c_keys, conferences):
+        if not conf:
+            continue
+        """ user ids are email addresses (see getUserId), so the id of
+            the parent Profile is the organizer's address when the
+            organizer has not stored a Profile yet """
+        recipient = emails.get(c_key.parent()) or c_key.parent().id()
+        items.append((recipient, task, conf))
+    return _groupMessages(
+        items, 'You created a new Conference!',
+        'You created %d new Conferences!',
+        'Hi, you have created the following conference(s):')
+
+
+def _groupMessages(items, subject, subjectMany, intro):
+    """ Turns (recipient, task, conf) items into a list of
+        (recipient, subject, body, tasks) tuples, one per recipient. """
+    grouped = collections.OrderedDict()
+    for recipient, task, conf in items:
+        grouped.setdefault(recipient, []).append((task, conf))
+
+    messages = []
+    for recipient, pairs in grouped.items():
+        body = '%s\r\n\r\n%s' % (intro, '\r\n\r\n'.join(
+            _formatConference(conf) for task, conf in pairs))
+        messages.append((recipient,
+                         subject if len(pairs) == 1
+                         else subjectMany % len(pairs),
+                         body, [task for task, conf in pairs]))
+    return messages
+
+
+def _waitlistMessages(tasks):
+    """ Groups leased waitlist promotion tasks by recipient, like
+        _confirmationMessages. """
+    pairs = [task.payload.split(' ', 1) for task in tasks]
+    conferences = ndb.get_multi([decodeKey(wsck)
+                                 for wsck, user_id in pairs])
+    profiles = ndb.get_multi([ndb.Key('Profile', user_id)
+                              for wsck, user_id in pairs])
+
+    items = [(prof.mainEmail or prof.key.id(), task, conf)
+             for task, conf, prof in zip(tasks, conferences, profiles)
+             if conf and prof]
+    return _groupMessages(
+        items, 'You are registered for a Conference!',
+        'You are registered for %d Conferences!',
+        'Hi, a seat became available and you are now registered for the '
+        'following conference(s):')
+
+
+def _sendAll(messages):
+    """ Sends the (recipient, subject, body, tasks) messages using at most
+        MAX_CONCURRENT_SENDS threads. Returns the messages that failed. """
+    sender = 'noreply@%s.appspotmail.com' % (
+        app_identity.get_application_id())
+    pending = collections.deque(messages)
+    failed = []
+
+    def worker():
+        while True:
+            try:
+                message = pending.popleft()
+            except IndexError:
+                return
+            recipient, subject, body, tasks = message
+            try:
+                mail.send_mail(sender, recipient, subject, body)
+            except Exception:
+                logging.exception('Failed to send email to %s', recipient)
+                failed.append(message)
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(MAX_CONCURRENT_SENDS, len(messages)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failed
+
+
+def _retryLater(queue, tasks):
+    """ Keeps failed tasks leased for a back-off period that doubles with
+        every retry, or drops them once they have been retried too often.
+        Returns the tasks to delete. """
+    drop = []
+    for task in tasks:
+        if task.retry_count >= MAX_NOTIFICATION_RETRIES:
+            logging.error('Dropping notification %s after %d retries',
+                          task.payload, task.retry_count)
+            drop.append(task)
+        else:
+            queue.modify_task_lease(task, min(
+                LEASE_SECONDS * 2 ** task.retry_count, MAX_BACKOFF_SECONDS))
+    return drop
+
+
+def sendNotifications():
+    """ Leases and delivers pending notification emails, one batch of a
+        single kind at a time, until the queue is empty or
+        MAX_BATCHES_PER_RUN batches have been handled. Returns the number
+        of emails sent. """
+    queue = taskqueue.Queue(NOTIFICATION_QUEUE)
+    sent = 0
+    for batch in range(MAX_BATCHES_PER_RUN):
+        # without a tag, the batch shares the tag of the oldest task
+        tasks = queue.lease_tasks_by_tag(LEASE_SECONDS, LEASE_BATCH_SIZE)
+        if not tasks:
+            break
+
+        messages = MESSAGE_BUILDERS[tasks[0].tag](tasks)
+        failed = _sendAll(messages)
+
+        # every task that is not part of a failed email is done with
+        failed_tasks = [task for message in failed for task in message[3]]
+        failed_names = set(task.name for task in failed_tasks)
+        done = [task for task in tasks if task.name not in failed_names]
+        done.extend(_retryLater(queue, failed_tasks))
+
+        queue.delete_tasks(done)
+        sent += len(messages) - len(failed)
+    return sent
+
+
+""" Builds the emails for the leased tasks of each kind of notification """
+MESSAGE_BUILDERS = {
+    CONFIRMATION_TAG: _confirmationMessages,
+    WAITLIST_TAG: _waitlistMessages,
+}
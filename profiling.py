@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+"""
+profiling.py -- Udacity conference server-side Python App Engine
+    on-demand cProfile captures of single API requests
+
+$Id$
+
+"""
+
+"""
+    The API server is wrapped by profiledApp(), which runs a request
+    under cProfile when either
+
+        - it carries the PROFILE_HEADER with the current profiling token,
+          which an admin creates at /admin/profiles (POST token=new) and
+          which expires after TOKEN_SECONDS, or
+        - it is sampled, at the rate set at /admin/profiles (POST
+          sampleRate=<0..1>).
+
+    Both are read from Memcache at most every SETTINGS_REFRESH_SECONDS,
+    like the list modes (see listmode.py). With no token and a rate of 0,
+    the wrapper hands the request straight to the API server, so requests
+    pay nothing for it.
+
+    A capture holds the pstats data of the request (what pstats.Stats
+    loads, zlib compressed), a text summary of its slowest functions and
+    the timeline of its datastore RPCs (call, start and end in
+    milliseconds from the start of the request), recorded by API proxy
+    hooks installed with the first capture of the instance. Captures are
+    kept in Memcache in a ring of RING_SIZE slots, so the newest ones
+    replace the oldest. /admin/profiles lists them, and
+    /admin/profiles?id=<id> downloads one (format=pstats or json).
+"""
+
+import cProfile
+import logging
+import marshal
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+import zlib
+
+from cStringIO import StringIO
+from datetime import datetime
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+PROFILE_HEADER = 'X-Profile-Token'
+RING_SIZE = 20
+TOKEN_SECONDS = 3600
+SUMMARY_LINES = 40
+MEMCACHE_PROFILE_RATE_KEY = "PROFILE_SAMPLE_RATE"
+MEMCACHE_PROFILE_TOKEN_KEY = "PROFILE_TOKEN"
+MEMCACHE_PROFILE_COUNTER_KEY = "PROFILE_COUNTER"
+MEMCACHE_PROFILE_SLOT_KEY = "PROFILE_SLOT_%d"
+
+# run-time settings are re-read from Memcache at most this often
+SETTINGS_REFRESH_SECONDS = 30
+_settings = {'expires': 0}
+
+_local = threading.local()
+_hooksLock = threading.Lock()
+_hooksInstalled = False
+
+
+def profileSettings():
+    """ Returns the sample rate and the token of the profiling settings """
+    if _settings['expires'] < time.time():
+        values = memcache.get_multi([MEMCACHE_PROFILE_RATE_KEY,
+                                     MEMCACHE_PROFILE_TOKEN_KEY])
+        _settings.update(
+            sampleRate=values.get(MEMCACHE_PROFILE_RATE_KEY, 0.0),
+            token=values.get(MEMCACHE_PROFILE_TOKEN_KEY),
+            expires=time.time() + SETTINGS_REFRESH_SECONDS)
+    return _settings['sampleRate'], _settings['token']
+
+
+def setSampleRate(rate):
+    """ Sets the share of API requests profiled on every instance (within
+        SETTINGS_REFRESH_SECONDS). A rate of 0 stops sampling. """
+    if not 0 <= rate <= 1:
+        raise ValueError('The sample rate must be between 0 and 1')
+    if rate:
+        memcache.set(MEMCACHE_PROFILE_RATE_KEY, rate)
+    else:
+        memcache.delete(MEMCACHE_PROFILE_RATE_KEY)
+    _settings['expires'] = 0
+
+
+def newToken():
+    """ Creates a new profiling token, valid for TOKEN_SECONDS, and
+        returns it """
+    token = uuid.uuid4().hex
+    memcache.set(MEMCACHE_PROFILE_TOKEN_KEY, token, time=TOKEN_SECONDS)
+    _settings['expires'] = 0
+    return token
+
+
+def revokeToken():
+    """ Revokes the profiling token """
+    memcache.delete(MEMCACHE_PROFILE_TOKEN_KEY)
+    _settings['expires'] = 0
+
+
+def _preCall(service, call, request, response, rpc):
+    """ API proxy hook starting the timeline entry of a datastore RPC """
+    timeline = getattr(_local, 'timeline', None)
+    if timeline is not None:
+        _local.pending[id(response)] = len(timeline)
+        timeline.append({'call': call,
+                         'startMs': _elapsedMs(), 'endMs': None})
+
+
+def _postCall(service, call, request, response, rpc, error):
+    """ API proxy hook ending the timeline entry of a datastore RPC """
+    timeline = getattr(_local, 'timeline', None)
+    if timeline is not None:
+        entry = _local.pending.pop(id(response), None)
+        if entry is not None:
+            timeline[entry]['endMs'] = _elapsedMs()
+            if error is not None:
+                timeline[entry]['error'] = repr(error)
+
+
+def _elapsedMs():
+    return round((time.time() - _local.started) * 1000, 1)
+
+
+def _installHooks():
+    """ Installs the datastore RPC hooks, once per instance """
+    global _hooksInstalled
+    with _hooksLock:
+        if not _hooksInstalled:
+            apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+                'profiling_pre', _preCall, 'datastore_v3')
+            apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+                'profiling_post', _postCall, 'datastore_v3')
+            _hooksInstalled = True
+
+
+def _capture(app, environ, start_response, trigger):
+    """ Runs a request under cProfile and stores its capture """
+    _installHooks()
+    profile = cProfile.Profile()
+    _local.started = time.time()
+    _local.pending = {}
+    _local.timeline = []
+    try:
+        return profile.runcall(app, environ, start_response)
+    finally:
+        wall = time.time() - _local.started
+        timeline = _local.timeline
+        _local.timeline = None
+        try:
+            _store(profile, environ, trigger, wall, timeline)
+        except Exception:
+            logging.exception('Could not store the profile of %s',
+                              environ.get('PATH_INFO'))
+
+
+def _store(profile, environ, trigger, wall, timeline):
+    """ Stores a capture in the next slot of the ring """
+    stats = pstats.Stats(profile)
+    summary = StringIO()
+    stats.stream = summary
+    stats.sort_stats('cumulative').print_stats(SUMMARY_LINES)
+
+    capture_id = memcache.incr(MEMCACHE_PROFILE_COUNTER_KEY, initial_value=0)
+    if capture_id is None:
+        return
+    datastore_ms = sum(entry['endMs'] - entry['startMs']
+                       for entry in timeline if entry['endMs'] is not None)
+    capture = {
+        'id': capture_id,
+        'path': environ.get('PATH_INFO'),
+        'trigger': trigger,
+        'instance': os.environ.get('INSTANCE_ID'),
+        'started': datetime.utcnow().isoformat(),
+        'wallMs': round(wall * 1000, 1),
+        'rpcs': len(timeline),
+        'datastoreMs': round(datastore_ms, 1),
+        'timeline': timeline,
+        'summary': summary.getvalue(),
+        'pstats': zlib.compress(marshal.dumps(stats.stats)),
+    }
+    try:
+        memcache.set(MEMCACHE_PROFILE_SLOT_KEY % (capture_id % RING_SIZE),
+                     capture)
+    except ValueError:
+        logging.warning('Profile of %s too large to keep', capture['path'])
+
+
+def profiledApp(app):
+    """ Wraps a WSGI application so that its requests are profiled when
+        asked for by header or sampled (see above) """
+    header = 'HTTP_' + PROFILE_HEADER.upper().replace('-', '_')
+
+    def wrapper(environ, start_response):
+        rate, token = profileSettings()
+        if not rate and not token:
+            return app(environ, start_response)
+        if token and environ.get(header) == token:
+            return _capture(app, environ, start_response, 'header')
+        if rate and random.random() < rate:
+            return _capture(app, environ, start_response, 'sampled')
+        return app(environ, start_response)
+    return wrapper
+
+
+def captures():
+    """ Returns the captures in the ring, newest first, without their
+        pstats data, summary and timeline """
+    slots = memcache.get_multi(
+        [MEMCACHE_PROFILE_SLOT_KEY % i for i in range(RING_SIZE)])
+    listed = []
+    for capture in slots.values():
+        capture = dict(capture)
+        for name in ('pstats', 'summary', 'timeline'):
+            del capture[name]
+        listed.append(capture)
+    return sorted(listed, key=lambda capture: -capture['id'])
+
+
+def getCapture(capture_id):
+    """ Returns a capture, with its pstats data uncompressed, or None if
+        it was replaced or evicted """
+    capture = memcache.get(MEMCACHE_PROFILE_SLOT_KEY % (capture_id % RING_SIZE))
+    if not capture or capture['id'] != capture_id:
+        return None
+    capture['pstats'] = zlib.decompress(capture['pstats'])
+    return capture
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""
+projection.py -- Udacity conference server-side Python App Engine
+    field selection and projection queries for list endpoints
+
+$Id$
+
+"""
+
+"""
+    List endpoints accept a 'fields' selector: the names of the fields of
+    the response form that the client wants. An empty selector means all
+    fields. Unrequested fields are simply not copied to the response.
+
+    When every requested field that is a stored property is part of one
+    of the projections allowed for the endpoint (LIST_PROJECTIONS in
+    constants.py), the query is run as a projection query, which reads
+    those properties from an index instead of reading whole entities.
+    The projection always covers the whole tuple, because a projection
+    query needs an index matching its properties exactly; each tuple is
+    backed by an index in index.yaml (a single property needs none).
+
+    Properties that change often, such as the seats of a Conference, are
+    kept out of the projections, so that changing them costs no composite
+    index write. Selecting one of them runs the regular query instead,
+    which reads the entities through the ndb cache; a projection followed
+    by a read of the same entities by key would cost more than that.
+
+    Fields that are not stored properties (e.g. websafeKey) are derived
+    from the key, which a projection query returns as well. Only indexed,
+    non-repeated properties can be projected, and entities that lack a
+    projected property are not returned by the projection query, so the
+    tuples only hold properties that every entity of the kind has.
+"""
+
+
+def selectFields(form, names):
+    """ Returns the set of the names of the fields of a response form
+        that a 'fields' selector asks for, or None for all fields.
+        Raises ValueError for names the form does not have. """
+    if not names:
+        return None
+    known = set(field.name for field in form.all_fields())
+    unknown = [name for name in names if name not in known]
+    if unknown:
+        raise ValueError('Unknown field(s): %s' % ', '.join(unknown))
+    return set(names)
+
+
+def projectionFor(model, fields, projections):
+    """ Returns the properties to project a query of 'model' on to produce
+        the selected fields, or None if whole entities are needed: when
+        all fields are selected, or when a selected stored property is
+        not in any of the allowed projections. """
+    if fields is None:
+        return None
+    stored = set(name for name in fields if name in model._properties)
+    for projection in projections:
+        if stored.issubset(projection):
+            return list(projection)
+    return None
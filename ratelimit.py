@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""
+ratelimit.py -- Udacity conference server-side Python App Engine
+    per-user, per-endpoint rate limits with Memcache token buckets
+
+$Id$
+
+"""
+
+"""
+    Every user (or, without one, every client address) has a bucket of
+    tokens per rate limited endpoint: RATE_LIMITS gives the size of the
+    bucket and the number of seconds it takes an empty bucket to fill up
+    again, at a steady rate. A call takes a token; a call finding less
+    than one token in the bucket is refused (with a 403, since Endpoints
+    does not pass a 429 through) before it does any other work, telling
+    the client how many seconds remain until the next token.
+
+    A bucket is a Memcache value of the tokens it held and the time they
+    were counted. A call adds the tokens refilled since then and stores
+    the new level with compare-and-set, retrying when another call changed
+    it in between, so concurrent calls on any instance never take more
+    tokens than there are. A bucket untouched long enough to be full
+    again expires. If Memcache is unavailable, or the bucket stays
+    contended, calls are let through.
+
+    The limits are overridable at run time through /admin/rate_limits,
+    like the list modes (see listmode.py), and refused calls are counted
+    per endpoint.
+"""
+
+import functools
+import logging
+import math
+import os
+import time
+
+import endpoints
+
+from google.appengine.api import memcache
+
+from models import RateLimitExceededException
+from utils import getUserId
+
+""" endpoint -> (tokens, seconds to refill) of each user's bucket """
+RATE_LIMITS = {
+    'queryConferences': (60, 60),
+    'querySessions': (60, 60),
+    'queryProblem': (20, 60),
+    'registerForConference': (10, 60),
+    'unregisterFromConference': (10, 60),
+    'queueRegistrationForConference': (10, 60),
+}
+
+MEMCACHE_BUCKET_KEY = "RATE_BUCKET_%s_%s"
+CAS_RETRIES = 3
+MEMCACHE_RATE_LIMIT_KEY = "RATE_LIMIT_%s"
+MEMCACHE_THROTTLED_PREFIX = "RATE_THROTTLED_"
+
+# run-time overrides are re-read from Memcache at most this often
+LIMIT_REFRESH_SECONDS = 30
+_limits = {}
+
+
+def rateLimit(endpoint):
+    """ Returns the (tokens, seconds) limit of an endpoint, or None """
+    limit, expires = _limits.get(endpoint, (None, 0))
+    if expires < time.time():
+        limit = memcache.get(MEMCACHE_RATE_LIMIT_KEY % endpoint) or \
+            RATE_LIMITS.get(endpoint)
+        _limits[endpoint] = (limit, time.time() + LIMIT_REFRESH_SECONDS)
+    return limit
+
+
+def setRateLimit(endpoint, tokens=None, seconds=None):
+    """ Overrides the limit of an endpoint on every instance (within
+        LIMIT_REFRESH_SECONDS). Without tokens, restores the default. """
+    if endpoint not in RATE_LIMITS:
+        raise ValueError('Not a rate limited endpoint: %s' % endpoint)
+    if tokens is None:
+        memcache.delete(MEMCACHE_RATE_LIMIT_KEY % endpoint)
+    elif tokens > 0 and seconds > 0:
+        memcache.set(MEMCACHE_RATE_LIMIT_KEY % endpoint, (tokens, seconds))
+    else:
+        raise ValueError('Tokens and seconds must be positive')
+    _limits.pop(endpoint, None)
+
+
+def takeToken(endpoint, client):
+    """ Takes a token from a client's bucket for an endpoint. Returns 0 if
+        there was one, else the number of seconds until there is. """
+    limit = rateLimit(endpoint)
+    if not limit:
+        return 0
+    tokens, seconds = limit
+    rate = float(tokens) / seconds
+    key = MEMCACHE_BUCKET_KEY % (endpoint, client)
+    cache = memcache.Client()
+
+    for attempt in range(CAS_RETRIES):
+        now = time.time()
+        bucket = cache.gets(key)
+        if bucket is None:
+            # a new (or expired, so full) bucket
+            if cache.add(key, (tokens - 1, now), time=seconds):
+                return 0
+            continue
+        level, counted = bucket
+        level = min(tokens, level + (now - counted) * rate)
+        if level < 1:
+            return max(int(math.ceil((1 - level) / rate)), 1)
+        if cache.cas(key, (level - 1, now), time=seconds):
+            return 0
+    return 0
+
+
+def rateLimited(method):
+    """ Decorates a ConferenceApi method so that each call takes a token
+        from the caller's bucket for the method, raising
+        RateLimitExceededException when it is empty. """
+    @functools.wraps(method)
+    def wrapper(service, request):
+        user = endpoints.get_current_user()
+        client = getUserId(user) if user else \
+            os.environ.get('REMOTE_ADDR', 'anonymous')
+        retry_after = takeToken(method.__name__, client)
+        if retry_after:
+            memcache.incr(MEMCACHE_THROTTLED_PREFIX + method.__name__,
+                          initial_value=0)
+            logging.warning('Throttled %s for %s', method.__name__, client)
+            raise RateLimitExceededException(
+                'Rate limit exceeded; retry after %d seconds' % retry_after)
+        return method(service, request)
+    return wrapper
+
+
+def rateLimitStats():
+    """ Returns a dictionary of endpoint -> limit and refused calls """
+    throttled = memcache.get_multi(
+        RATE_LIMITS.keys(), key_prefix=MEMCACHE_THROTTLED_PREFIX)
+    stats = {}
+    for endpoint in sorted(RATE_LIMITS):
+        tokens, seconds = rateLimit(endpoint)
+        stats[endpoint] = {'tokens': tokens, 'seconds': seconds,
+                           'throttled': throttled.get(endpoint, 0)}
+    return stats
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+"""
+recommend.py -- Udacity conference server-side Python App Engine
+    Conference recommendations scored against a user's Profile
+
+$Id$
+
+"""
+
+"""
+    The candidates are the Conferences that start today or later. A cron
+    job rebuilds them into an index of NumPy arrays, one row per
+    Conference in start date order:
+
+        rows, cols, data    the topics of each Conference as a sparse
+                            (coordinate) matrix over the topic vocabulary,
+                            each row of unit length
+        cities              the code of each Conference's city
+        months              the month of each Conference (0 for none)
+
+    The index is pickled, compressed and stored in RecommendationChunk
+    entities (an entity holds at most about 1MB), and each instance keeps
+    the current one in memory through RECOMMENDATION_CACHE, which the
+    rebuild invalidates.
+
+    A user's Profile is turned into the same features: the topics, cities
+    and months of the Conferences they attend and of the Conferences of
+    the Sessions in their wishlist (Sessions have no topics of their own).
+    A Conference scores the cosine similarity of the topics, plus the
+    share of the user's Conferences in its city and in its month, with
+    the weights below; this is a handful of vector operations over all
+    candidates at once. Conferences the user attends are left out.
+
+    The top MAX_RECOMMENDATIONS are kept per user in Memcache, under a key
+    holding the index version and a digest of the Profile's lists, so
+    that a rebuild or a change of the lists is picked up on the next
+    request.
+"""
+
+import cPickle as pickle
+import hashlib
+import zlib
+
+from collections import Counter
+from datetime import date
+
+import numpy as np
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from keys import decodeKey
+from localcache import LocalCache
+from models import Conference
+from models import RecommendationChunk
+from models import RecommendationIndex
+
+TOPIC_WEIGHT = 1.0
+CITY_WEIGHT = 0.5
+MONTH_WEIGHT = 0.25
+WISHLIST_WEIGHT = 0.5
+MAX_RECOMMENDATIONS = 50
+CHUNK_BYTES = 900 * 1024
+BUILD_BATCH_SIZE = 500
+RECOMMENDATION_CACHE_SECONDS = 3600
+MEMCACHE_RECOMMENDED_KEY = "RECOMMENDED_%s_%d_%s"
+
+""" The current index, held by each instance """
+RECOMMENDATION_CACHE = LocalCache('recommendations', size=1, ttl=3600)
+
+INDEX_KEY = ndb.Key(RecommendationIndex, 'current')
+
+
+def buildIndex():
+    """ Rebuilds the candidate index from the upcoming Conferences, stores
+        it as a new version and drops the chunks of the previous one. """
+    keys, rows, cols, data, city_codes, months = [], [], [], [], [], []
+    topics, cities = {}, {}
+    q = Conference.query(Conference.startDate >= date.today()).order(
+        Conference.startDate)
+    for conf in q.iter(batch_size=BUILD_BATCH_SIZE):
+        row = len(keys)
+        keys.append(conf.key.urlsafe())
+        conf_topics = set(conf.topics)
+        for topic in conf_topics:
+            rows.append(row)
+            cols.append(topics.setdefault(topic, len(topics)))
+            data.append(1.0 / np.sqrt(len(conf_topics)))
+        city_codes.append(cities.setdefault(conf.city, len(cities))
+                          if conf.city else -1)
+        months.append(conf.month or 0)
+
+    """ -1 (no city) becomes the last code, which no user vector weighs """
+    city_codes = np.array(city_codes, dtype=np.int32)
+    city_codes[city_codes < 0] = len(cities)
+    index = {
+        'keys': keys,
+        'topics': topics,
+        'cities': cities,
+        'rows': np.array(rows, dtype=np.int32),
+        'cols': np.array(cols, dtype=np.int32),
+        'data': np.array(data, dtype=np.float32),
+        'cityCodes': city_codes,
+        'months': np.array(months, dtype=np.int32),
+    }
+    blob = zlib.compress(pickle.dumps(index, pickle.HIGHEST_PROTOCOL))
+
+    current = INDEX_KEY.get()
+    version = current.version + 1 if current else 1
+    chunks = [RecommendationChunk(parent=INDEX_KEY,
+                                  id='%d-%d' % (version, i),
+                                  data=blob[offset:offset + CHUNK_BYTES])
+              for i, offset in enumerate(range(0, len(blob), CHUNK_BYTES))]
+    ndb.put_multi(chunks)
+    RecommendationIndex(key=INDEX_KEY, version=version, chunks=len(chunks),
+                        conferences=len(keys)).put()
+    if current:
+        ndb.delete_multi(
+            [ndb.Key(RecommendationChunk, '%d-%d' % (current.version, i),
+                     parent=INDEX_KEY) for i in range(current.chunks)])
+    RECOMMENDATION_CACHE.invalidate()
+
+
+def _loadIndex():
+    """ Returns the current index with its version, or None if it was
+        never built. """
+    current = INDEX_KEY.get()
+    if not current:
+        return None
+    chunks = ndb.get_multi(
+        [ndb.Key(RecommendationChunk, '%d-%d' % (current.version, i),
+                 parent=INDEX_KEY) for i in range(current.chunks)])
+    if not all(chunks):
+        return None
+    index = pickle.loads(zlib.decompress(
+        ''.join(chunk.data for chunk in chunks)))
+    index['version'] = current.version
+    index['rowOf'] = dict((wsck, row) for row, wsck in
+                          enumerate(index['keys']))
+    return index
+
+
+def currentIndex():
+    """ Returns the current index of this instance (see _loadIndex()) """
+    return RECOMMENDATION_CACHE.get('index', _loadIndex)
+
+
+def _profileVectors(prof, index):
+    """ Returns the topic, city and month vectors of a Profile over the
+        features of the index, from the Conferences it attends and those
+        of the Sessions in its wishlist, or None without any. """
+    weights = Counter()
+    for wsck in prof.conferenceKeysToAttend:
+        weights[decodeKey(wsck)] += 1.0
+    for wssk in prof.sessionKeysWishList:
+        weights[decodeKey(wssk).parent()] += WISHLIST_WEIGHT
+    keys = weights.keys()
+    conferences = [conf for conf in ndb.get_multi(keys) if conf]
+    if not conferences:
+        return None
+
+    topic_vec = np.zeros(len(index['topics']))
+    city_vec = np.zeros(len(index['cities']) + 1)
+    month_vec = np.zeros(13)
+    for conf in conferences:
+        weight = weights[conf.key]
+        for topic in set(conf.topics):
+            if topic in index['topics']:
+                topic_vec[index['topics'][topic]] += weight
+        if conf.city in index['cities']:
+            city_vec[index['cities'][conf.city]] += weight
+        if conf.month:
+            month_vec[conf.month] += weight
+
+    norm = np.sqrt(np.dot(topic_vec, topic_vec))
+    if norm:
+        topic_vec /= norm
+    total = sum(weights[conf.key] for conf in conferences)
+    return topic_vec, city_vec / total, month_vec / total
+
+
+def scoreConferences(prof, index):
+    """ Returns the websafe keys of the best scoring candidates for a
+        Profile, best first (earliest first among equal scores), leaving
+        out those it attends and those scoring nothing. """
+    vectors = _profileVectors(prof, index)
+    if vectors is None or not index['keys']:
+        return []
+    topic_vec, city_vec, month_vec = vectors
+
+    n = len(index['keys'])
+    """ the sparse matrix-vector product: one weighted bincount over the
+        non-zero entries of all rows """
+    topic_scores = np.bincount(
+        index['rows'], weights=index['data'] * topic_vec[index['cols']],
+        minlength=n)
+    scores = (TOPIC_WEIGHT * topic_scores
+              + CITY_WEIGHT * city_vec[index['cityCodes']]
+              + MONTH_WEIGHT * month_vec[index['months']])
+
+    attended = [index['rowOf'][wsck] for wsck in prof.conferenceKeysToAttend
+                if wsck in index['rowOf']]
+    scores[attended] = 0
+    candidates = np.flatnonzero(scores > 0)
+    best = candidates[np.argsort(-scores[candidates], kind='mergesort')]
+    return [index['keys'][row] for row in best[:MAX_RECOMMENDATIONS]]
+
+
+def recommendedKeys(prof):
+    """ Returns the websafe keys of the Conferences recommended to a
+        Profile (see scoreConferences()), from Memcache when they were
+        scored against the same index and lists already. """
+    index = currentIndex()
+    if index is None:
+        return []
+    digest = hashlib.md5(repr((sorted(prof.conferenceKeysToAttend),
+                               sorted(prof.sessionKeysWishList)))).hexdigest()
+    memcache_key = MEMCACHE_RECOMMENDED_KEY % (prof.key.id(),
+                                               index['version'], digest)
+    keys = memcache.get(memcache_key)
+    if keys is None:
+        keys = scoreConferences(prof, index)
+        memcache.set(memcache_key, keys, time=RECOMMENDATION_CACHE_SECONDS)
+    return keys
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+"""
+registration.py -- Udacity conference server-side Python App Engine
+    queued registration with batched seat allocation
+
+$Id$
+
+"""
+
+"""
+    When many users register for the same Conference at once, every
+    registerForConference call runs its own transaction on the Conference
+    entity group and most of them fail on contention. In the queued mode
+    a registration is instead added to the 'registrations' pull queue,
+    tagged with the websafe key of the Conference, and the client polls
+    getRegistrationStatus for the outcome.
+
+    A worker leases the requests for one Conference in batches and grants
+    the seats of a whole batch in a single cross-group transaction, so the
+    Conference is written once per batch rather than once per registrant.
+    A transaction spans at most 25 entity groups: the Conference's group
+    plus REGISTRATION_BATCH_SIZE Profiles.
+
+    Workers are started with the fork-join pattern: every request tries to
+    add a worker task named after the Conference and the current value of
+    a Memcache index. The first request of a round adds the task, the rest
+    collide with its name. A running worker first increments the index, so
+    requests that arrive while it runs start the next round. A cron job
+    picks up anything left behind (e.g. if the index was evicted).
+"""
+
+import hashlib
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from keys import decodeKey
+from localcache import CONFERENCE_CACHE
+from models import Profile
+from models import RegistrationState
+from models import RegistrationStatus
+
+REGISTRATION_QUEUE = 'registrations'
+REGISTRATION_BATCH_SIZE = 24
+MAX_BATCHES_PER_RUN = 20
+LEASE_SECONDS = 60
+WORKER_COUNTDOWN_SECONDS = 1
+MEMCACHE_REGISTRATION_INDEX_KEY = "REGISTRATION_INDEX_%s"
+
+
+def _statusKey(user_id, wsck):
+    """ Returns the key of a user's RegistrationStatus for a Conference """
+    return ndb.Key(Profile, user_id, RegistrationStatus, wsck)
+
+
+@ndb.tasklet
+def registrationStateAsync(user_id, wsck):
+    """ Returns (as a Future) the RegistrationState of a user's latest
+        queued request to register for a Conference, or None if there is
+        none. """
+    status = yield _statusKey(user_id, wsck).get_async()
+    raise ndb.Return(getattr(RegistrationState, status.state)
+                     if status else None)
+
+
+def registrationState(user_id, wsck):
+    """ Synchronous version of registrationStateAsync """
+    return registrationStateAsync(user_id, wsck).get_result()
+
+
+def queueRegistration(user_id, wsck):
+    """ Adds a request to register a user for a Conference to the queue
+        and makes sure a worker will process it. """
+    RegistrationStatus(key=_statusKey(user_id, wsck),
+                       state=str(RegistrationState.PENDING)).put()
+    taskqueue.Queue(REGISTRATION_QUEUE).add(
+        taskqueue.Task(payload=user_id, method='PULL', tag=wsck))
+    _startWorker(wsck)
+
+
+def _startWorker(wsck):
+    """ Adds the worker task of the current round for a Conference, unless
+        another request has already added it. """
+    index_key = MEMCACHE_REGISTRATION_INDEX_KEY % wsck
+    index = memcache.get(index_key)
+    if index is None:
+        memcache.add(index_key, 0)
+        index = memcache.get(index_key) or 0
+    name = 'register-%s-%d' % (hashlib.md5(wsck).hexdigest(), index)
+    try:
+        taskqueue.add(name=name, params={'wsck': wsck},
+                      countdown=WORKER_COUNTDOWN_SECONDS,
+                      url='/tasks/process_registrations')
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+@ndb.transactional(xg=True)
+def _grantSeats(wsck, user_ids):
+    """ Registers a batch of users for a Conference in one transaction,
+        as long as seats last. Records the outcome for every user in their
+        RegistrationStatus and writes all entities with one put_multi. """
+    conf = decodeKey(wsck).get()
+    profiles = ndb.get_multi([ndb.Key(Profile, uid) for uid in user_ids])
+
+    changed = []
+    for user_id, prof in zip(user_ids, profiles):
+        if not conf or not prof:
+            state = RegistrationState.FAILED
+        elif wsck in prof.conferenceKeysToAttend:
+            state = RegistrationState.ALREADY_REGISTERED
+        elif conf.seatsAvailable <= 0:
+            state = RegistrationState.SOLD_OUT
+        else:
+            prof.conferenceKeysToAttend.append(wsck)
+            conf.seatsAvailable -= 1
+            changed.append(prof)
+            state = RegistrationState.REGISTERED
+        changed.append(RegistrationStatus(key=_statusKey(user_id, wsck),
+                                          state=str(state)))
+    if conf:
+        changed.append(conf)
+    ndb.put_multi(changed)
+
+
+def processRegistrations(wsck=None):
+    """ Leases and processes queued registrations for a Conference in
+        batches until none are left or MAX_BATCHES_PER_RUN batches have
+        been handled. Without a Conference, each batch is taken from the
+        Conference with the oldest queued request. """
+    if wsck:
+        # requests queued from now on belong to the next round
+        memcache.incr(MEMCACHE_REGISTRATION_INDEX_KEY % wsck,
+                      initial_value=0)
+
+    queue = taskqueue.Queue(REGISTRATION_QUEUE)
+    for batch in range(MAX_BATCHES_PER_RUN):
+        tasks = queue.lease_tasks_by_tag(
+            LEASE_SECONDS, REGISTRATION_BATCH_SIZE, tag=wsck)
+        if not tasks:
+            break
+
+        # a user who asked twice is only registered once
+        user_ids = sorted(set(task.payload for task in tasks))
+        _grantSeats(tasks[0].tag, user_ids)
+        CONFERENCE_CACHE.delete(tasks[0].tag)
+        queue.delete_tasks(tasks)
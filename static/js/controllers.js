@@ -293,6 +293,23 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.conferences = [];
 
+    /**
+     * Holds the number of matching conferences per city, topic and month.
+     * @type {Array}
+     */
+    $scope.facets = [];
+
+    /**
+     * Maps the field names returned by conference.getConferenceFacets to the filterable fields.
+     *
+     * @type {{}}
+     */
+    $scope.facetFields = {
+        'city': $scope.filtereableFields[0],
+        'topics': $scope.filtereableFields[1],
+        'month': $scope.filtereableFields[2]
+    };
+
     /**
      * Holds the state if offcanvas is enabled.
      *
@@ -408,6 +425,39 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         }
     };
 
+    /**
+     * Adds an equality filter for the facet and re-runs the query.
+     *
+     * @param facet
+     */
+    $scope.addFacetFilter = function (facet) {
+        $scope.filters.push({
+            field: $scope.facetFields[facet.field],
+            operator: $scope.operators[0],
+            value: facet.value
+        });
+        $scope.queryConferences();
+    };
+
+    /**
+     * Invokes the conference.getConferenceFacets API with the filters of the current query.
+     *
+     * @param sendFilters
+     */
+    $scope.getConferenceFacets = function (sendFilters) {
+        gapi.client.conference.getConferenceFacets(sendFilters).
+            execute(function (resp) {
+                $scope.$apply(function () {
+                    if (resp.error) {
+                        $log.error('Failed to get the conference facets : ' + (resp.error.message || ''));
+                        $scope.facets = [];
+                    } else {
+                        $scope.facets = resp.items || [];
+                    }
+                });
+            });
+    };
+
     /**
      * Query the conferences depending on the tab currently selected.
      *
@@ -428,7 +478,10 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.queryConferencesAll = function () {
         var sendFilters = {
-            filters: []
+            filters: [],
+            // Only the fields shown in the list (see show_conferences.html).
+            fields: ['websafeKey', 'name', 'city', 'startDate', 'organizerDisplayName',
+                'maxAttendees', 'seatsAvailable']
         }
         for (var i = 0; i < $scope.filters.length; i++) {
             var filter = $scope.filters[i];
@@ -462,6 +515,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         angular.forEach(resp.items, function (conference) {
                             $scope.conferences.push(conference);
                         });
+                        $scope.getConferenceFacets(sendFilters);
                     }
                     $scope.submitted = true;
                 });
@@ -540,6 +594,53 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
 });
 
 
+/**
+ * @ngdoc controller
+ * @name UpcomingConferencesCtrl
+ *
+ * @description
+ * A controller used for the list of upcoming conferences on the home page.
+ */
+conferenceApp.controllers.controller('UpcomingConferencesCtrl', function ($scope, $log) {
+
+    /**
+     * Holds the upcoming conferences loaded so far, ordered by start date.
+     * @type {Array}
+     */
+    $scope.conferences = [];
+
+    /**
+     * Holds the token of the next page, if there is one.
+     */
+    $scope.nextPageToken = null;
+
+    /**
+     * Invokes the conference.getUpcomingConferences API for the next page of the feed.
+     */
+    $scope.loadUpcoming = function () {
+        var request = {};
+        if ($scope.nextPageToken) {
+            request.pageToken = $scope.nextPageToken;
+        }
+        $scope.loading = true;
+        gapi.client.conference.getUpcomingConferences(request).
+            execute(function (resp) {
+                $scope.$apply(function () {
+                    $scope.loading = false;
+                    if (resp.error) {
+                        $log.error('Failed to get the upcoming conferences : ' + (resp.error.message || ''));
+                    } else {
+                        angular.forEach(resp.result.items || [], function (conference) {
+                            $scope.conferences.push(conference);
+                        });
+                        $scope.nextPageToken = resp.result.nextPageToken || null;
+                    }
+                });
+            });
+    };
+});
+
+
 /**
  * @ngdoc controller
  * @name ConferenceDetailCtrl
@@ -552,14 +653,21 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
 
     $scope.isUserAttending = false;
 
+    $scope.sessions = [];
+
+    $scope.featuredSpeaker = null;
+
+    $scope.sessionKeysInWishlist = [];
+
     /**
      * Initializes the conference detail page.
-     * Invokes the conference.getConference method and sets the returned conference in the $scope.
+     * Invokes the conference.getConferenceDetail method, which returns the conference together with its
+     * sessions, featured speaker and the user's registration state, and sets them in the $scope.
      *
      */
     $scope.init = function () {
         $scope.loading = true;
-        gapi.client.conference.getConference({
+        gapi.client.conference.getConferenceDetail({
             websafeConferenceKey: $routeParams.websafeConferenceKey
         }).execute(function (resp) {
             $scope.$apply(function () {
@@ -567,40 +675,46 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                 if (resp.error) {
                     // The request has failed.
                     var errorMessage = resp.error.message || '';
-                    $scope.messages = 'Failed to get the conference : ' + $routeParams.websafeKey
+                    $scope.messages = 'Failed to get the conference : ' + $routeParams.websafeConferenceKey
                         + ' ' + errorMessage;
                     $scope.alertStatus = 'warning';
                     $log.error($scope.messages);
                 } else {
                     // The request has succeeded.
+                    var detail = resp.result;
                     $scope.alertStatus = 'success';
-                    $scope.conference = resp.result;
-                }
-            });
-        });
-
-        $scope.loading = true;
-        // If the user is attending the conference, updates the status message and available function.
-        gapi.client.conference.getProfile().execute(function (resp) {
-            $scope.$apply(function () {
-                $scope.loading = false;
-                if (resp.error) {
-                    // Failed to get a user profile.
-                } else {
-                    var profile = resp.result;
-                    for (var i = 0; i < profile.conferenceKeysToAttend.length; i++) {
-                        if ($routeParams.websafeConferenceKey == profile.conferenceKeysToAttend[i]) {
-                            // The user is attending the conference.
-                            $scope.alertStatus = 'info';
-                            $scope.messages = 'You are attending this conference';
-                            $scope.isUserAttending = true;
-                        }
+                    $scope.conference = detail.conference;
+                    $scope.sessions = detail.sessions || [];
+                    $scope.featuredSpeaker = detail.featuredSpeaker || null;
+                    $scope.sessionKeysInWishlist = detail.sessionKeysInWishlist || [];
+                    if (detail.isAttending) {
+                        // The user is attending the conference.
+                        $scope.alertStatus = 'info';
+                        $scope.messages = 'You are attending this conference';
+                        $scope.isUserAttending = true;
+                    } else if (detail.registrationState == 'PENDING') {
+                        $scope.alertStatus = 'info';
+                        $scope.messages = 'Your registration for this conference is being processed';
+                    } else if (detail.waitlistPosition) {
+                        $scope.alertStatus = 'info';
+                        $scope.messages = 'You are number ' + detail.waitlistPosition +
+                            ' on the waitlist of this conference';
                     }
                 }
             });
         });
     };
 
+    /**
+     * Tells if a session is on the user's wishlist.
+     *
+     * @param session
+     * @returns {boolean}
+     */
+    $scope.isInWishlist = function (session) {
+        return $scope.sessionKeysInWishlist.indexOf(session.sessionKey) >= 0;
+    };
+
 
     /**
      * Invokes the conference.registerForConference method.
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+"""
+test_mapper.py -- Udacity conference server-side Python App Engine
+    tests of the mapper (mapper.py) and its jobs (jobs.py)
+
+$Id$
+
+"""
+
+"""
+    The tests run on the App Engine SDK's local stubs, from the project
+    directory, with the SDK on the path:
+
+        PYTHONPATH=.:$APPENGINE_SDK python -m unittest discover tests
+
+    Tasks are not run by the taskqueue stub; runTasks() runs the mapper
+    chain by hand, one round of queued tasks at a time.
+"""
+
+import os
+import unittest
+
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+from datetime import date
+from datetime import time
+
+from google.appengine.api import datastore
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import jobs  # registers the mapper jobs
+import mapper
+
+from idblock import ID_FLOOR
+from models import Conference
+from models import ConferenceAlias
+from models import MapperJob
+from models import MapperShard
+from models import Profile
+from models import Session
+from models import Speaker
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class MapperTestItem(ndb.Model):
+    """ an entity for the mapper's own tests """
+    mapped = ndb.BooleanProperty(default=False)
+
+
+@mapper.mapperJob(MapperTestItem, name='markItems', shards=1, batch_size=2)
+def markItems(item):
+    if not item.mapped:
+        item.mapped = True
+        return item
+
+
+def putLegacyProfile(user_id, websafe_keys):
+    """ Stores a Profile as written before its key lists were compact. It
+        is written without ndb, whose Profile model would compact them. """
+    entity = datastore.Entity('Profile', name=user_id)
+    entity['conferenceKeysToAttend'] = websafe_keys
+    datastore.Put(entity)
+
+
+class MapperTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.taskqueue = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().clear_cache()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def runTasks(self):
+        """ Runs the queued mapper tasks until none are left and returns
+            the parameters of every task run """
+        run = []
+        while True:
+            tasks = self.taskqueue.get_filtered_tasks(
+                queue_names=mapper.MAPPER_QUEUE)
+            self.taskqueue.FlushQueue(mapper.MAPPER_QUEUE)
+            if not tasks:
+                return run
+            for task in tasks:
+                params = task.extract_params()
+                mapper.processShard(ndb.Key(urlsafe=params['shard']),
+                                    params.get('cursor', ''))
+                run.append(params)
+
+    def runJob(self, name):
+        """ Runs a job to the end and returns its MapperJob """
+        job_key = mapper.startJob(name)
+        self.runTasks()
+        return job_key.get()
+
+    def shards(self, job):
+        return MapperShard.query(ancestor=job.key).fetch()
+
+
+class MapperTest(MapperTestCase):
+
+    def testChainsBatchesThroughCursors(self):
+        ndb.put_multi([MapperTestItem() for i in range(5)])
+        job_key = mapper.startJob('markItems')
+        run = self.runTasks()
+
+        job = job_key.get()
+        self.assertEqual(mapper.DONE, job.status)
+        self.assertTrue(all(item.mapped for item in MapperTestItem.query()))
+        """ 5 entities in batches of 2: three tasks, each starting from the
+            cursor the previous one checkpointed """
+        self.assertEqual(3, len(run))
+        self.assertEqual('', run[0].get('cursor', ''))
+        self.assertTrue(all(params.get('cursor') for params in run[1:]))
+        shard, = self.shards(job)
+        self.assertTrue(shard.done)
+        self.assertEqual((5, 5), (shard.processed, shard.written))
+
+    def testIgnoresStaleTasks(self):
+        ndb.put_multi([MapperTestItem() for i in range(3)])
+        job_key = mapper.startJob('markItems')
+        first = self.taskqueue.get_filtered_tasks(
+            queue_names=mapper.MAPPER_QUEUE)[0].extract_params()
+        self.runTasks()
+
+        """ a duplicate of the first task finds the shard done """
+        mapper.processShard(ndb.Key(urlsafe=first['shard']), '')
+        shard, = self.shards(job_key.get())
+        self.assertEqual(3, shard.processed)
+
+    def testPausesAndResumes(self):
+        ndb.put_multi([MapperTestItem() for i in range(5)])
+        job_key = mapper.startJob('markItems')
+        mapper.pauseJob(job_key)
+        self.runTasks()
+        self.assertEqual(0, MapperTestItem.query(
+            MapperTestItem.mapped == True).count())
+
+        mapper.resumeJob(job_key)
+        self.runTasks()
+        self.assertEqual(mapper.DONE, job_key.get().status)
+        self.assertEqual(5, MapperTestItem.query(
+            MapperTestItem.mapped == True).count())
+
+    def testPausesUnknownJobs(self):
+        for name in ('removedJob', None):
+            job = MapperJob(name=name, status=mapper.RUNNING, shardCount=1)
+            job.put()
+            shard = MapperShard(parent=job.key, id=1, index=0)
+            shard.put()
+            mapper.processShard(shard.key, '')
+            self.assertEqual(mapper.PAUSED, job.key.get().status)
+            self.assertEqual(0, shard.key.get().processed)
+
+    def testStopsWithoutJob(self):
+        shard_key = ndb.Key(MapperJob, 12345, MapperShard, 1)
+        mapper.processShard(shard_key, '')
+        self.assertEqual([], self.taskqueue.get_filtered_tasks(
+            queue_names=mapper.MAPPER_QUEUE))
+
+    def testSkipsEntitiesDeletedSinceTheQuery(self):
+        key = MapperTestItem().put()
+        key.delete()
+        self.assertEqual(0, ndb.transaction(
+            lambda: mapper._mapKey(markItems, key), xg=True))
+
+
+class JobsTest(MapperTestCase):
+
+    def conference(self, **values):
+        values.setdefault('name', 'Conference')
+        return Conference(parent=ndb.Key(Profile, 'organizer'), **values)
+
+    def testBackfillConferenceMonth(self):
+        key = self.conference(startDate=date(2026, 5, 4)).put()
+        undated = self.conference().put()
+        self.runJob('backfillConferenceMonth')
+        self.assertEqual(5, key.get().month)
+        self.assertEqual(None, undated.get().month)
+
+    def testRepairSeatsAvailable(self):
+        key = self.conference(maxAttendees=10, seatsAvailable=3).put()
+        full = self.conference(maxAttendees=1, seatsAvailable=1).put()
+        wsck = key.urlsafe()
+        ndb.put_multi([
+            Profile(id='a', conferenceKeysToAttend=[wsck]),
+            Profile(id='b', conferenceKeysToAttend=[wsck, full.urlsafe()]),
+            Profile(id='c', conferenceKeysToAttend=[full.urlsafe()]),
+        ])
+        self.runJob('repairSeatsAvailable')
+        self.assertEqual(8, key.get().seatsAvailable)
+        self.assertEqual(0, full.get().seatsAvailable)
+
+    def testRepairSeatsAvailableCountsLegacyProfiles(self):
+        key = self.conference(maxAttendees=10, seatsAvailable=10).put()
+        Profile(id='a', conferenceKeysToAttend=[key.urlsafe()]).put()
+        putLegacyProfile('b', [key.urlsafe()])
+        self.runJob('repairSeatsAvailable')
+        self.assertEqual(8, key.get().seatsAvailable)
+
+    def testRecomputeFeaturedSpeakers(self):
+        keys = ndb.put_multi([self.conference(), self.conference()])
+        self.runJob('recomputeFeaturedSpeakers')
+        tasks = self.taskqueue.get_filtered_tasks(
+            url='/tasks/set_featured_speaker')
+        self.assertEqual(sorted(key.urlsafe() for key in keys),
+                         sorted(task.extract_params()['c_key']
+                                for task in tasks))
+
+    def testBackfillConferenceAliases(self):
+        compact = self.conference(id=ID_FLOOR + 1).put()
+        legacy = self.conference(id=7).put()
+        self.runJob('backfillConferenceAliases')
+        self.assertEqual(compact,
+                         ndb.Key(ConferenceAlias, ID_FLOOR + 1).get().conference)
+        self.assertEqual(None, ndb.Key(ConferenceAlias, 7).get())
+
+    def testMigrateProfileLists(self):
+        kept = self.conference().put()
+        gone = self.conference().put()
+        gone.delete()
+        sess = Session(parent=kept, sessionName='Session').put()
+        prof_key = Profile(
+            id='a',
+            conferenceKeysToAttend=[kept.urlsafe(), gone.urlsafe(),
+                                    kept.urlsafe()],
+            sessionKeysWishList=[sess.urlsafe(), sess.urlsafe()]).put()
+        self.runJob('migrateProfileLists')
+        prof = prof_key.get()
+        self.assertEqual([kept.urlsafe()], prof.conferenceKeysToAttend)
+        self.assertEqual([sess.urlsafe()], prof.sessionKeysWishList)
+
+    def testBackfillSessionStartTimes(self):
+        conf = self.conference().put()
+        ndb.put_multi([
+            Session(parent=conf, sessionName='Timed', date=date(2026, 5, 4),
+                    startTime=time(9, 30)),
+            Session(parent=conf, sessionName='Untimed'),
+        ])
+        job = self.runJob('backfillSessionStartTimes')
+        self.assertEqual(1, sum(shard.written for shard in self.shards(job)))
+        self.assertEqual(['Timed'], [sess.sessionName for sess in
+                                     Session.query(Session.startMinute == 570)])
+
+    def testBackfillSpeakerSortName(self):
+        key = Speaker(displayName=u'\xc9mile  Zola').put()
+        self.runJob('backfillSpeakerSortName')
+        self.assertEqual(key, Speaker.query(
+            Speaker.sortName == u'emile zola').get(keys_only=True))
+
+    def testCompactProfileLists(self):
+        conf = self.conference().put()
+        putLegacyProfile('a', [conf.urlsafe()])
+        self.assertEqual([], Profile.query(
+            Profile.conferenceKeysToAttend == conf.urlsafe()).fetch())
+        self.runJob('compactProfileLists')
+        self.assertEqual(['a'], [prof.key.id() for prof in Profile.query(
+            Profile.conferenceKeysToAttend == conf.urlsafe())])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+tombstones.py -- Udacity conference server-side Python App Engine
+    short-lived Memcache tombstones for keys of missing entities
+
+$Id$
+
+"""
+
+"""
+    Crawlers and stale clients keep asking for Conferences and Sessions
+    that were deleted (or never existed). When a get by key finds nothing,
+    a tombstone for the key is kept in Memcache for TOMBSTONE_SECONDS, and
+    the next lookups of the key within that time are answered from it
+    without a datastore read.
+
+    A lookup asks for the tombstone together with ndb's own cache lookup
+    of the entity (both Memcache gets leave in the same round trip), so a
+    lookup served by the cache waits no longer than without tombstones;
+    only when neither answers is the datastore read.
+
+    Once a new entity is stored, its creator clears the tombstone of its
+    key by replacing it with a marker (CLEARED) for TOMBSTONE_SECONDS. A
+    tombstone is only stored with memcache add, which fails while the key
+    holds the marker, so a lookup that missed the entity just before it
+    was stored cannot bury it again afterwards.
+
+    The number of lookups answered by a tombstone, of tombstones stored
+    and of keys cleared are counted in Memcache; see tombstoneStats().
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+TOMBSTONE_SECONDS = 60
+MEMCACHE_TOMBSTONE_KEY = "TOMBSTONE_%s"
+MEMCACHE_TOMBSTONE_STATS_PREFIX = "TOMBSTONE_STATS_"
+TOMBSTONE_STATS = ('hits', 'stored', 'cleared')
+TOMBSTONE = 'missing'
+CLEARED = 'cleared'
+
+
+def _tombstoneKey(key):
+    """ Returns the Memcache key of the tombstone of a key """
+    return MEMCACHE_TOMBSTONE_KEY % key.urlsafe()
+
+
+def _record(**counts):
+    """ Adds to the tombstone counters without waiting for Memcache """
+    memcache.Client().offset_multi_async(
+        counts, initial_value=0, key_prefix=MEMCACHE_TOMBSTONE_STATS_PREFIX)
+
+
+@ndb.tasklet
+def getEntityAsync(key):
+    """ Returns (as a Future) the entity of a key, or None if it does not
+        exist, skipping the datastore while the key has a tombstone. """
+    ctx = ndb.get_context()
+    entity, tombstone = yield (key.get_async(use_datastore=False),
+                               ctx.memcache_get(_tombstoneKey(key)))
+    if entity is not None:
+        raise ndb.Return(entity)
+    if tombstone == TOMBSTONE:
+        _record(hits=1)
+        raise ndb.Return(None)
+    entity = yield key.get_async()
+    if entity is None and (yield ctx.memcache_add(
+            _tombstoneKey(key), TOMBSTONE, time=TOMBSTONE_SECONDS)):
+        _record(stored=1)
+    raise ndb.Return(entity)
+
+
+def getEntity(key):
+    """ Synchronous version of getEntityAsync """
+    return getEntityAsync(key).get_result()
+
+
+@ndb.tasklet
+def clearTombstonesAsync(*keys):
+    """ Clears (as a Future) the tombstones of the keys of new entities,
+        which must be stored already """
+    ctx = ndb.get_context()
+    yield [ctx.memcache_set(_tombstoneKey(key), CLEARED,
+                            time=TOMBSTONE_SECONDS) for key in keys]
+    _record(cleared=len(keys))
+
+
+def clearTombstones(*keys):
+    """ Synchronous version of clearTombstonesAsync """
+    clearTombstonesAsync(*keys).get_result()
+
+
+def tombstoneStats():
+    """ Returns the tombstone counters """
+    counts = memcache.get_multi(
+        TOMBSTONE_STATS, key_prefix=MEMCACHE_TOMBSTONE_STATS_PREFIX)
+    return dict((name, counts.get(name, 0)) for name in TOMBSTONE_STATS)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+upcoming.py -- Udacity conference server-side Python App Engine
+    feed of upcoming Conferences ordered by start date
+
+$Id$
+
+"""
+
+"""
+    The feed lists the Conferences that start today or later, ordered by
+    startDate (and key, for a stable order), a page at a time. The range
+    and the order are on the same property, so the feed is served by the
+    built-in startDate index. Conferences without a start date are not in
+    it.
+
+    The first FEED_PAGES pages of the default feed (no date range,
+    FEED_PAGE_SIZE Conferences per page) are materialized in Memcache,
+    keyed by the day and the page token, with the Conferences and their
+    organizers' display names. They are refreshed by the upcoming feed
+    cron job and by a task enqueued whenever a Conference is created or
+    updated. As the key holds the day, the pages of a new day are built
+    afresh, so Conferences that have started drop off on their own.
+"""
+
+import hashlib
+
+from datetime import date
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Conference
+
+FEED_PAGE_SIZE = 20
+FEED_PAGES = 3
+FEED_CACHE_SECONDS = 24 * 3600
+REFRESH_COUNTDOWN_SECONDS = 5
+MEMCACHE_UPCOMING_KEY = "UPCOMING_%s_%s"
+
+
+def _pageKey(day, page_token):
+    """ Returns the Memcache key of a materialized page of the feed """
+    return MEMCACHE_UPCOMING_KEY % (
+        day.isoformat(), hashlib.md5(page_token or '').hexdigest())
+
+
+def upcomingPage(page_size, page_token=None, from_date=None, to_date=None):
+    """ Returns a page of upcoming Conferences, starting from from_date
+        (or today, whichever is later) up to and including to_date, as a
+        list of (Conference, organizer display name) pairs with the token
+        of the next page, or None if this is the last one. """
+    today = date.today()
+    q = Conference.query(Conference.startDate >= max(from_date or today,
+                                                     today))
+    if to_date:
+        q = q.filter(Conference.startDate <= to_date)
+    q = q.order(Conference.startDate, Conference.key)
+
+    cursor = Cursor(urlsafe=page_token) if page_token else None
+    keys, next_cursor, more = q.fetch_page(
+        page_size, start_cursor=cursor, keys_only=True)
+    conferences = [conf for conf in ndb.get_multi(keys) if conf]
+    profiles = ndb.get_multi(set(conf.key.parent() for conf in conferences))
+    names = dict((prof.key, prof.displayName) for prof in profiles if prof)
+
+    return ([(conf, names.get(conf.key.parent())) for conf in conferences],
+            next_cursor.urlsafe() if more and next_cursor else None)
+
+
+def feedPage(page_token=None):
+    """ Returns a page of the default feed like upcomingPage(), from
+        Memcache when it is materialized. A missing first page (e.g. on a
+        new day) is materialized on the way. """
+    page = memcache.get(_pageKey(date.today(), page_token))
+    if page is None:
+        page = upcomingPage(FEED_PAGE_SIZE, page_token)
+        if not page_token:
+            memcache.set(_pageKey(date.today(), page_token), page,
+                         time=FEED_CACHE_SECONDS)
+    return page
+
+
+def refreshFeed():
+    """ Rebuilds the materialized pages of today's feed """
+    today = date.today()
+    pages = {}
+    token = None
+    for i in range(FEED_PAGES):
+        page = upcomingPage(FEED_PAGE_SIZE, token)
+        pages[_pageKey(today, token)] = page
+        token = page[1]
+        if not token:
+            break
+    memcache.set_multi(pages, time=FEED_CACHE_SECONDS)
+
+
+def refreshTask():
+    """ Returns the task that refreshes the feed after a Conference was
+        written, once the write shows in the (eventually consistent)
+        startDate index. """
+    return taskqueue.Task(url='/tasks/refresh_upcoming',
+                          countdown=REFRESH_COUNTDOWN_SECONDS)
@@ -3,6 +3,8 @@ import os
 import time
 import uuid
 
+from datetime import datetime
+
 from google.appengine.api import urlfetch
 from models import Profile
 
@@ -43,3 +45,11 @@ def getUserId(user, id_type="email"):
             return profile.id()
         else:
             return str(uuid.uuid1().get_hex())
+
+
+def minuteOfDay(value):
+    """ Returns the minutes since midnight of an 'HH:MM' string (24 hour
+        format) or of a time object, as stored in Session.startMinute. """
+    if isinstance(value, basestring):
+        value = datetime.strptime(value, "%H:%M").time()
+    return value.hour * 60 + value.minute
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""
+waitlist.py -- Udacity conference server-side Python App Engine
+    Conference waitlists with batched FIFO promotion
+
+$Id$
+
+"""
+
+"""
+    Once a Conference is sold out, users can join its waitlist instead of
+    retrying registerForConference. A WaitlistEntry is a child of the
+    user's Profile (id: the websafe Conference key), so joining and
+    leaving never touch the Conference entity group.
+
+    When a seat is freed by unregisterFromConference, a promotion task is
+    enqueued. The promotion worker takes the oldest entries in batches and
+    registers them in one cross-group transaction per batch (the
+    Conference's group plus up to WAITLIST_BATCH_SIZE Profiles), deleting
+    their entries and enqueuing a notification for the promoted users.
+
+    A user's position is found with a binary search of the sorted join
+    times of the Conference's waitlist, which are cached in Memcache for
+    WAITLIST_CACHE_SECONDS. Joining does not invalidate the cache (a new
+    entry goes to the end); leaving and promotion do.
+"""
+
+import bisect
+import json
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from keys import decodeKey
+from localcache import CONFERENCE_CACHE
+from models import Profile
+from models import WaitlistEntry
+
+WAITLIST_BATCH_SIZE = 24
+MAX_BATCHES_PER_RUN = 20
+WAITLIST_CACHE_SECONDS = 30
+MEMCACHE_WAITLIST_KEY = "WAITLIST_%s"
+
+
+def _entryKey(user_id, wsck):
+    """ Returns the key of a user's WaitlistEntry for a Conference """
+    return ndb.Key(Profile, user_id, WaitlistEntry, wsck)
+
+
+@ndb.tasklet
+def _joinTimesAsync(wsck):
+    """ Returns (as a Future) the sorted join times of a Conference's
+        waitlist, from Memcache when available. """
+    ctx = ndb.get_context()
+    times = yield ctx.memcache_get(MEMCACHE_WAITLIST_KEY % wsck)
+    if times is None:
+        entries = yield WaitlistEntry.query(
+            WaitlistEntry.conferenceKey == wsck).order(
+            WaitlistEntry.joined).fetch_async(
+            projection=[WaitlistEntry.joined])
+        times = [entry.joined for entry in entries]
+        yield ctx.memcache_set(MEMCACHE_WAITLIST_KEY % wsck, times,
+                               time=WAITLIST_CACHE_SECONDS)
+    raise ndb.Return(times)
+
+
+@ndb.tasklet
+def waitlistPositionAsync(user_id, wsck):
+    """ Returns (as a Future) the 1-based position of a user on a
+        Conference's waitlist, or 0 if the user is not on it. """
+    entry = yield _entryKey(user_id, wsck).get_async()
+    if not entry:
+        raise ndb.Return(0)
+    times = yield _joinTimesAsync(wsck)
+    raise ndb.Return(bisect.bisect_left(times, entry.joined) + 1)
+
+
+def waitlistPosition(user_id, wsck):
+    """ Synchronous version of waitlistPositionAsync """
+    return waitlistPositionAsync(user_id, wsck).get_result()
+
+
+def addToWaitlist(user_id, wsck):
+    """ Puts a user on a Conference's waitlist (once) and returns their
+        position. """
+    entry_key = _entryKey(user_id, wsck)
+    if not entry_key.get():
+        WaitlistEntry(key=entry_key, conferenceKey=wsck).put()
+    return waitlistPosition(user_id, wsck)
+
+
+def removeFromWaitlist(user_id, wsck):
+    """ Takes a user off a Conference's waitlist. Returns False if the
+        user was not on it. """
+    entry_key = _entryKey(user_id, wsck)
+    if not entry_key.get():
+        return False
+    entry_key.delete()
+    memcache.delete(MEMCACHE_WAITLIST_KEY % wsck)
+    return True
+
+
+def promotionTask(wsck):
+    """ Returns the task that fills the free seats of a Conference from its
+        waitlist. """
+    return taskqueue.Task(params={'wsck': wsck},
+                          url='/tasks/promote_waitlist')
+
+
+@ndb.transactional(xg=True)
+def _promoteBatch(wsck, entry_keys):
+    """ Registers the users of a batch of waitlist entries (oldest first)
+        for as many seats as are free, in one transaction. Returns the ids
+        of the promoted users and whether any seats are left. """
+    conf = decodeKey(wsck).get()
+    if not conf:
+        ndb.delete_multi(entry_keys)
+        return [], False
+
+    entries = ndb.get_multi(entry_keys)
+    profiles = ndb.get_multi([e_key.parent() for e_key in entry_keys])
+
+    promoted = []
+    changed = []
+    done = []
+    for e_key, entry, prof in zip(entry_keys, entries, profiles):
+        if conf.seatsAvailable <= 0:
+            break
+        # the entry may have been deleted since the (eventual) query
+        if not entry or not prof:
+            continue
+        if wsck not in prof.conferenceKeysToAttend:
+            prof.conferenceKeysToAttend.append(wsck)
+            conf.seatsAvailable -= 1
+            changed.append(prof)
+            promoted.append(prof.key.id())
+        done.append(e_key)
+
+    if promoted:
+        changed.append(conf)
+        ndb.put_multi(changed)
+        taskqueue.add(params={'wsck': wsck, 'users': json.dumps(promoted)},
+                      url='/tasks/notify_waitlist', transactional=True)
+    ndb.delete_multi(done)
+    return promoted, conf.seatsAvailable > 0
+
+
+def promoteWaitlist(wsck):
+    """ Fills the free seats of a Conference from its waitlist, oldest
+        entries first, one batch (and one transaction) at a time. """
+    for batch in range(MAX_BATCHES_PER_RUN):
+        entry_keys = WaitlistEntry.query(
+            WaitlistEntry.conferenceKey == wsck).order(
+            WaitlistEntry.joined).fetch(WAITLIST_BATCH_SIZE, keys_only=True)
+        if not entry_keys:
+            break
+
+        promoted, seats_left = _promoteBatch(wsck, entry_keys)
+        memcache.delete(MEMCACHE_WAITLIST_KEY % wsck)
+        if promoted:
+            CONFERENCE_CACHE.delete(wsck)
+        if not seats_left:
+            break